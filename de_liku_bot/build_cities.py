@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# Сборка набора населённых пунктов Украины для поиска городов в "Де ліки Bot"
+#
+# Результат — файл ua_settlements.tsv (название, область, население, варианты написания через "|"),
+# который бот читает при первом поиске города и строит по нему индекс.
+#
+# Источники:
+#   --katottg FILE.csv   официальный Кодифікатор адміністративно-територіальних одиниць (КАТОТТГ),
+#                        выгрузка CSV с сайта Мінрегіону / data.gov.ua — полный список (~28 тыс.)
+#   --geonames           GeoNames (CC BY 4.0) через пакет geonamescache: пункты от 500 жителей
+#                        с латинскими и русскими вариантами названий
+# Оба источника можно указать вместе: варианты написания из GeoNames добавятся к записям КАТОТТГ.
+#
+# Пример:
+#   python3 build_cities.py --geonames -o ua_settlements.tsv
+#   python3 build_cities.py --katottg katottg.csv --geonames -o ua_settlements.tsv
+import argparse
+import csv
+import math
+import re
+import sys
+
+# Коды областей GeoNames (admin1) для Украины
+GEONAMES_REGIONS = {
+    "01": "Черкаська обл.", "02": "Чернігівська обл.", "03": "Чернівецька обл.",
+    "04": "Дніпропетровська обл.", "05": "Донецька обл.", "06": "Івано-Франківська обл.",
+    "07": "Харківська обл.", "08": "Херсонська обл.", "09": "Хмельницька обл.",
+    "10": "Кіровоградська обл.", "11": "АР Крим", "12": "м. Київ", "13": "Київська обл.",
+    "14": "Луганська обл.", "15": "Львівська обл.", "16": "Миколаївська обл.",
+    "17": "Одеська обл.", "18": "Полтавська обл.", "19": "Рівненська обл.",
+    "20": "м. Севастополь", "21": "Сумська обл.", "22": "Тернопільська обл.",
+    "23": "Вінницька обл.", "24": "Волинська обл.", "25": "Закарпатська обл.",
+    "26": "Запорізька обл.", "27": "Житомирська обл."
+}
+
+# Категории КАТОТТГ, которые являются населёнными пунктами: місто, селище міського типу, селище, село
+KATOTTG_SETTLEMENTS = {"M", "T", "X", "C"}
+
+CYRILLIC_NAME = re.compile(r"^[А-ЯЇІЄҐа-яїієґЫЭЪЁыэъё'’ʼ\- ]+$")
+RUSSIAN_ONLY = re.compile(r"[ыэъёЫЭЪЁ]")
+
+# Официальная транслитерация (постановление КМУ №55 2010 г.) и её вариант 1996 г.,
+# которым записаны многие названия GeoNames
+BASE_LATIN = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'h', 'ґ': 'g', 'д': 'd', 'е': 'e', 'ж': 'zh', 'з': 'z',
+    'и': 'y', 'і': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
+    'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'shch', 'ь': ''
+}
+WORD_START = {'є': 'ye', 'ї': 'yi', 'й': 'y', 'ю': 'yu', 'я': 'ya'}
+IN_WORD_2010 = {'є': 'ie', 'ї': 'i', 'й': 'i', 'ю': 'iu', 'я': 'ia'}
+IN_WORD_1996 = WORD_START
+
+def transliterate(name, in_word):
+    out = []
+    lower = name.lower()
+    for i, ch in enumerate(lower):
+        start = i == 0 or not (lower[i - 1].isalpha() or lower[i - 1] in "'’ʼ")
+        if ch in WORD_START:
+            out.append(WORD_START[ch] if start else in_word[ch])
+        elif ch == 'г' and i > 0 and lower[i - 1] == 'з':
+            out.append('gh')
+        else:
+            out.append(BASE_LATIN.get(ch, ch))
+    return "".join(out)
+
+# Сравнение без учёта разночтений y/i и удвоенных букв (Kamyanets / Kamianets, Podilskyy / Podilskyi)
+def latin_key(text):
+    text = re.sub(r"[^a-z]", "", text.lower()).replace("y", "i")
+    return re.sub(r"(.)\1+", r"\1", text)
+
+# Грубая латинская запись кириллицы (украинские и русские буквы): близкие по звучанию буквы совпадают,
+# чтобы Харків и Харьков, Одеса и Одесса отличались на одну-две буквы
+SKELETON = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'h', 'ґ': 'g', 'д': 'd', 'е': 'e', 'є': 'e', 'э': 'e', 'ё': 'e',
+    'ж': 'zh', 'з': 'z', 'и': 'i', 'і': 'i', 'ї': 'i', 'ы': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm',
+    'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts',
+    'ч': 'ch', 'ш': 'sh', 'щ': 'sh', 'ю': 'iu', 'я': 'ia', 'ь': '', 'ъ': ''
+}
+
+def skeleton(text):
+    text = "".join(SKELETON.get(ch, ch) for ch in text.lower() if ch.isalpha() or ch == " ")
+    return re.sub(r"(.)\1+", r"\1", text)
+
+def distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+# Окончания косвенных падежей: GeoNames хранит и такие формы (Киеву, Киевом, Одессе)
+CASE_ENDINGS = ("ом", "ем", "ой", "ей", "ою", "ею", "у", "ю", "е", "і", "и")
+
+UKRAINIAN_LETTERS = re.compile("[іїєґІЇЄҐ]")
+
+# Варианты написания, пригодные для поиска: тот же населённый пункт в другом языке или написании
+# (Харьков, Одесса) и прежние официальные названия (Кіровоград, Днепропетровск), а не прозвища
+# (Столица Юмора), пометки (Киев ош) и падежные формы (Киеву, Киевом).
+# Вариант должен состоять из стольких же слов, что и название, и отличаться от него не больше чем
+# на половину букв в грубой латинской записи. Прежнее название так не проверить, поэтому далёкий
+# вариант оставляем, только если GeoNames знает его и по-украински, и по-русски (Кіровоград
+# и Кировоград) — у прозвищ и случайных записей такой пары обычно нет. Формы, получающиеся
+# из другого варианта падежным окончанием, и обрезанные варианты (Одесс) отбрасываются
+def plausible_aliases(name, aliases):
+    target = skeleton(name)
+    words = len(name.split())
+    kept = []
+    distant = []
+    for alias in aliases:
+        if len(alias.split()) != words or alias.lower() == name.lower():
+            continue
+        if distance(skeleton(alias), target) <= max(1, len(target) // 2):
+            kept.append(alias)
+        else:
+            distant.append(alias)
+    for alias in distant:
+        key = skeleton(alias)
+        ukrainian = bool(UKRAINIAN_LETTERS.search(alias))
+        if any(
+            other != alias and bool(UKRAINIAN_LETTERS.search(other)) != ukrainian
+            and distance(skeleton(other), key) <= max(1, len(key) // 4)
+            for other in distant
+        ):
+            kept.append(alias)
+    forms = {alias.lower() for alias in kept} | {name.lower()}
+
+    def derived(alias):
+        lower = alias.lower()
+        for ending in CASE_ENDINGS:
+            if lower.endswith(ending):
+                stem = lower[:-len(ending)]
+                if stem in forms or any(stem + other in forms for other in ("а", "я", "о") if stem + other != lower):
+                    return True
+        return any(other != lower and other.startswith(lower) and len(other) - len(lower) <= 2 for other in forms)
+
+    return [alias for alias in kept if not derived(alias)]
+
+# Украинское название из вариантов GeoNames: тот вариант, транслитерация которого совпадает с основным
+# (латинским) названием. Если таких несколько, предпочитаем точное совпадение транслитерации,
+# затем украинские буквы и мягкий знак (-ець, -ськ)
+def pick_ukrainian_name(record):
+    target = latin_key(record["name"])
+    exact = re.sub(r"[^a-z]", "", record["name"].lower())
+    candidates = {}
+    for alt in record.get("alternatenames", []):
+        if not CYRILLIC_NAME.match(alt) or RUSSIAN_ONLY.search(alt):
+            continue
+        variants = [re.sub(r"[^a-z]", "", transliterate(alt, in_word)) for in_word in (IN_WORD_2010, IN_WORD_1996)]
+        if any(latin_key(variant) == target for variant in variants):
+            candidates[alt] = exact in variants
+    if not candidates:
+        return None
+    return max(sorted(candidates), key=lambda alt: (
+        candidates[alt], len(re.findall("[іїєґІЇЄҐ]", alt)), alt.count("ь")
+    ))
+
+# Расстояние в километрах между пунктами GeoNames (для нескольких километров хватает плоской аппроксимации)
+def km_between(a, b):
+    dy = (a["latitude"] - b["latitude"]) * 111.2
+    dx = (a["longitude"] - b["longitude"]) * 111.2 * math.cos(math.radians(a["latitude"]))
+    return math.hypot(dx, dy)
+
+# Названия районов в форме прилагательного: Центральний, Кальміуський, Лівобережний, Східні квартали
+DISTRICT_NAME = re.compile(r"(ськ|цьк|зьк|н)ий$|масив|квартал|^Соцмісто$", re.IGNORECASE)
+
+# Местности и районы внутри городов: GeoNames хранит их как отдельные пункты (Салтівка, Сихів, Черемушки),
+# а тип объекта в geonamescache не попадает. Считаем районом пункт, который лежит в черте города той же
+# области, вдвое большего по населению (радиус черты растёт с населением: ~7 км у миллионника), или
+# крупный пункт с названием района не дальше 10 км от такого города
+def is_city_section(record, name, hosts):
+    for host in hosts:
+        if host["admin1code"] != record["admin1code"] or host["population"] < 2 * record["population"]:
+            continue
+        km = km_between(record, host)
+        if km <= 2.2 * math.sqrt(host["population"] / 100000):
+            return True
+        if km <= 10 and record["population"] >= 40000 and DISTRICT_NAME.search(name):
+            return True
+    return False
+
+def load_geonames():
+    try:
+        import geonamescache
+    except ImportError:
+        sys.exit("Для --geonames нужен пакет geonamescache: pip install geonamescache")
+    cache = geonamescache.GeonamesCache(min_city_population=500)
+    records = sorted(
+        (record for record in cache.get_cities().values() if record["countrycode"] == "UA"),
+        key=lambda record: -record["population"]
+    )
+    settlements = []
+    hosts = []
+    skipped = 0
+    sections = 0
+    for record in records:
+        name = pick_ukrainian_name(record)
+        # Районы внутри городов GeoNames хранит как отдельные пункты — они не нужны
+        if name is None or "район" in name.lower():
+            skipped += 1
+            continue
+        region = GEONAMES_REGIONS.get(record["admin1code"], "")
+        # Города со специальным статусом в GeoNames — отдельная область, и все пункты в ней,
+        # кроме самого города, — его местности (Оболонь, Печерськ, Старе місто)
+        if region.startswith("м. ") and name != region[3:] or is_city_section(record, name, hosts):
+            sections += 1
+            continue
+        if record["population"] >= 100000:
+            hosts.append(record)
+        # Латинские варианты бот получает сам транслитерацией, поэтому из них храним только основной
+        aliases = [record["name"]] + plausible_aliases(name, [
+            alt for alt in record.get("alternatenames", [])
+            if alt != name and CYRILLIC_NAME.match(alt)
+        ])
+        settlements.append({
+            "name": name,
+            "region": region,
+            "population": record["population"],
+            "aliases": aliases
+        })
+    print(
+        f"GeoNames: {len(settlements)} пунктов, пропущено {skipped} без надёжного украинского названия "
+        f"и {sections} районов городов", file=sys.stderr
+    )
+    return settlements
+
+# Разбор CSV КАТОТТГ: столбцы ищутся по заголовкам, разделитель определяется автоматически
+def load_katottg(path):
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        sample = f.read(8192)
+        f.seek(0)
+        dialect = csv.Sniffer().sniff(sample, delimiters=";,\t")
+        rows = list(csv.reader(f, dialect))
+    header = [cell.strip().lower() for cell in rows[0]]
+
+    def column(*words):
+        for i, cell in enumerate(header):
+            if all(word in cell for word in words):
+                return i
+        sys.exit(f"В {path} не найден столбец {' '.join(words)}")
+
+    first_level = column("перший")
+    category = column("категорія")
+    name_column = column("назва")
+
+    regions = {}
+    settlements = []
+    for row in rows[1:]:
+        if len(row) <= max(first_level, category, name_column):
+            continue
+        kind = row[category].strip().upper()
+        name = row[name_column].strip()
+        if kind == "O":
+            regions[row[first_level].strip()] = f"{name} обл." if not name.startswith("Автономна") else "АР Крим"
+        elif kind == "K":
+            regions[row[first_level].strip()] = f"м. {name}"
+    for row in rows[1:]:
+        if len(row) <= max(first_level, category, name_column):
+            continue
+        if row[category].strip().upper() not in KATOTTG_SETTLEMENTS:
+            continue
+        name = row[name_column].strip()
+        settlements.append({
+            "name": name[:1].upper() + name[1:],
+            "region": regions.get(row[first_level].strip(), ""),
+            "population": 0,
+            "aliases": []
+        })
+    # Города со специальным статусом (Київ, Севастополь) в КАТОТТГ записаны только строкой K
+    for code, region in regions.items():
+        if region.startswith("м. "):
+            settlements.append({"name": region[3:], "region": region, "population": 0, "aliases": []})
+    print(f"КАТОТТГ: {len(settlements)} пунктов", file=sys.stderr)
+    return settlements
+
+# Объединение источников: записи КАТОТТГ дополняются населением и вариантами из GeoNames
+def merge(katottg, geonames):
+    by_key = {}
+    for record in geonames:
+        by_key.setdefault((record["name"].lower(), record["region"]), record)
+    for record in katottg:
+        extra = by_key.pop((record["name"].lower(), record["region"]), None)
+        if extra is not None:
+            record["population"] = extra["population"]
+            record["aliases"] = extra["aliases"]
+    # Пункты GeoNames, которых нет в КАТОТТГ (например, другое написание), не добавляем:
+    # официальный список полнее и точнее
+    return katottg
+
+def write_tsv(settlements, path, sources):
+    unique = {}
+    for record in settlements:
+        # Апостроф в названиях приводится к одному виду, как в запросах к сайту
+        record["name"] = re.sub("[’ʼ`]", "'", record["name"])
+        key = (record["name"], record["region"])
+        if key not in unique or record["population"] > unique[key]["population"]:
+            unique[key] = record
+    ordered = sorted(unique.values(), key=lambda record: (-record["population"], record["name"], record["region"]))
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write(f"# Источники: {', '.join(sources)}\n")
+        f.write("# name\tregion\tpopulation\taliases\n")
+        for record in ordered:
+            aliases = {alias.replace("\t", " ").replace("|", " ") for alias in record["aliases"]}
+            aliases = sorted(alias for alias in aliases if alias.lower() != record["name"].lower())
+            f.write(f"{record['name']}\t{record['region']}\t{record['population']}\t{'|'.join(aliases)}\n")
+    print(f"Записано {len(ordered)} пунктов в {path}", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="Сборка списка населённых пунктов Украины")
+    parser.add_argument("--katottg", help="CSV-выгрузка КАТОТТГ")
+    parser.add_argument("--geonames", action="store_true", help="использовать GeoNames (пакет geonamescache)")
+    parser.add_argument("-o", "--output", default="ua_settlements.tsv", help="итоговый файл")
+    args = parser.parse_args()
+    if not args.katottg and not args.geonames:
+        parser.error("укажите --katottg и/или --geonames")
+
+    geonames = load_geonames() if args.geonames else []
+    if args.katottg:
+        settlements = merge(load_katottg(args.katottg), geonames)
+    else:
+        settlements = geonames
+    sources = []
+    if args.katottg:
+        sources.append("КАТОТТГ (Мінрегіон України)")
+    if args.geonames:
+        sources.append("GeoNames (geonames.org, CC BY 4.0)")
+    write_tsv(settlements, args.output, sources)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,802 @@
+#!/usr/bin/env python3
+# Офлайн-бенчмарк полной проверки "Де ліки Bot"
+#
+# Поднимает локальные заглушки tabletki.ua и Telegram Bot API, генерирует наборы
+# отслеживания заданного размера и измеряет полную проверку (run_sweep):
+# время, запросы в секунду, время разбора страницы, пиковый RSS и число сообщений.
+# Сценарий webhook измеряет задержку и пропускную способность приёма обновлений.
+# Сценарий handlers имитирует тысячи пользователей, проходящих обычные сценарии в боте (меню, поиск,
+# выбор города, удаление), и измеряет задержку обработчиков, задержку цикла событий и пропускную способность.
+# Сценарий parsers проверяет, что все доступные бэкенды разбора дают на страницах (сохранённых или
+# сгенерированных с разными вариантами разметки) тот же результат, что исходный разбор BeautifulSoup.
+#
+# Пример:
+#   python3 meds_bench.py --sizes 1000,10000 --json result.json
+#   python3 meds_bench.py --sizes 1000,10000 --compare result.json
+#   python3 meds_bench.py --pages ./saved_pages   # сохранённые страницы tabletki.ua (*.html)
+#   python3 meds_bench.py --result-pages 3   # результаты поиска на нескольких страницах
+#   python3 meds_bench.py --sweeps 2 --change-ratio 0.1   # повторная проверка, изменилась десятая часть страниц
+#   python3 meds_bench.py --scenario webhook --updates 5000   # приём обновлений через вебхук
+#   python3 meds_bench.py --scenario handlers --users 2000 --active 500   # нагрузка на обработчики
+#   python3 meds_bench.py --scenario parsers --pages ./saved_pages   # совпадение результатов разбора
+import argparse
+import asyncio
+import glob
+import gzip
+import json
+import logging
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+# Доля запросов, на которые заглушка отвечает страницей "ничего не найдено"
+EMPTY_RATIO = 0.2
+
+# Генерация страницы поиска в разметке tabletki.ua (используется, если сохранённых страниц нет).
+# next_page — ссылка на следующую страницу результатов, если она есть; revision — версия страницы
+# (другие цены и аптеки при том же запросе)
+def generate_search_page(seed, products=30, next_page=None, revision=0):
+    rnd = random.Random(f"{seed}:{revision}" if revision else seed)
+    if rnd.random() < EMPTY_RATIO:
+        return "<html><body><div class=\"search-result-empty\">Нічого не знайдено</div></body></html>"
+    items = []
+    for i in range(products):
+        items.append(
+            f'<div class="search-result-item" data-id="{seed}-{i}">'
+            f'<a href="/uk/{seed}/{i}/"><img src="/img/{seed}/{i}.jpg"></a>'
+            f'<h3 class="item-title">Препарат {seed % 997} таб. №{rnd.randint(10, 60)}</h3>'
+            f'<div class="price">{rnd.randint(20, 2000)},{rnd.randint(0, 99):02d} грн</div>'
+            f'<div class="pharmacy-title">Аптека №{rnd.randint(1, 300)}</div>'
+            f'<div class="description">Виробник {rnd.randint(1, 50)}, Україна</div>'
+            f'</div>'
+        )
+    head = "<head><title>Пошук</title>" + "<script>var data = {};</script>" * 20 + "</head>"
+    pagination = f'<div class="pagination"><a rel="next" href="{next_page}">Далі</a></div>' if next_page else ""
+    return f"<html>{head}<body><div class=\"search-results\">{''.join(items)}</div>{pagination}</body></html>"
+
+# Локальная заглушка tabletki.ua
+# Как настоящий сайт, заглушка сжимает ответы (gzip) и отдаёт ETag, отвечая 304 на условные запросы.
+# validators=False — без ETag: бот может узнать неизменную страницу только по содержимому
+class TabletkiStub:
+    def __init__(self, pages_dir=None, result_pages=1, validators=True):
+        self.result_pages = result_pages
+        self.validators = validators
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self.pages = []
+        if pages_dir:
+            for path in sorted(glob.glob(os.path.join(pages_dir, "*.html"))):
+                with open(path, "r", encoding="utf-8") as f:
+                    self.pages.append(f.read().encode("utf-8"))
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._gzipped = {}
+        self._revisions = {}
+
+    # Между проверками: доля change_ratio уже запрошенных страниц меняет содержимое
+    def advance(self, change_ratio, rnd):
+        for path in self._revisions:
+            if rnd.random() < change_ratio:
+                self._revisions[path] += 1
+
+    def page_for(self, path):
+        base, _, page = path.partition("&page=")
+        page = int(page or 1)
+        seed = zlib.crc32(path.encode("utf-8")) % 100000
+        revision = self._revisions.setdefault(path, 0)
+        if self.pages:
+            return self.pages[seed % len(self.pages)]
+        body = self._cache.get((seed, revision))
+        if body is None:
+            # У каждого запроса своё число страниц результатов, от 1 до result_pages
+            pages = 1 + zlib.crc32(base.encode("utf-8")) % self.result_pages
+            next_page = f"{base}&page={page + 1}" if page < pages else None
+            body = generate_search_page(seed, next_page=next_page, revision=revision).encode("utf-8")
+            self._cache[(seed, revision)] = body
+        return body
+
+    def gzipped(self, body, etag):
+        compressed = self._gzipped.get(etag)
+        if compressed is None:
+            compressed = self._gzipped[etag] = gzip.compress(body, compresslevel=6)
+        return compressed
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                body = stub.page_for(self.path)
+                etag = f'"{zlib.crc32(body):08x}-{len(body)}"'
+                if stub.validators and self.headers.get("If-None-Match") == etag:
+                    with stub._lock:
+                        stub.requests += 1
+                        stub.not_modified += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                encoding = None
+                if "gzip" in self.headers.get("Accept-Encoding", ""):
+                    body = stub.gzipped(body, etag)
+                    encoding = "gzip"
+                with stub._lock:
+                    stub.requests += 1
+                    stub.bytes_sent += len(body)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                if encoding:
+                    self.send_header("Content-Encoding", encoding)
+                if stub.validators:
+                    self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+# Страница, где карточки размечены по-разному: у поля есть разные подмножества селекторов (с разным
+# текстом) и атрибуты data-*, поэтому результат зависит от порядка, в котором пробуются селекторы
+def generate_mixed_page(seed, products=40):
+    rnd = random.Random(seed)
+    fields = [
+        ("name", ['item-title', 'product-name', 'title', None, None, 'name'], ['data-name', 'title']),
+        ("price", ['price', 'cost', 'product-price', 'money'], ['data-price']),
+        ("pharmacy", ['pharmacy-title', 'store-name', 'pharmacy-name', 'pharmacy', 'store'], ['data-pharmacy', 'data-store']),
+        ("info", ['description', 'product-desc', 'details', 'info'], [])
+    ]
+    cards = []
+    for i in range(products):
+        attrs = [f'data-id="{seed}-{i}"']
+        inner = []
+        for field, classes, field_attrs in fields:
+            for position, css_class in enumerate(classes):
+                if rnd.random() < 0.35:
+                    text = f"{field} {position} #{rnd.randint(1, 999)}"
+                    # None — селекторы по тегу (h3, h2) без класса
+                    inner.append(f'<h{3 - position % 2}>{text}</h{3 - position % 2}>' if css_class is None
+                                 else f'<div class="{css_class}">{text}</div>')
+            for attr in field_attrs:
+                if rnd.random() < 0.3:
+                    attrs.append(f'{attr}="{field} {attr} {rnd.randint(1, 99)}"')
+        if rnd.random() < 0.7:
+            inner.append(f'<a href="/uk/{seed}/{i}/"><img src="/img/{seed}/{i}.jpg"></a>')
+        card_class = rnd.choice(['search-result-item', 'product-item', 'search-result-item'])
+        cards.append(f'<div class="{card_class}" {" ".join(attrs)}>{"".join(inner)}</div>')
+    return f"<html><body><div class=\"search-results\">{''.join(cards)}</div></body></html>"
+
+# Исходный разбор страницы (BeautifulSoup, html.parser, селекторы строго по порядку) — эталон для
+# сценария parsers
+def reference_parse(meds_bot, html, city_name):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    for selector in meds_bot.NO_RESULTS_SELECTORS:
+        if soup.select(selector):
+            return []
+
+    def first(node, selectors):
+        for selector in selectors:
+            found = node.select_one(selector)
+            if found:
+                return found
+        return None
+
+    products = []
+    for selector in meds_bot.PRODUCT_SELECTORS:
+        products = soup.select(selector)
+        if products:
+            break
+    if not products:
+        products = soup.find_all('div', class_=lambda c: c and ('item' in c or 'product' in c or 'result' in c))
+        if not products:
+            products = soup.find_all(['div', 'li'], attrs={'data-id': True})
+    results = []
+    for product in products:
+        name = first(product, meds_bot.NAME_SELECTORS) or product.get('data-name') or product.get('title')
+        price = first(product, meds_bot.PRICE_SELECTORS) or product.get('data-price')
+        pharmacy = first(product, meds_bot.PHARMACY_SELECTORS) or product.get('data-pharmacy') or product.get('data-store')
+        info = first(product, meds_bot.INFO_SELECTORS)
+        img = product.select_one('img')
+        link = product.select_one('a')
+        link = link.get('href') if link else ""
+        if link and not link.startswith('http'):
+            link = f"{meds_bot.TABLETKI_BASE_URL}{link}"
+        results.append({
+            "name": name.text.strip() if hasattr(name, 'text') else name or "Без назви",
+            "price": price.text.strip() if hasattr(price, 'text') else price or "Ціна невідома",
+            "pharmacy": pharmacy.text.strip() if hasattr(pharmacy, 'text') else pharmacy or "Аптека невідома",
+            "info": info.text.strip() if info else "",
+            "img_url": img.get('src') if img else "",
+            "link": link,
+            "city": city_name
+        })
+    return results
+
+# Сценарий parsers: каждая страница разбирается всеми доступными бэкендами, в том числе по нескольку
+# раз подряд и вперемешку с другими страницами, и сравнивается с эталоном
+def run_parsers_scenario(meds_bot, args):
+    pages = []
+    if args.pages:
+        for path in sorted(glob.glob(os.path.join(args.pages, "*.html"))):
+            with open(path, "r", encoding="utf-8") as f:
+                pages.append((os.path.basename(path), f.read()))
+    else:
+        pages = [(f"generated-{seed}", generate_search_page(seed)) for seed in range(20)]
+        pages += [(f"mixed-{seed}", generate_mixed_page(seed)) for seed in range(50)]
+    backends = []
+    if meds_bot.LexborHTMLParser is not None:
+        backends.append(meds_bot.SelectolaxBackend())
+    if meds_bot.HAS_LXML:
+        backends.append(meds_bot.SoupBackend("lxml"))
+    backends.append(meds_bot.SoupBackend("html.parser"))
+    expected = {name: reference_parse(meds_bot, html, "Київ") for name, html in pages}
+    mismatches = 0
+    result = {"pages": len(pages), "cards": sum(len(value) for value in expected.values()), "backends": {}}
+    for backend in backends:
+        meds_bot._parser_backend = backend
+        failed = []
+        for _ in range(2):
+            for name, html in pages:
+                if meds_bot.parse_search_results(html, "Препарат", "Київ") != expected[name]:
+                    failed.append(name)
+        result["backends"][backend.name] = sorted(set(failed))
+        mismatches += len(failed)
+        print(f"{backend.name}\t{'OK' if not failed else 'MISMATCH: ' + ', '.join(sorted(set(failed)))}")
+    meds_bot._parser_backend = None
+    result["mismatches"] = mismatches
+    return result
+
+# Локальная заглушка Telegram Bot API: отвечает на getMe и sendMessage/editMessageText
+class BotApiStub:
+    def __init__(self):
+        self.messages = 0
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                method = self.path.rstrip("/").rsplit("/", 1)[-1]
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length).decode("utf-8") if length else ""
+                params = stub.parse_params(raw, self.headers.get("Content-Type", ""))
+                with stub._lock:
+                    stub.calls[method] = stub.calls.get(method, 0) + 1
+                    if method in ("sendMessage", "editMessageText"):
+                        stub.messages += 1
+                    message_id = sum(stub.calls.values())
+                body = json.dumps({"ok": True, "result": stub.result(method, params, message_id)}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    @staticmethod
+    def parse_params(raw, content_type):
+        if not raw:
+            return {}
+        if "json" in content_type:
+            return json.loads(raw)
+        return {key: values[0] for key, values in parse_qs(raw).items()}
+
+    @staticmethod
+    def result(method, params, message_id):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id") or 0)
+            return {
+                "message_id": int(params.get("message_id") or message_id),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", "")
+            }
+        return True
+
+def start_server(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Временный каталог с конфигом без лимитов частоты: измеряем сам бот, а не паузы
+def prepare_environment(args):
+    workdir = tempfile.mkdtemp(prefix="de_liky_bench_")
+    bench_config = {
+        "token": "123456:BENCH",
+        "http_max_concurrency": args.concurrency,
+        "http_max_connections": args.concurrency,
+        "http_requests_per_second": 1000000,
+        "scheduler_max_concurrency": args.concurrency,
+        "telegram_messages_per_second": 1000000,
+        "telegram_chat_messages_per_second": 1000000,
+        "notification_workers": args.concurrency,
+        # Сообщения чата объединяются до конца проверки, как в бою
+        "notification_batch_seconds": 3600
+    }
+    if args.parser:
+        bench_config["html_parser"] = args.parser
+    if args.workers:
+        bench_config["workers"] = args.workers
+    config_path = os.path.join(workdir, "config.json")
+    with open(config_path, "w", encoding="utf-8") as f:
+        json.dump(bench_config, f)
+    os.environ["DE_LIKY_BOT_CONFIG"] = config_path
+    return workdir
+
+# Набор отслеживания: популярность препаратов по закону Ципфа, как у реальных пользователей
+def generate_tracking(meds_bot, size, seed=42):
+    rnd = random.Random(seed)
+    drugs = [f"Препарат {i}" for i in range(max(50, size // 20))]
+    weights = [1 / (rank + 1) for rank in range(len(drugs))]
+    cities = meds_bot.UKRAINE_CITIES
+    chats = max(1, size // 3)
+    storage = meds_bot.storage
+    storage.conn.execute("DELETE FROM tracking")
+    storage.conn.execute("DELETE FROM snapshots")
+    storage.conn.execute("BEGIN")
+    added = 0
+    while added < size:
+        drug = rnd.choices(drugs, weights)[0]
+        city = cities[min(int(rnd.expovariate(0.3)), len(cities) - 1)]
+        if storage.add_tracking(rnd.randrange(chats) + 1, drug, city):
+            added += 1
+    storage.conn.execute("COMMIT")
+    # Запись шла в обход очереди команд — снимок состояния нужно перечитать
+    meds_bot.tracking_state.reload()
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# Полная проверка набора отслеживания заданного размера. При sweeps > 1 проверка повторяется (между
+# повторами доля change_ratio страниц сайта меняется), а результаты относятся к последнему повтору
+async def run_scenario(meds_bot, bot, tabletki, bot_api, size, sweeps=1, change_ratio=0.0):
+    generate_tracking(meds_bot, size)
+    meds_bot.page_cache._entries.clear()
+    for sweep in range(sweeps - 1):
+        meds_bot.search_cache._entries.clear()
+        await meds_bot.run_sweep(bot)
+        tabletki.advance(change_ratio, random.Random(sweep))
+    meds_bot.search_cache._entries.clear()
+
+    # Замеряем время разбора, оборачивая функцию разбора модуля
+    parse_stats = {"pages": 0, "seconds": 0.0}
+    original_parse = meds_bot.parse_search_page
+
+    def timed_parse(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return original_parse(*args, **kwargs)
+        finally:
+            parse_stats["pages"] += 1
+            parse_stats["seconds"] += time.perf_counter() - started
+
+    meds_bot.parse_search_page = timed_parse
+    # В режиме рабочих процессов разбор идёт вне этого процесса: время берём из метрики, которую они передают
+    parse_before = dict(meds_bot.PARSE_SECONDS.values.get((), {"sum": 0.0, "count": 0}))
+    requests_before = tabletki.requests
+    not_modified_before = tabletki.not_modified
+    bytes_before = tabletki.bytes_sent
+    messages_before = bot_api.messages
+    dispatcher = meds_bot.NotificationDispatcher(bot)
+    meds_bot.notification_dispatcher = dispatcher
+    dispatcher_task = asyncio.create_task(dispatcher.run())
+    try:
+        started = time.perf_counter()
+        stats = await meds_bot.run_sweep(bot)
+        sweep_seconds = time.perf_counter() - started
+        await dispatcher.drain(timeout=3600)
+        total_seconds = time.perf_counter() - started
+    finally:
+        dispatcher_task.cancel()
+        await asyncio.gather(dispatcher_task, return_exceptions=True)
+        meds_bot.parse_search_page = original_parse
+        meds_bot.notification_dispatcher = None
+
+    requests = tabletki.requests - requests_before
+    if meds_bot.worker_pool is not None:
+        parse_after = meds_bot.PARSE_SECONDS.values.get((), {"sum": 0.0, "count": 0})
+        parse_stats = {"pages": parse_after["count"] - parse_before["count"], "seconds": parse_after["sum"] - parse_before["sum"]}
+    return {
+        "size": size,
+        "jobs": stats["jobs"],
+        "fetches_saved": stats["fetches_saved"],
+        "sweep_seconds": round(sweep_seconds, 3),
+        "total_seconds": round(total_seconds, 3),
+        "requests": requests,
+        "requests_per_second": round(requests / sweep_seconds, 1) if sweep_seconds else 0.0,
+        "parse_ms_per_page": round(parse_stats["seconds"] / parse_stats["pages"] * 1000, 3) if parse_stats["pages"] else 0.0,
+        "pages_parsed": parse_stats["pages"],
+        "not_modified": tabletki.not_modified - not_modified_before,
+        "kb_received": round((tabletki.bytes_sent - bytes_before) / 1024, 1),
+        "messages_sent": bot_api.messages - messages_before,
+        "peak_rss_mb": round(peak_rss_mb(), 1)
+    }
+
+# Входящие обновления для сценария вебхука: команды и кнопки меню от разных чатов
+WEBHOOK_TEXTS = ["/start", "📋 Список відстежуваних", "⚙️ Налаштування"]
+
+def make_update(update_id, chats):
+    chat_id = update_id % chats + 1
+    text = WEBHOOK_TEXTS[update_id % len(WEBHOOK_TEXTS)]
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+        "text": text
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"update_id": update_id, "message": message}
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+# Сценарий вебхука: бот поднимает свой HTTP-сервер, а бенчмарк, как Telegram, отправляет ему
+# обновления POST-запросами с заданным числом одновременных соединений. Задержка — от отправки
+# обновления до начала его обработки; пропускная способность — приём и полная обработка
+async def run_webhook_scenario(meds_bot, bot_api_server, bot_api, args):
+    import httpx
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    generate_tracking(meds_bot, 1000)
+    app = meds_bot.build_application(base_url=f"http://127.0.0.1:{bot_api_server.server_port}/bot")
+    received = {}
+
+    async def probe(update, context):
+        received[update.update_id] = time.perf_counter()
+
+    app.add_handler(TypeHandler(Update, probe), group=-1)
+    port = free_port()
+    secret = "bench-secret"
+    url = f"http://127.0.0.1:{port}/telegram"
+    await app.initialize()
+    await app.start()
+    await app.updater.start_webhook(
+        listen="127.0.0.1", port=port, url_path="telegram", webhook_url=url, secret_token=secret
+    )
+    messages_before = bot_api.messages
+    sent = {}
+    semaphore = asyncio.Semaphore(args.webhook_connections)
+    limits = httpx.Limits(max_connections=args.webhook_connections)
+    try:
+        async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+            wrong_secret = await client.post(url, json=make_update(0, 1), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+
+            async def post(update_id):
+                async with semaphore:
+                    sent[update_id] = time.perf_counter()
+                    response = await client.post(
+                        url, json=make_update(update_id, args.chats),
+                        headers={"X-Telegram-Bot-Api-Secret-Token": secret}
+                    )
+                    response.raise_for_status()
+
+            started = time.perf_counter()
+            await asyncio.gather(*(post(update_id) for update_id in range(1, args.updates + 1)))
+            intake_seconds = time.perf_counter() - started
+            await app.update_queue.join()
+            total_seconds = time.perf_counter() - started
+    finally:
+        await app.updater.stop()
+        await app.stop()
+        await app.shutdown()
+
+    latencies = [(received[update_id] - sent[update_id]) * 1000 for update_id in sent if update_id in received]
+    return {
+        "scenario": "webhook",
+        "updates": args.updates,
+        "connections": args.webhook_connections,
+        "handled": len(latencies),
+        "wrong_secret_status": wrong_secret.status_code,
+        "intake_per_second": round(args.updates / intake_seconds, 1),
+        "processed_per_second": round(args.updates / total_seconds, 1),
+        "latency_p50_ms": round(percentile(latencies, 0.5), 2),
+        "latency_p95_ms": round(percentile(latencies, 0.95), 2),
+        "latency_p99_ms": round(percentile(latencies, 0.99), 2),
+        "messages_sent": bot_api.messages - messages_before,
+        "peak_rss_mb": round(peak_rss_mb(), 1)
+    }
+
+# Сессия пользователя в сценарии handlers: шаги (вид действия, текст или данные кнопки).
+# Город выбирается кнопкой из результатов поиска по индексу городов, как в боте
+def make_session(rnd, city_ids):
+    drug = f"Препарат {int(rnd.paretovariate(1.2)) % 997}"
+    city_pattern, city_id = rnd.choice(city_ids)
+    steps = [
+        ("start", "/start"),
+        ("menu", "🔎 Додати препарат для відстеження"),
+        ("search", drug),
+        # id варианта становится известен только во время сессии, см. run_user
+        ("pick_drug", "drug:"),
+        ("city_search", city_pattern),
+        ("pick_city", f"select_city:{city_id}"),
+        ("list", "📋 Список відстежуваних")
+    ]
+    if rnd.random() < 0.3:
+        steps.append(("settings", "⚙️ Налаштування"))
+    if rnd.random() < 0.2:
+        steps.append(("check", "🔎 Перевірити зараз"))
+    if rnd.random() < 0.5:
+        # id записи становится известен только во время сессии, см. run_user
+        steps.append(("remove", "untrack:"))
+    return steps
+
+def make_session_update(update_id, chat_id, kind, payload):
+    user = {"id": chat_id, "is_bot": False, "first_name": "Load"}
+    chat = {"id": chat_id, "type": "private"}
+    if payload.startswith(("drug:", "city:", "select_", "untrack:", "interval:")):
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": user, "chat_instance": str(chat_id), "data": payload,
+            "message": {"message_id": update_id, "date": int(time.time()), "chat": chat, "text": "…"}
+        }}
+    message = {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": user, "text": payload}
+    if payload.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(payload)}]
+    return {"update_id": update_id, "message": message}
+
+# Задержка цикла событий: насколько позже запланированного просыпается короткий sleep
+async def monitor_loop_lag(lags, interval=0.01):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append((time.perf_counter() - started - interval) * 1000)
+
+# Сценарий handlers: обновления подаются прямо в очередь Application (как после getUpdates/вебхука).
+# Каждый пользователь проходит свою сессию шаг за шагом, дожидаясь обработки предыдущего шага;
+# одновременно активны не больше --active пользователей. Задержка шага — от постановки обновления
+# в очередь до завершения всех его обработчиков
+async def run_handlers_scenario(meds_bot, bot_api_server, bot_api, tabletki, args):
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    generate_tracking(meds_bot, 1000)
+    meds_bot.search_cache._entries.clear()
+    app = meds_bot.build_application(base_url=f"http://127.0.0.1:{bot_api_server.server_port}/bot")
+    waiters = {}
+
+    async def finished(update, context):
+        waiter = waiters.pop(update.update_id, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(time.perf_counter())
+
+    # Последняя группа: выполняется после обработчиков бота
+    app.add_handler(TypeHandler(Update, finished), group=100)
+    rnd = random.Random(7)
+    city_ids = []
+    for city in meds_bot.UKRAINE_CITIES:
+        found = meds_bot.search_cities(city[:4])
+        if found:
+            city_ids.append((city[:4], found[0]["id"]))
+    sessions = [make_session(rnd, city_ids) for _ in range(args.users)]
+    update_ids = iter(range(1, 10 ** 9))
+    latencies = {}
+    lags = []
+    semaphore = asyncio.Semaphore(args.active)
+
+    async def run_user(user_index, steps):
+        chat_id = 1000000 + user_index
+        async with semaphore:
+            for kind, payload in steps:
+                if kind == "pick_drug":
+                    session = meds_bot.sessions._sessions.get(chat_id)
+                    payload += next(iter(session.choices), "0") if session is not None else "0"
+                if kind == "remove":
+                    entries = meds_bot.tracking_state.snapshot.entries(chat_id)
+                    payload += str(entries[0].id if entries else 0)
+                update_id = next(update_ids)
+                update = Update.de_json(make_session_update(update_id, chat_id, kind, payload), app.bot)
+                waiter = waiters[update_id] = asyncio.get_running_loop().create_future()
+                started = time.perf_counter()
+                await app.update_queue.put(update)
+                latencies.setdefault(kind, []).append((await waiter - started) * 1000)
+                if args.think:
+                    await asyncio.sleep(rnd.uniform(0, 2 * args.think))
+
+    await app.initialize()
+    await app.start()
+    monitor = asyncio.create_task(monitor_loop_lag(lags))
+    messages_before = bot_api.messages
+    requests_before = tabletki.requests
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(run_user(index, steps) for index, steps in enumerate(sessions)))
+        total_seconds = time.perf_counter() - started
+    finally:
+        monitor.cancel()
+        await asyncio.gather(monitor, return_exceptions=True)
+        await app.stop()
+        await app.shutdown()
+
+    everything = [value for values in latencies.values() for value in values]
+    result = {
+        "scenario": "handlers",
+        "users": args.users,
+        "active": args.active,
+        "concurrent_updates": meds_bot.config.get("concurrent_updates", 32),
+        "updates": len(everything),
+        "seconds": round(total_seconds, 2),
+        "updates_per_second": round(len(everything) / total_seconds, 1),
+        "sessions_per_second": round(args.users / total_seconds, 1),
+        "latency_p50_ms": round(percentile(everything, 0.5), 2),
+        "latency_p95_ms": round(percentile(everything, 0.95), 2),
+        "latency_p99_ms": round(percentile(everything, 0.99), 2),
+        "loop_lag_p50_ms": round(percentile(lags, 0.5), 2),
+        "loop_lag_p99_ms": round(percentile(lags, 0.99), 2),
+        "loop_lag_max_ms": round(max(lags, default=0.0), 2),
+        "site_requests": tabletki.requests - requests_before,
+        "messages_sent": bot_api.messages - messages_before,
+        "peak_rss_mb": round(peak_rss_mb(), 1)
+    }
+    result["by_action"] = {
+        kind: {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 0.5), 2),
+            "p95_ms": round(percentile(values, 0.95), 2),
+            "p99_ms": round(percentile(values, 0.99), 2)
+        }
+        for kind, values in sorted(latencies.items())
+    }
+    return result
+
+def print_handler_results(result):
+    for key, value in result.items():
+        if key != "by_action":
+            print(f"{key}\t{value}")
+    print()
+    print("action\tcount\tp50_ms\tp95_ms\tp99_ms")
+    for kind, stats in result["by_action"].items():
+        print(f"{kind}\t{stats['count']}\t{stats['p50_ms']}\t{stats['p95_ms']}\t{stats['p99_ms']}")
+
+def print_results(results, previous=None):
+    columns = [
+        "size", "jobs", "sweep_seconds", "total_seconds", "requests_per_second",
+        "parse_ms_per_page", "pages_parsed", "kb_received", "messages_sent", "peak_rss_mb"
+    ]
+    print("\t".join(columns))
+    for result in results:
+        print("\t".join(str(result[column]) for column in columns))
+        base = (previous or {}).get(str(result["size"]))
+        if base:
+            deltas = []
+            for column in columns[2:]:
+                if base.get(column):
+                    deltas.append(f"{column} {100 * (result[column] - base[column]) / base[column]:+.1f}%")
+            print("  vs previous: " + ", ".join(deltas))
+
+async def main_async(args):
+    workdir = prepare_environment(args)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import meds_bot
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+
+    if args.scenario == "parsers":
+        result = run_parsers_scenario(meds_bot, args)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump({"created": time.time(), "workdir": workdir, "results": [result]}, f, ensure_ascii=False, indent=2)
+        if result["mismatches"]:
+            sys.exit(1)
+        return
+
+    meds_bot.init_storage()
+    # В боте каталог загружается в фоне при запуске; здесь — сразу, до проверок
+    meds_bot.drug_catalog.load()
+    tabletki = TabletkiStub(args.pages, args.result_pages, validators=not args.no_etag)
+    bot_api = BotApiStub()
+    tabletki_server = start_server(tabletki.handler())
+    bot_api_server = start_server(bot_api.handler())
+    meds_bot.TABLETKI_BASE_URL = f"http://127.0.0.1:{tabletki_server.server_port}"
+
+    bot = Bot(
+        meds_bot.config["token"],
+        base_url=f"http://127.0.0.1:{bot_api_server.server_port}/bot",
+        request=HTTPXRequest(connection_pool_size=args.concurrency)
+    )
+    await bot.initialize()
+    if args.workers:
+        meds_bot.worker_pool = meds_bot.WorkerPool(args.workers)
+        meds_bot.worker_pool.start()
+    results = []
+    try:
+        if args.scenario == "webhook":
+            result = await run_webhook_scenario(meds_bot, bot_api_server, bot_api, args)
+            print(json.dumps(result, ensure_ascii=False))
+            if args.json:
+                with open(args.json, "w", encoding="utf-8") as f:
+                    json.dump({"created": time.time(), "workdir": workdir, "results": [result]}, f, ensure_ascii=False, indent=2)
+            return
+        if args.scenario == "handlers":
+            result = await run_handlers_scenario(meds_bot, bot_api_server, bot_api, tabletki, args)
+            print_handler_results(result)
+            if args.json:
+                with open(args.json, "w", encoding="utf-8") as f:
+                    json.dump({"created": time.time(), "workdir": workdir, "results": [result]}, f, ensure_ascii=False, indent=2)
+            return
+        for size in args.sizes:
+            result = await run_scenario(meds_bot, bot, tabletki, bot_api, size, args.sweeps, args.change_ratio)
+            results.append(result)
+            print(json.dumps(result, ensure_ascii=False), file=sys.stderr)
+    finally:
+        if meds_bot.worker_pool is not None:
+            await meds_bot.worker_pool.close()
+        await bot.shutdown()
+        await meds_bot.close_http_client()
+        tabletki_server.shutdown()
+        bot_api_server.shutdown()
+
+    previous = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            previous = {str(item["size"]): item for item in json.load(f)["results"]}
+    print_results(results, previous)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"created": time.time(), "workdir": workdir, "results": results}, f, ensure_ascii=False, indent=2)
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк полной проверки Де ліки Bot")
+    parser.add_argument(
+        "--scenario", choices=["sweep", "webhook", "handlers", "parsers"], default="sweep",
+        help="полная проверка, приём обновлений через вебхук, нагрузка на обработчики или совпадение результатов разбора"
+    )
+    parser.add_argument("--sizes", default="1000,10000,100000", help="размеры наборов отслеживания через запятую")
+    parser.add_argument("--concurrency", type=int, default=16, help="одновременных запросов к заглушке tabletki.ua")
+    parser.add_argument("--workers", type=int, default=0, help="число рабочих процессов проверки (0 — в процессе бота)")
+    parser.add_argument("--parser", default=None, help="html_parser: selectolax, lxml или html.parser")
+    parser.add_argument("--pages", default=None, help="каталог с сохранёнными страницами поиска tabletki.ua (*.html)")
+    parser.add_argument("--result-pages", type=int, default=1, help="до скольких страниц результатов у запроса в заглушке")
+    parser.add_argument("--sweeps", type=int, default=1, help="сколько раз подряд выполнить проверку (результаты — последней)")
+    parser.add_argument("--change-ratio", type=float, default=0.1, help="доля страниц, меняющихся между проверками")
+    parser.add_argument("--no-etag", action="store_true", help="заглушка не отдаёт ETag и не отвечает 304")
+    parser.add_argument("--updates", type=int, default=5000, help="сценарий webhook: число обновлений")
+    parser.add_argument("--chats", type=int, default=500, help="сценарий webhook: число разных чатов")
+    parser.add_argument("--webhook-connections", type=int, default=40, help="сценарий webhook: одновременных POST-запросов (max_connections Telegram)")
+    parser.add_argument("--users", type=int, default=2000, help="сценарий handlers: число пользователей")
+    parser.add_argument("--active", type=int, default=200, help="сценарий handlers: одновременно активных пользователей")
+    parser.add_argument("--think", type=float, default=0.0, help="сценарий handlers: средняя пауза пользователя между шагами, с")
+    parser.add_argument("--json", default=None, help="сохранить результаты в JSON-файл")
+    parser.add_argument("--compare", default=None, help="сравнить с результатами из JSON-файла")
+    args = parser.parse_args()
+    args.sizes = [int(size) for size in args.sizes.split(",") if size]
+
+    logging.getLogger("meds_bot").setLevel(logging.WARNING)
+    asyncio.run(main_async(args))
+
+if __name__ == "__main__":
+    main()
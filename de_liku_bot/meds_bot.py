@@ -1,654 +1,3938 @@
-import json
-import os
-import time
-import threading
-import requests
-import logging
-from bs4 import BeautifulSoup
-from urllib.parse import quote
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
-
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
-
-CONFIG_PATH = "/opt/de_liky_bot/config.json"
-
-# Загрузка конфига
-def load_config():
-    try:
-        if not os.path.exists(CONFIG_PATH):
-            default_config = {"token": "", "cities": [], "drugs": [], "interval_hours": 12, "chat_ids": []}
-            os.makedirs(os.path.dirname(CONFIG_PATH), exist_ok=True)
-            with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-                json.dump(default_config, f, ensure_ascii=False, indent=4)
-            return default_config
-        with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception as e:
-        logger.error(f"Ошибка загрузки конфига: {e}")
-        return {"token": "", "cities": [], "drugs": [], "interval_hours": 12, "chat_ids": []}
-
-# Сохранение конфига
-def save_config(config):
-    try:
-        os.makedirs(os.path.dirname(CONFIG_PATH), exist_ok=True)
-        with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-            json.dump(config, f, ensure_ascii=False, indent=4)
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка сохранения конфига: {e}")
-        return False
-
-config = load_config()
-
-# Приветственное сообщение
-WELCOME_TEXT = """Вітаю! Я — 🤖 *Де ліки Bot*.
-
-Я допоможу вам відстежувати наявність потрібних ліків у вибраних містах України через сервіс [tabletki.ua](https://tabletki.ua).
-
-Що я вмію:
-🔎 Шукати препарати у вашому місті
-➕ Додавати нові міста та ліки для відстеження
-📋 Показувати список відстежуваних препаратів
-🔔 Повідомляти, коли ліки з'являться в аптеках
-⚙️ Налаштовувати інтервал перевірки
-
-*Використовуйте меню або команди для керування ботом.*
-
-_Бажаю здоров'я!_
-"""
-
-# Список основных городов Украины для поиска
-UKRAINE_CITIES = [
-    "Київ", "Харків", "Одеса", "Дніпро", "Донецьк", "Запоріжжя", "Львів", 
-    "Кривий Ріг", "Миколаїв", "Маріуполь", "Луганськ", "Вінниця", 
-    "Херсон", "Полтава", "Чернігів", "Черкаси", "Житомир", "Суми", 
-    "Рівне", "Івано-Франківськ", "Кропивницький", "Тернопіль", "Луцьк", 
-    "Ужгород", "Кам'янець-Подільський", "Мелітополь", "Бердянськ", "Нікополь"
-]
-
-# Команда /start
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        # Добавляем chat_id в список отслеживаемых
-        chat_id = update.effective_chat.id
-        if "chat_ids" not in config:
-            config["chat_ids"] = []
-        if chat_id not in config["chat_ids"]:
-            config["chat_ids"].append(chat_id)
-            save_config(config)
-            
-        keyboard = [
-            ["🔎 Додати препарат для відстеження"],
-            ["📋 Список відстежуваних", "🔎 Перевірити зараз"],
-            ["⚙️ Налаштування"]
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        await update.message.reply_text(WELCOME_TEXT, parse_mode="Markdown", reply_markup=reply_markup)
-    except Exception as e:
-        logger.error(f"Ошибка в команде start: {e}")
-        await update.message.reply_text("Виникла помилка при запуску бота. Спробуйте ще раз.")
-
-# Функция для поиска лекарств через парсинг сайта
-def search_drugs(drug_name, city_name=None):
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        'Accept-Language': 'uk-UA,uk;q=0.9,ru;q=0.8,en-US;q=0.7,en;q=0.6'
-    }
-    
-    # Формируем URL для поиска
-    encoded_drug = quote(drug_name)
-    url = f"https://tabletki.ua/uk/search/?q={encoded_drug}"
-    if city_name:
-        encoded_city = quote(city_name)
-        url += f"&city={encoded_city}"
-    
-    try:
-        logger.info(f"Поиск: {drug_name} {f'в {city_name}' if city_name else ''}, URL: {url}")
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        # Проверяем наличие результатов поиска
-        no_results_selectors = ['.search-result-empty', '.no-results', '.empty-results']
-        for selector in no_results_selectors:
-            no_results = soup.select(selector)
-            if no_results:
-                logger.info(f"Ничего не найдено для {drug_name} {f'в {city_name}' if city_name else ''}")
-                return []
-        
-        # Ищем результаты на странице
-        results = []
-        product_selectors = ['.search-result-item', '.product-item', '.med-item', '.result-item', '.item']
-        
-        products = []
-        for selector in product_selectors:
-            products = soup.select(selector)
-            if products:
-                break
-        
-        if not products:
-            # Если не нашли по селекторам, попробуем найти по атрибутам
-            products = soup.find_all('div', class_=lambda c: c and ('item' in c or 'product' in c or 'result' in c))
-            # Можно также попробовать найти по тегам
-            if not products:
-                products = soup.find_all(['div', 'li'], attrs={'data-id': True})
-            
-        for product in products:
-            try:
-                # Пробуем разные селекторы для названия
-                name_selectors = ['.item-title', '.product-name', '.title', 'h3', 'h2', '.name']
-                name_elem = None
-                for selector in name_selectors:
-                    name_elem = product.select_one(selector)
-                    if name_elem:
-                        break
-                
-                # Пробуем получить название из атрибута, если селекторы не сработали
-                if not name_elem:
-                    name_elem = product.get('data-name') or product.get('title')
-                
-                name = name_elem.text.strip() if hasattr(name_elem, 'text') else name_elem or "Без назви"
-                
-                # Пробуем разные селекторы для цены
-                price_selectors = ['.price', '.cost', '.product-price', '.money']
-                price_elem = None
-                for selector in price_selectors:
-                    price_elem = product.select_one(selector)
-                    if price_elem:
-                        break
-                
-                # Пробуем получить цену из атрибута, если селекторы не сработали
-                if not price_elem:
-                    price_elem = product.get('data-price')
-                
-                price = price_elem.text.strip() if hasattr(price_elem, 'text') else price_elem or "Ціна невідома"
-                
-                # Пробуем разные селекторы для аптеки
-                pharmacy_selectors = ['.pharmacy-title', '.store-name', '.pharmacy-name', '.pharmacy', '.store']
-                pharmacy_elem = None
-                for selector in pharmacy_selectors:
-                    pharmacy_elem = product.select_one(selector)
-                    if pharmacy_elem:
-                        break
-                
-                # Пробуем получить аптеку из атрибута, если селекторы не сработали
-                if not pharmacy_elem:
-                    pharmacy_elem = product.get('data-pharmacy') or product.get('data-store')
-                
-                pharmacy = pharmacy_elem.text.strip() if hasattr(pharmacy_elem, 'text') else pharmacy_elem or "Аптека невідома"
-                
-                # Дополнительная информация: производитель, форма, вес и т.д.
-                info_selectors = ['.description', '.product-desc', '.details', '.info']
-                info_elem = None
-                for selector in info_selectors:
-                    info_elem = product.select_one(selector)
-                    if info_elem:
-                        break
-                
-                info = info_elem.text.strip() if info_elem else ""
-                
-                # Ссылка на изображение
-                img_elem = product.select_one('img')
-                img_url = img_elem.get('src') if img_elem else ""
-                
-                # Ссылка на продукт
-                link_elem = product.select_one('a')
-                link = link_elem.get('href') if link_elem else ""
-                if link and not link.startswith('http'):
-                    link = f"https://tabletki.ua{link}"
-                
-                results.append({
-                    "name": name,
-                    "price": price,
-                    "pharmacy": pharmacy,
-                    "info": info,
-                    "img_url": img_url,
-                    "link": link,
-                    "city": city_name if city_name else ""
-                })
-            except Exception as e:
-                logger.error(f"Ошибка при парсинге элемента: {e}")
-        
-        logger.info(f"Найдено {len(results)} результатов для {drug_name} {f'в {city_name}' if city_name else ''}")
-        return results
-    except Exception as e:
-        logger.error(f"Ошибка при поиске {drug_name} {f'в {city_name}' if city_name else ''}: {e}")
-        return []
-
-# Функция для поиска городов по шаблону
-def search_cities(city_pattern):
-    try:
-        # Фильтруем города из списка по паттерну
-        pattern = city_pattern.lower()
-        matching_cities = [city for city in UKRAINE_CITIES if pattern in city.lower()]
-        
-        # Сортируем города так, чтобы наиболее точные совпадения были вверху
-        matching_cities.sort(key=lambda x: (0 if x.lower().startswith(pattern) else 1, len(x)))
-        
-        return matching_cities[:10]  # Возвращаем не более 10 городов
-    except Exception as e:
-        logger.error(f"Ошибка при поиске городов: {e}")
-        return []
-
-# Функция проверки наличия препарата в конкретном городе
-def check_drug_availability(drug_name, city_name):
-    try:
-        results = search_drugs(drug_name, city_name)
-        return results
-    except Exception as e:
-        logger.error(f"Ошибка при проверке наличия {drug_name} в {city_name}: {e}")
-        return []
-
-# Функция для отправки уведомления о наличии препарата
-def notify_drug_available(chat_id, drug_name, city_name, bot):
-    try:
-        results = check_drug_availability(drug_name, city_name)
-        if results:
-            message = f"💊 *{drug_name}* з'явився у місті *{city_name}*!\n\n"
-            
-            # Добавляем до 3 аптек с ценами
-            for i, result in enumerate(results[:3]):
-                message += f"{i+1}. {result['name']}\n   💰 {result['price']}\n   🏥 {result['pharmacy']}\n\n"
-            
-            bot.send_message(chat_id, message, parse_mode="Markdown")
-            return True
-        return False
-    except Exception as e:
-        logger.error(f"Ошибка при отправке уведомления: {e}")
-        return False
-
-# Команда /list
-async def list_items(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        # Получаем информацию о парах препарат-город для пользователя
-        chat_id = update.effective_chat.id
-        user_tracking = config.get("tracking", {}).get(str(chat_id), [])
-        
-        if not user_tracking:
-            await update.message.reply_text("У вас ще немає препаратів для відстеження.")
-            return
-        
-        text = "*Відстежувані препарати:*\n\n"
-        
-        for i, item in enumerate(user_tracking):
-            drug = item.get("drug", "")
-            city = item.get("city", "")
-            text += f"{i+1}. 💊 *{drug}* у місті 🏙️ *{city}*\n"
-        
-        # Добавляем кнопки для удаления препаратов из отслеживания
-        keyboard = []
-        for i, item in enumerate(user_tracking):
-            drug = item.get("drug", "")
-            city = item.get("city", "")
-            keyboard.append([InlineKeyboardButton(f"❌ {drug} ({city})", callback_data=f"remove_tracking:{i}")])
-        
-        markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(text, parse_mode="Markdown", reply_markup=markup)
-    except Exception as e:
-        logger.error(f"Ошибка в команде list: {e}")
-        await update.message.reply_text("Виникла помилка при отриманні списку.")
-
-# Команда /settings
-async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        keyboard = [
-            [InlineKeyboardButton("3 години", callback_data="interval:3")],
-            [InlineKeyboardButton("6 годин", callback_data="interval:6")],
-            [InlineKeyboardButton("12 годин", callback_data="interval:12")],
-            [InlineKeyboardButton("24 години", callback_data="interval:24")]
-        ]
-        markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(
-            f"⏰ Поточний інтервал перевірки: кожні {config.get('interval_hours',12)} годин.\n\nОберіть новий інтервал:",
-            reply_markup=markup
-        )
-    except Exception as e:
-        logger.error(f"Ошибка в команде settings: {e}")
-        await update.message.reply_text("Виникла помилка при налаштуванні інтервалу.")
-
-# Команда /check
-async def check_now(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        chat_id = update.effective_chat.id
-        user_tracking = config.get("tracking", {}).get(str(chat_id), [])
-        
-        if not user_tracking:
-            await update.message.reply_text("У вас ще немає препаратів для відстеження.")
-            return
-        
-        await update.message.reply_text("🔎 Виконується перевірка наявності препаратів...")
-        
-        found = False
-        for item in user_tracking:
-            drug = item.get("drug", "")
-            city = item.get("city", "")
-            
-            results = check_drug_availability(drug, city)
-            if results:
-                found = True
-                message = f"💊 *{drug}* доступний у місті *{city}*!\n\n"
-                
-                # Добавляем до 3 аптек с ценами
-                for i, result in enumerate(results[:3]):
-                    message += f"{i+1}. {result['name']}\n   💰 {result['price']}\n   🏥 {result['pharmacy']}\n\n"
-                
-                await update.message.reply_text(message, parse_mode="Markdown")
-        
-        if not found:
-            await update.message.reply_text("❌ Жодних відстежуваних препаратів не знайдено в обраних містах.")
-    except Exception as e:
-        logger.error(f"Ошибка в команде check: {e}")
-        await update.message.reply_text("Виникла помилка при перевірці наявності ліків.")
-
-# Поиск препаратов по тексту и показ вариантов выбора
-async def search_and_show_drugs(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
-    try:
-        await update.message.reply_text(f"🔎 Пошук препаратів \"{query}\"...")
-        
-        # Ищем препараты без указания города
-        results = search_drugs(query)
-        
-        if not results:
-            await update.message.reply_text("Нічого не знайдено. Спробуйте інший запит.")
-            return False
-        
-        # Группируем препараты по названию (убираем дубликаты)
-        unique_drugs = {}
-        for result in results:
-            name = result['name']
-            if name not in unique_drugs:
-                unique_drugs[name] = result
-        
-        # Создаем кнопки с названиями препаратов
-        keyboard = []
-        for name in list(unique_drugs.keys())[:10]:  # Ограничиваем 10 препаратами
-            keyboard.append([InlineKeyboardButton(name, callback_data=f"select_drug_for_tracking:{name}")])
-        
-        markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(
-            "Оберіть препарат для відстеження з варіантів нижче:", 
-            reply_markup=markup
-        )
-        
-        # Сохраняем результаты в контексте пользователя
-        context.user_data['search_results'] = unique_drugs
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка при поиске препаратов: {e}")
-        await update.message.reply_text("Виникла помилка при пошуку. Спробуйте пізніше.")
-        return False
-
-# Показ списка городов для выбора
-async def show_cities_for_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, city_pattern=None):
-    try:
-        if city_pattern:
-            cities = search_cities(city_pattern)
-        else:
-            # Если шаблон не передан, показываем основные города
-            cities = UKRAINE_CITIES[:10]
-        
-        if not cities:
-            await update.callback_query.edit_message_text(
-                "Не знайдено підходящих міст. Введіть назву міста ще раз:"
-            )
-            return False
-        
-        # Создаем кнопки с городами
-        keyboard = []
-        for city in cities:
-            keyboard.append([InlineKeyboardButton(city, callback_data=f"select_city_for_tracking:{city}")])
-        
-        markup = InlineKeyboardMarkup(keyboard)
-        
-        # В зависимости от типа сообщения, редактируем или отправляем новое
-        if update.callback_query:
-            await update.callback_query.edit_message_text(
-                "Оберіть місто для відстеження препарату:",
-                reply_markup=markup
-            )
-        else:
-            await update.message.reply_text(
-                "Оберіть місто для відстеження препарату:",
-                reply_markup=markup
-            )
-        
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка при отображении списка городов: {e}")
-        if update.callback_query:
-            await update.callback_query.edit_message_text("Виникла помилка при виборі міста. Спробуйте пізніше.")
-        else:
-            await update.message.reply_text("Виникла помилка при виборі міста. Спробуйте пізніше.")
-        return False
-
-# Добавление препарата и города в отслеживание
-def add_to_tracking(chat_id, drug_name, city_name):
-    try:
-        if "tracking" not in config:
-            config["tracking"] = {}
-        
-        if str(chat_id) not in config["tracking"]:
-            config["tracking"][str(chat_id)] = []
-        
-        # Проверяем, не отслеживается ли уже такой препарат в этом городе
-        user_tracking = config["tracking"][str(chat_id)]
-        for item in user_tracking:
-            if item.get("drug") == drug_name and item.get("city") == city_name:
-                return False  # Уже отслеживается
-        
-        # Добавляем в отслеживание
-        config["tracking"][str(chat_id)].append({
-            "drug": drug_name,
-            "city": city_name,
-            "added": time.time()
-        })
-        
-        save_config(config)
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка при добавлении в отслеживание: {e}")
-        return False
-
-# Удаление препарата из отслеживания
-def remove_from_tracking(chat_id, index):
-    try:
-        if "tracking" not in config or str(chat_id) not in config["tracking"]:
-            return False
-        
-        user_tracking = config["tracking"][str(chat_id)]
-        if index >= len(user_tracking):
-            return False
-        
-        # Удаляем из отслеживания
-        del user_tracking[index]
-        save_config(config)
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка при удалении из отслеживания: {e}")
-        return False
-
-# Фоновая проверка по расписанию
-def schedule_checks(application):
-    def loop():
-        while True:
-            interval_hours = config.get("interval_hours", 12)
-            logger.info(f"Запланирована проверка через {interval_hours} часов")
-            
-            time.sleep(interval_hours * 3600)
-            
-            try:
-                tracking = config.get("tracking", {})
-                logger.info(f"Проверка препаратов для {len(tracking)} пользователей")
-                
-                for chat_id, user_tracking in tracking.items():
-                    for item in user_tracking:
-                        drug = item.get("drug", "")
-                        city = item.get("city", "")
-                        
-                        if drug and city:
-                            notify_drug_available(int(chat_id), drug, city, application.bot)
-            except Exception as e:
-                logger.error(f"Scheduled check error: {e}")
-    
-    t = threading.Thread(target=loop, daemon=True)
-    t.start()
-    logger.info(f"Background checker started with interval: {config.get('interval_hours', 12)} hours")
-
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        query = update.callback_query
-        await query.answer()
-        
-        if query.data.startswith("select_drug_for_tracking:"):
-            # Пользователь выбрал препарат, предлагаем выбрать город
-            drug_name = query.data.split(":", 1)[1]
-            
-            # Сохраняем выбранный препарат
-            context.user_data["selected_drug"] = drug_name
-            
-            # Показываем список городов для выбора
-            context.user_data["waiting_for"] = "city_for_tracking"
-            await show_cities_for_selection(update, context)
-        
-        elif query.data.startswith("select_city_for_tracking:"):
-            # Пользователь выбрал город
-            city_name = query.data.split(":", 1)[1]
-            drug_name = context.user_data.get("selected_drug", "")
-            
-            if not drug_name:
-                await query.edit_message_text("Помилка: не вибрано препарат. Почніть спочатку.")
-                return
-            
-            # Добавляем в отслеживание
-            chat_id = update.effective_chat.id
-            if add_to_tracking(chat_id, drug_name, city_name):
-                await query.edit_message_text(
-                    f"✅ Препарат *{drug_name}* буде відстежуватися у місті *{city_name}*.\n\n"
-                    f"Ви отримаєте повідомлення, коли препарат з'явиться в наявності.",
-                    parse_mode="Markdown"
-                )
-            else:
-                await query.edit_message_text(
-                    f"ℹ️ Препарат *{drug_name}* у місті *{city_name}* вже відстежується.",
-                    parse_mode="Markdown"
-                )
-            
-            # Очищаем состояние ожидания
-            context.user_data.pop("waiting_for", None)
-            context.user_data.pop("selected_drug", None)
-        
-        elif query.data.startswith("remove_tracking:"):
-            # Пользователь хочет удалить препарат из отслеживания
-            index = int(query.data.split(":", 1)[1])
-            chat_id = update.effective_chat.id
-            
-            user_tracking = config.get("tracking", {}).get(str(chat_id), [])
-            if index < len(user_tracking):
-                drug = user_tracking[index].get("drug", "")
-                city = user_tracking[index].get("city", "")
-                
-                if remove_from_tracking(chat_id, index):
-                    await query.edit_message_text(
-                        f"🗑️ Препарат *{drug}* у місті *{city}* видалено з відстеження.",
-                        parse_mode="Markdown"
-                    )
-                else:
-                    await query.edit_message_text(
-                        "❌ Помилка при видаленні препарату з відстеження.",
-                    )
-            else:
-                await query.edit_message_text("❌ Препарат не знайдено.")
-        
-        elif query.data.startswith("interval:"):
-            hours = int(query.data.split(":", 1)[1])
-            config["interval_hours"] = hours
-            save_config(config)
-            await query.edit_message_text(f"⏰ Інтервал перевірки змінено на *{hours} годин*.", parse_mode="Markdown")
-    
-    except Exception as e:
-        logger.error(f"Ошибка в button_handler: {e}")
-        await query.edit_message_text("Виникла помилка при обробці запиту.")
-
-async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        text = update.message.text.strip()
-        
-        if text == "🔎 Додати препарат для відстеження":
-            await update.message.reply_text("Введіть назву препарату для пошуку:")
-            context.user_data["waiting_for"] = "drug_search"
-            return
-        
-        if text == "📋 Список відстежуваних":
-            await list_items(update, context)
-            return
-        
-        if text == "🔎 Перевірити зараз":
-            await check_now(update, context)
-            return
-        
-        if text == "⚙️ Налаштування":
-            await settings(update, context)
-            return
-        
-        # Проверяем, ожидаем ли ввод от пользователя
-        waiting_for = context.user_data.get("waiting_for")
-        
-        if waiting_for == "drug_search":
-            # Пользователь ввел название препарата
-            await search_and_show_drugs(update, context, text)
-            return
-        
-        elif waiting_for == "city_for_tracking":
-            # Пользователь ввел название города
-            await show_cities_for_selection(update, context, text)
-            return
-        
-        else:
-            # Если ничего не ожидаем, считаем ввод поиском препарата
-            await search_and_show_drugs(update, context, text)
-    
-    except Exception as e:
-        logger.error(f"Ошибка в handle_text: {e}")
-        await update.message.reply_text("Виникла помилка при обробці тексту.")
-
-def main():
-    try:
-        if not config["token"]:
-            logger.error("Токен бота не найден в конфигурации")
-            print("Ошибка: токен бота не найден в конфигурации!")
-            return
-            
-        app = ApplicationBuilder().token(config["token"]).build()
-        
-        # Добавляем обработчики команд
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(CommandHandler("list", list_items))
-        app.add_handler(CommandHandler("check", check_now))
-        app.add_handler(CommandHandler("settings", settings))
-        
-        # Добавляем обработчик для callback-запросов от кнопок
-        app.add_handler(CallbackQueryHandler(button_handler))
-        
-        # Добавляем обработчик для текстовых сообщений
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-        
-        # Запускаем фоновую проверку
-        schedule_checks(app)
-        
-        # Запускаем бота
-        logger.info("Bot started!")
-        print("Bot started!")
-        app.run_polling()
-    except Exception as e:
-        logger.critical(f"Критическая ошибка при запуске бота: {e}")
-        print(f"Критическая ошибка при запуске бота: {e}")
-
-if __name__ == "__main__":
-    main()
+import array
+import asyncio
+import bisect
+import collections
+import contextvars
+import cProfile
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import pickle
+import pstats
+import queue
+import random
+import re
+import secrets
+import signal
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import types
+import zlib
+import httpx
+import logging
+from bs4 import BeautifulSoup, SoupStrainer
+from collections import OrderedDict
+from urllib.parse import quote, urljoin, urlsplit
+from telegram import (
+    Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup,
+    InlineQueryResultArticle, InputTextMessageContent
+)
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.helpers import escape_markdown
+from telegram.ext import (
+    ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, InlineQueryHandler
+)
+
+# Настройка логирования
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+# httpx логирует каждый запрос, при массовых проверках это лишний шум
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# Путь к конфигу можно переопределить переменной окружения (используется бенчмарком)
+CONFIG_PATH = os.environ.get("DE_LIKY_BOT_CONFIG", "/opt/de_liky_bot/config.json")
+
+# Загрузка конфига
+def load_config():
+    try:
+        if not os.path.exists(CONFIG_PATH):
+            default_config = {"token": "", "cities": [], "drugs": []}
+            os.makedirs(os.path.dirname(CONFIG_PATH), exist_ok=True)
+            with open(CONFIG_PATH, "w", encoding="utf-8") as f:
+                json.dump(default_config, f, ensure_ascii=False, indent=4)
+            return default_config
+        with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки конфига: {e}")
+        return {"token": "", "cities": [], "drugs": []}
+
+# Сохранение конфига
+def save_config(config):
+    try:
+        os.makedirs(os.path.dirname(CONFIG_PATH), exist_ok=True)
+        with open(CONFIG_PATH, "w", encoding="utf-8") as f:
+            json.dump(config, f, ensure_ascii=False, indent=4)
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка сохранения конфига: {e}")
+        return False
+
+config = load_config()
+
+# Нормализация названия препарата или города для сравнения запросов
+def normalize_query(text):
+    text = text.replace("’", "'").replace("ʼ", "'").replace("`", "'")
+    return " ".join(text.lower().split())
+
+DB_PATH = os.path.join(os.path.dirname(CONFIG_PATH), "bot.db")
+
+# Запись отслеживания (неизменяемая): так её видят снимки состояния и планировщик
+# checked — запись уже прошла плановую проверку, то есть подписчик знает текущее наличие
+TrackingEntry = collections.namedtuple("TrackingEntry", "id chat_id drug city drug_key city_key added checked")
+
+# Хранилище данных бота в SQLite (режим WAL): чаты, отслеживание и настройки.
+# Каждое изменение — отдельная короткая транзакция вместо перезаписи всего config.json
+class Storage:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS chats (
+                chat_id INTEGER PRIMARY KEY,
+                added REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS tracking (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                drug TEXT NOT NULL,
+                city TEXT NOT NULL,
+                drug_key TEXT NOT NULL,
+                city_key TEXT NOT NULL,
+                added REAL NOT NULL,
+                UNIQUE (chat_id, drug, city)
+            );
+            CREATE INDEX IF NOT EXISTS idx_tracking_chat ON tracking (chat_id);
+            CREATE INDEX IF NOT EXISTS idx_tracking_query ON tracking (drug_key, city_key);
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS snapshots (
+                drug_key TEXT NOT NULL,
+                city_key TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                min_price INTEGER,
+                pharmacies TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (drug_key, city_key)
+            );
+            CREATE TABLE IF NOT EXISTS pharmacies (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS history (
+                drug_key TEXT NOT NULL,
+                city_key TEXT NOT NULL,
+                data BLOB NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (drug_key, city_key)
+            );
+            CREATE TABLE IF NOT EXISTS job_stats (
+                drug_key TEXT NOT NULL,
+                city_key TEXT NOT NULL,
+                changes REAL NOT NULL,
+                hours REAL NOT NULL,
+                last_check REAL NOT NULL,
+                PRIMARY KEY (drug_key, city_key)
+            );
+            CREATE TABLE IF NOT EXISTS schedule (
+                drug_key TEXT NOT NULL,
+                city_key TEXT NOT NULL,
+                due REAL,
+                last_run REAL,
+                PRIMARY KEY (drug_key, city_key)
+            );
+            CREATE TABLE IF NOT EXISTS search_cache (
+                drug_key TEXT NOT NULL,
+                city_key TEXT NOT NULL,
+                stored REAL NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (drug_key, city_key)
+            );
+            CREATE TABLE IF NOT EXISTS drug_catalog (
+                name TEXT PRIMARY KEY,
+                hits INTEGER NOT NULL,
+                last_seen REAL NOT NULL
+            );
+        """)
+        # Желаемый интервал проверки пользователя (NULL — на усмотрение планировщика)
+        self._add_column("chats", "interval_hours", "REAL")
+        # Записи, ещё не прошедшие плановую проверку. Записи, существовавшие до появления столбца,
+        # проверки уже проходили
+        if self._add_column("tracking", "checked", "INTEGER NOT NULL DEFAULT 0"):
+            self.conn.execute("UPDATE tracking SET checked = 1")
+
+    def _add_column(self, table, column, declaration):
+        columns = {row["name"] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+        if column not in columns:
+            self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+            return True
+        return False
+
+    def add_chat(self, chat_id):
+        cursor = self.conn.execute(
+            "INSERT OR IGNORE INTO chats (chat_id, added) VALUES (?, ?)", (chat_id, time.time())
+        )
+        return cursor.rowcount > 0
+
+    # Добавление записи; повтор определяется уникальным индексом, а не перебором списка.
+    # Возвращает новую запись или None, если такая уже есть
+    def add_tracking(self, chat_id, drug_name, city_name):
+        entry = TrackingEntry(
+            None, chat_id, drug_name, city_name, normalize_query(drug_name), normalize_query(city_name), time.time(), 0
+        )
+        cursor = self.conn.execute(
+            "INSERT OR IGNORE INTO tracking (chat_id, drug, city, drug_key, city_key, added) VALUES (?, ?, ?, ?, ?, ?)",
+            entry[1:-1]
+        )
+        return entry._replace(id=cursor.lastrowid) if cursor.rowcount > 0 else None
+
+    def remove_tracking(self, chat_id, entry_id):
+        cursor = self.conn.execute("DELETE FROM tracking WHERE id = ? AND chat_id = ?", (entry_id, chat_id))
+        return cursor.rowcount > 0
+
+    def mark_checked(self, entry_ids):
+        self.conn.executemany("UPDATE tracking SET checked = 1 WHERE id = ?", [(entry_id,) for entry_id in entry_ids])
+
+    # Все записи отслеживания в порядке добавления
+    def all_tracking(self):
+        rows = self.conn.execute(
+            "SELECT id, chat_id, drug, city, drug_key, city_key, added, checked FROM tracking ORDER BY id"
+        )
+        return [TrackingEntry(*row) for row in rows]
+
+    # Последний сохранённый отпечаток наличия для пары (препарат, город)
+    def get_snapshot(self, key):
+        row = self.conn.execute(
+            "SELECT fingerprint, min_price, pharmacies FROM snapshots WHERE drug_key = ? AND city_key = ?", key
+        ).fetchone()
+        if row is None:
+            return None
+        return {"fingerprint": row["fingerprint"], "min_price": row["min_price"], "pharmacies": json.loads(row["pharmacies"])}
+
+    def save_snapshot(self, key, snapshot):
+        self.conn.execute(
+            "INSERT INTO snapshots (drug_key, city_key, fingerprint, min_price, pharmacies, updated) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(drug_key, city_key) DO UPDATE SET fingerprint = excluded.fingerprint, "
+            "min_price = excluded.min_price, pharmacies = excluded.pharmacies, updated = excluded.updated",
+            (*key, snapshot["fingerprint"], snapshot["min_price"], json.dumps(snapshot["pharmacies"], ensure_ascii=False), time.time())
+        )
+
+    # Числовой id аптеки для истории цен
+    def intern_pharmacy(self, name):
+        self.conn.execute("INSERT OR IGNORE INTO pharmacies (name) VALUES (?)", (name,))
+        return self.conn.execute("SELECT id FROM pharmacies WHERE name = ?", (name,)).fetchone()["id"]
+
+    def pharmacy_name(self, pharmacy_id):
+        row = self.conn.execute("SELECT name FROM pharmacies WHERE id = ?", (pharmacy_id,)).fetchone()
+        return row["name"] if row else None
+
+    def get_history(self, key):
+        row = self.conn.execute("SELECT data FROM history WHERE drug_key = ? AND city_key = ?", key).fetchone()
+        return row["data"] if row else None
+
+    def save_history(self, key, data):
+        self.conn.execute(
+            "INSERT INTO history (drug_key, city_key, data, updated) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(drug_key, city_key) DO UPDATE SET data = excluded.data, updated = excluded.updated",
+            (*key, data, time.time())
+        )
+
+    def history_keys(self):
+        return [(row["drug_key"], row["city_key"]) for row in self.conn.execute("SELECT drug_key, city_key FROM history")]
+
+    # Удаление истории пар, которые давно никто не отслеживает
+    def delete_stale_history(self, updated_before):
+        cursor = self.conn.execute("DELETE FROM history WHERE updated < ?", (updated_before,))
+        return cursor.rowcount
+
+    def history_size(self):
+        row = self.conn.execute("SELECT COUNT(*) AS items, COALESCE(SUM(LENGTH(data)), 0) AS bytes FROM history").fetchone()
+        return dict(row)
+
+    # Состояние планировщика для тёплого перезапуска: время следующей и последней проверки каждой пары
+    def load_schedule(self):
+        return {
+            (row["drug_key"], row["city_key"]): (row["due"], row["last_run"])
+            for row in self.conn.execute("SELECT drug_key, city_key, due, last_run FROM schedule")
+        }
+
+    def save_schedule(self, rows):
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.execute("DELETE FROM schedule")
+            self.conn.executemany(
+                "INSERT INTO schedule (drug_key, city_key, due, last_run) VALUES (?, ?, ?, ?)",
+                [(*key, due, last_run) for key, due, last_run in rows]
+            )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    # Сохранённые записи кэша результатов не старше stored_after; более старые удаляются
+    def load_cache(self, stored_after):
+        self.conn.execute("DELETE FROM search_cache WHERE stored < ?", (stored_after,))
+        return [
+            ((row["drug_key"], row["city_key"]), row["stored"], row["data"])
+            for row in self.conn.execute("SELECT drug_key, city_key, stored, data FROM search_cache")
+        ]
+
+    def save_cache(self, rows, removed):
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.executemany(
+                "INSERT INTO search_cache (drug_key, city_key, stored, data) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(drug_key, city_key) DO UPDATE SET stored = excluded.stored, data = excluded.data",
+                [(*key, stored, data) for key, stored, data in rows]
+            )
+            self.conn.executemany("DELETE FROM search_cache WHERE drug_key = ? AND city_key = ?", removed)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    # Каталог названий препаратов из результатов поиска (для подсказок)
+    def catalog_names(self):
+        return [(row["name"], row["hits"]) for row in self.conn.execute("SELECT name, hits FROM drug_catalog")]
+
+    def save_catalog(self, rows):
+        now = time.time()
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.executemany(
+                "INSERT INTO drug_catalog (name, hits, last_seen) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET hits = excluded.hits, last_seen = excluded.last_seen",
+                [(name, hits, now) for name, hits in rows]
+            )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    # Статистика изменений пары (препарат, город): затухающие счётчики изменений и часов наблюдения,
+    # старые наблюдения теряют вес с периодом полураспада half_life_hours
+    def record_check(self, key, changed, half_life_hours):
+        now = time.time()
+        row = self.conn.execute(
+            "SELECT changes, hours, last_check FROM job_stats WHERE drug_key = ? AND city_key = ?", key
+        ).fetchone()
+        if row is None:
+            changes, hours = 0.0, 0.0
+        else:
+            elapsed = max(0.0, now - row["last_check"]) / 3600
+            decay = 0.5 ** (elapsed / half_life_hours)
+            changes = row["changes"] * decay + (1 if changed else 0)
+            hours = row["hours"] * decay + elapsed
+        self.conn.execute(
+            "INSERT INTO job_stats (drug_key, city_key, changes, hours, last_check) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(drug_key, city_key) DO UPDATE SET changes = excluded.changes, "
+            "hours = excluded.hours, last_check = excluded.last_check",
+            (*key, changes, hours, now)
+        )
+        return changes, hours
+
+    def get_job_stats(self, key):
+        row = self.conn.execute(
+            "SELECT changes, hours FROM job_stats WHERE drug_key = ? AND city_key = ?", key
+        ).fetchone()
+        return (row["changes"], row["hours"]) if row else None
+
+    def all_job_stats(self):
+        return {
+            (row["drug_key"], row["city_key"]): (row["changes"], row["hours"])
+            for row in self.conn.execute("SELECT drug_key, city_key, changes, hours FROM job_stats")
+        }
+
+    def set_chat_interval(self, chat_id, hours):
+        self.conn.execute(
+            "INSERT INTO chats (chat_id, added, interval_hours) VALUES (?, ?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET interval_hours = excluded.interval_hours",
+            (chat_id, time.time(), hours)
+        )
+
+    def chat_intervals(self):
+        rows = self.conn.execute("SELECT chat_id, interval_hours FROM chats WHERE interval_hours IS NOT NULL")
+        return {row["chat_id"]: row["interval_hours"] for row in rows}
+
+    def get_setting(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return json.loads(row["value"]) if row else default
+
+    def set_setting(self, key, value):
+        self.conn.execute(
+            "INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, json.dumps(value))
+        )
+
+    # Одноразовый перенос chat_ids, tracking и interval_hours из config.json; токен остаётся в файле
+    def migrate_from_config(self, config):
+        if not any(key in config for key in ("chat_ids", "tracking", "interval_hours")):
+            return False
+        
+        self.conn.execute("BEGIN")
+        try:
+            for chat_id in config.get("chat_ids", []):
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO chats (chat_id, added) VALUES (?, ?)", (int(chat_id), time.time())
+                )
+            for chat_id, user_tracking in config.get("tracking", {}).items():
+                for item in user_tracking:
+                    drug = item.get("drug", "")
+                    city = item.get("city", "")
+                    if not drug or not city:
+                        continue
+                    self.conn.execute(
+                        "INSERT OR IGNORE INTO tracking (chat_id, drug, city, drug_key, city_key, added) VALUES (?, ?, ?, ?, ?, ?)",
+                        (int(chat_id), drug, city, normalize_query(drug), normalize_query(city), item.get("added", time.time()))
+                    )
+            if "interval_hours" in config and self.get_setting("interval_hours") is None:
+                self.set_setting("interval_hours", config["interval_hours"])
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        
+        # Данные в базе закоммичены, поэтому из файла их можно убрать
+        for key in ("chat_ids", "tracking", "interval_hours"):
+            config.pop(key, None)
+        save_config(config)
+        logger.info(f"Данные отслеживания перенесены из {CONFIG_PATH} в {self.path}")
+        return True
+
+# База и объекты поверх неё создаются в init_storage(), а не при импорте: рабочие процессы проверок
+# импортируют модуль заново, и им нужны только загрузка и разбор страниц
+storage = None
+
+# Текущий интервал проверки в часах
+def get_interval_hours():
+    return storage.get_setting("interval_hours", 12)
+
+# Метрики в текстовом формате Prometheus: счётчики, гистограммы и датчики
+class Metric:
+    def __init__(self, name, help_text, kind, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.labelnames = labelnames
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name + self._format_labels(key), value
+
+class Counter(Metric):
+    def __init__(self, name, help_text, labelnames=(), func=None):
+        super().__init__(name, help_text, "counter", labelnames)
+        self.func = func
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        if self.func is not None:
+            # Значения берутся из уже существующих счётчиков (например, кэша) в момент чтения
+            for labels, value in self.func():
+                yield self.name + self._format_labels(self._key(labels)), value
+        else:
+            yield from super().samples()
+
+class Gauge(Metric):
+    def __init__(self, name, help_text, func):
+        super().__init__(name, help_text, "gauge")
+        self.func = func
+
+    def samples(self):
+        yield self.name, self.func()
+
+# Замер времени блока кода: with HISTOGRAM.time(stage="..."):
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+class Histogram(Metric):
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, "histogram", labelnames)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        data = self.values.get(key)
+        if data is None:
+            data = self.values[key] = {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                data["buckets"][i] += 1
+                break
+        data["sum"] += value
+        data["count"] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        for key, data in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, data["buckets"]):
+                cumulative += count
+                yield self.name + "_bucket" + self._format_labels(key, [("le", bound)]), cumulative
+            yield self.name + "_bucket" + self._format_labels(key, [("le", "+Inf")]), data["count"]
+            yield self.name + "_sum" + self._format_labels(key), data["sum"]
+            yield self.name + "_count" + self._format_labels(key), data["count"]
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                for sample, value in metric.samples():
+                    lines.append(f"{sample} {value}")
+            except Exception as e:
+                logger.error(f"Ошибка при сборе метрики {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+    # Краткая сводка для администратора: для гистограмм — число замеров и среднее
+    def render_summary(self):
+        lines = []
+        for metric in self.metrics:
+            if isinstance(metric, Histogram):
+                for key, data in sorted(metric.values.items()):
+                    average = data["sum"] / data["count"] * 1000 if data["count"] else 0
+                    lines.append(f"{metric.name}{metric._format_labels(key)} n={data['count']} avg={average:.1f}ms")
+            else:
+                for sample, value in metric.samples():
+                    lines.append(f"{sample} {value}")
+        return "\n".join(lines)
+
+metrics = MetricsRegistry()
+FETCH_SECONDS = metrics.register(Histogram("de_liky_fetch_seconds", "Время загрузки страницы tabletki.ua"))
+PARSE_SECONDS = metrics.register(Histogram("de_liky_parse_seconds", "Время разбора страницы поиска"))
+FETCH_BYTES = metrics.register(Counter("de_liky_fetch_bytes_total", "Получено байт от tabletki.ua (до распаковки)"))
+PAGE_REUSE = metrics.register(Counter(
+    "de_liky_page_reuse_total", "Страницы поиска: разобраны заново или взяты из прошлой загрузки", ("outcome",)
+))
+SEND_SECONDS = metrics.register(Histogram("de_liky_telegram_send_seconds", "Время отправки сообщения в Telegram"))
+HANDLER_SECONDS = metrics.register(Histogram("de_liky_handler_seconds", "Время работы обработчика", ("handler",)))
+SWEEP_JOB_SECONDS = metrics.register(Histogram("de_liky_sweep_job_seconds", "Время проверки одной пары препарат-город"))
+SWEEPS = metrics.register(Counter("de_liky_sweeps_total", "Полные проверки всего списка"))
+SWEEP_JOBS = metrics.register(Counter("de_liky_sweep_jobs_total", "Проверенные пары препарат-город"))
+ERRORS = metrics.register(Counter("de_liky_errors_total", "Ошибки по этапам", ("stage",)))
+RESULTS = metrics.register(Counter("de_liky_search_results_total", "Результаты поиска", ("outcome",)))
+PAGES = metrics.register(Counter("de_liky_search_pages_total", "Загруженные и разобранные страницы результатов поиска"))
+RETRIES = metrics.register(Counter("de_liky_fetch_retries_total", "Повторные запросы к tabletki.ua"))
+HEDGES = metrics.register(Counter("de_liky_fetch_hedges_total", "Дублирующие запросы к tabletki.ua"))
+HEDGE_WINS = metrics.register(Counter("de_liky_fetch_hedge_wins_total", "Дублирующие запросы, ответившие первыми"))
+
+# Датчик по одному из полей статистики отслеживания (по текущему снимку, без запроса к базе)
+def tracking_gauge(field):
+    return lambda: tracking_state.snapshot.stats()[field]
+
+metrics.register(Gauge("de_liky_tracked_entries", "Записей отслеживания", tracking_gauge("entries")))
+metrics.register(Gauge("de_liky_distinct_queries", "Уникальных пар препарат-город", tracking_gauge("queries")))
+metrics.register(Gauge("de_liky_active_chats", "Чатов с отслеживанием", tracking_gauge("chats")))
+
+# Отдача метрик по HTTP на локальном порту (metrics_port в конфиге)
+async def handle_metrics_request(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # Заголовки запроса не нужны, но их нужно дочитать
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[1].split("?")[0] == "/metrics":
+            status = "200 OK"
+            body = metrics.render().encode("utf-8")
+        else:
+            status = "404 Not Found"
+            body = b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.warning(f"Ошибка при отдаче метрик: {e}")
+    finally:
+        writer.close()
+
+async def serve_metrics(port):
+    server = await asyncio.start_server(handle_metrics_request, config.get("metrics_host", "127.0.0.1"), port)
+    logger.info(f"Метрики доступны на http://{config.get('metrics_host', '127.0.0.1')}:{port}/metrics")
+    async with server:
+        await server.serve_forever()
+
+# Обёртка обработчика: время выполнения и необработанные ошибки
+def instrument_handler(name, callback):
+    async def wrapper(update, context):
+        with HANDLER_SECONDS.time(handler=name):
+            try:
+                return await callback(update, context)
+            except Exception:
+                ERRORS.inc(stage="handler")
+                raise
+    return wrapper
+
+# Приветственное сообщение
+WELCOME_TEXT = """Вітаю! Я — 🤖 *Де ліки Bot*.
+
+Я допоможу вам відстежувати наявність потрібних ліків у вибраних містах України через сервіс [tabletki.ua](https://tabletki.ua).
+
+Що я вмію:
+🔎 Шукати препарати у вашому місті
+💡 Підказувати назви ліків у будь-якому чаті: наберіть @ім'я бота і початок назви
+➕ Додавати нові міста та ліки для відстеження
+📋 Показувати список відстежуваних препаратів
+🔔 Повідомляти, коли ліки з'являться в аптеках
+📈 Показувати історію цін і наявності (/history)
+⚙️ Налаштовувати інтервал перевірки
+
+*Використовуйте меню або команди для керування ботом.*
+
+_Бажаю здоров'я!_
+"""
+
+# Список основных городов Украины для поиска
+UKRAINE_CITIES = [
+    "Київ", "Харків", "Одеса", "Дніпро", "Донецьк", "Запоріжжя", "Львів", 
+    "Кривий Ріг", "Миколаїв", "Маріуполь", "Луганськ", "Вінниця", 
+    "Херсон", "Полтава", "Чернігів", "Черкаси", "Житомир", "Суми", 
+    "Рівне", "Івано-Франківськ", "Кропивницький", "Тернопіль", "Луцьк", 
+    "Ужгород", "Кам'янець-Подільський", "Мелітополь", "Бердянськ", "Нікополь"
+]
+
+# Команда /start
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        # Добавляем chat_id в список отслеживаемых
+        chat_id = update.effective_chat.id
+        storage.add_chat(chat_id)
+            
+        keyboard = [
+            ["🔎 Додати препарат для відстеження"],
+            ["📋 Список відстежуваних", "🔎 Перевірити зараз"],
+            ["⚙️ Налаштування"]
+        ]
+        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        await update.message.reply_text(WELCOME_TEXT, parse_mode="Markdown", reply_markup=reply_markup)
+    except Exception as e:
+        ERRORS.inc(stage="handler")
+        logger.error(f"Ошибка в команде start: {e}")
+        await update.message.reply_text("Виникла помилка при запуску бота. Спробуйте ще раз.")
+
+# Базовый адрес сайта и заголовки запросов. Сжатие: gzip/deflate httpx распаковывает сам,
+# br — если установлен пакет brotli (httpx[brotli])
+TABLETKI_BASE_URL = "https://tabletki.ua"
+try:
+    import brotli
+    ACCEPT_ENCODING = "br, gzip, deflate"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+HTTP_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept-Language': 'uk-UA,uk;q=0.9,ru;q=0.8,en-US;q=0.7,en;q=0.6',
+    'Accept-Encoding': ACCEPT_ENCODING
+}
+
+# Общий асинхронный HTTP-клиент с пулом keep-alive соединений
+_http_client = None
+_fetch_semaphore = None
+
+def get_http_client():
+    global _http_client
+    if _http_client is None:
+        max_connections = config.get("http_max_connections", 10)
+        _http_client = httpx.AsyncClient(
+            headers=HTTP_HEADERS,
+            timeout=httpx.Timeout(config.get("http_timeout", 10), connect=5),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=60
+            ),
+            follow_redirects=True
+        )
+    return _http_client
+
+# Закрытие HTTP-клиента при остановке бота
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+# Ограничение частоты запросов по алгоритму token bucket
+class RateLimiter:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    # Токен без ожидания, если он есть (для необязательных запросов)
+    def try_acquire(self):
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    # Списание уже израсходованных токенов (в долг): следующие acquire подождут, пока долг не покроется
+    def charge(self, amount):
+        self._refill()
+        self._tokens -= amount
+
+# Ограничители частоты запросов для каждого хоста
+_host_limiters = {}
+
+def get_host_limiter(url):
+    host = urlsplit(url).netloc
+    limiter = _host_limiters.get(host)
+    if limiter is None:
+        rate = config.get("http_requests_per_second", 2)
+        limiter = _host_limiters[host] = RateLimiter(rate, burst=max(1, int(rate)))
+    return limiter
+
+# Не удалось получить страницу (сеть, таймаут, ошибка сервера, сайт недоступен).
+# В отличие от пустого результата не означает, что препарата нет
+class FetchError(Exception):
+    pass
+
+# Запрос не отправлялся: автоматический выключатель разомкнут
+class CircuitOpenError(FetchError):
+    pass
+
+# Автоматический выключатель: после failure_threshold неудач подряд запросы к хосту сразу завершаются
+# ошибкой, пока не пройдёт open_seconds. Затем пропускается один пробный запрос: успех замыкает
+# выключатель, неудача размыкает его снова на вдвое больший срок (не больше max_open_seconds)
+class CircuitBreaker:
+    def __init__(self, failure_threshold, open_seconds, max_open_seconds):
+        self.failure_threshold = failure_threshold
+        self.base_open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.retry_at = 0.0
+        self.opened = 0
+
+    # Сколько секунд осталось до следующего разрешённого запроса (0 — можно сейчас)
+    def retry_in(self):
+        if self.state == "closed":
+            return 0.0
+        return max(0.0, self.retry_at - time.monotonic())
+
+    def before_request(self):
+        if self.state == "closed":
+            return
+        if time.monotonic() < self.retry_at:
+            raise CircuitOpenError(f"сайт недоступен, повтор через {self.retry_in():.0f} с")
+        # Пробный запрос; следующий пропускаем не раньше, чем через open_seconds, даже если этот завис
+        self.state = "half_open"
+        self.retry_at = time.monotonic() + self.open_seconds
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info("Сайт снова отвечает, проверки возобновлены")
+        self.state = "closed"
+        self.failures = 0
+        self.open_seconds = self.base_open_seconds
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "closed":
+            if self.failures >= self.failure_threshold:
+                self._open()
+        elif self.state == "half_open" or time.monotonic() >= self.retry_at:
+            # Неудачный пробный запрос (в том числе выполненный рабочим процессом)
+            self.open_seconds = min(self.max_open_seconds, self.open_seconds * 2)
+            self._open()
+
+    def _open(self):
+        self.state = "open"
+        self.retry_at = time.monotonic() + self.open_seconds
+        self.opened += 1
+        logger.warning(f"Сайт не отвечает ({self.failures} ошибок подряд), запросы приостановлены на {self.open_seconds:.0f} с")
+
+_host_breakers = {}
+
+def get_host_breaker(url):
+    host = urlsplit(url).netloc
+    breaker = _host_breakers.get(host)
+    if breaker is None:
+        breaker = _host_breakers[host] = CircuitBreaker(
+            failure_threshold=config.get("circuit_failure_threshold", 5),
+            open_seconds=config.get("circuit_open_seconds", 60),
+            max_open_seconds=config.get("circuit_max_open_seconds", 600)
+        )
+    return breaker
+
+metrics.register(Gauge(
+    "de_liky_circuit_open", "Разомкнутые автоматические выключатели (сайт недоступен)",
+    lambda: sum(breaker.state != "closed" for breaker in _host_breakers.values())
+))
+metrics.register(Counter("de_liky_circuit_opened_total", "Размыкания автоматического выключателя", func=lambda: [
+    ({}, sum(breaker.opened for breaker in _host_breakers.values()))
+]))
+
+# Ответы, после которых есть смысл повторить запрос
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Время последних успешных загрузок для автоматической задержки дублирующего запроса
+_fetch_latencies = collections.deque(maxlen=200)
+
+# Через сколько секунд без ответа отправлять дублирующий запрос (None — не отправлять).
+# http_hedge_after: число секунд или "auto" — 95-й перцентиль недавних загрузок
+def hedge_delay():
+    setting = config.get("http_hedge_after", 0)
+    if setting == "auto":
+        if len(_fetch_latencies) < 20:
+            return None
+        latencies = sorted(_fetch_latencies)
+        return max(0.2, latencies[int(len(latencies) * 0.95)])
+    return setting or None
+
+# Один запрос с ограничением числа одновременных запросов и их частоты
+async def _fetch_once(url, headers=None):
+    global _fetch_semaphore
+    if _fetch_semaphore is None:
+        _fetch_semaphore = asyncio.Semaphore(config.get("http_max_concurrency", 5))
+    await get_host_limiter(url).acquire()
+    async with _fetch_semaphore:
+        started = time.monotonic()
+        with FETCH_SECONDS.time():
+            response = await get_http_client().get(url, headers=headers)
+        FETCH_BYTES.inc(response.num_bytes_downloaded)
+        if response.status_code < 400:
+            _fetch_latencies.append(time.monotonic() - started)
+        return response
+
+# Запрос с дублированием: если ответа нет дольше обычного, отправляется второй такой же запрос
+# и используется ответ, пришедший первым. Дубль отправляется, только если есть свободный слот
+# и токен лимита частоты, поэтому нагрузку на сайт сверх лимита он не создаёт
+async def _fetch_hedged(url, headers=None):
+    delay = hedge_delay()
+    first = asyncio.create_task(_fetch_once(url, headers))
+    tasks = [first]
+    try:
+        if delay is None:
+            return await first
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done or _fetch_semaphore.locked() or not get_host_limiter(url).try_acquire():
+            return await first
+        HEDGES.inc()
+        # Токен уже взят, поэтому второй запрос идёт мимо ограничителя частоты
+        tasks.append(asyncio.create_task(_fetch_unlimited(url, headers)))
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not first:
+                        HEDGE_WINS.inc()
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+async def _fetch_unlimited(url, headers=None):
+    async with _fetch_semaphore:
+        with FETCH_SECONDS.time():
+            response = await get_http_client().get(url, headers=headers)
+        FETCH_BYTES.inc(response.num_bytes_downloaded)
+        return response
+
+# Пауза перед повтором: экспоненциальный рост с полным случайным разбросом,
+# чтобы повторы разных задач не приходили на сайт одновременно
+def backoff_delay(attempt):
+    base = config.get("http_backoff_base", 0.5)
+    return random.uniform(0, min(config.get("http_backoff_max", 8), base * 2 ** attempt))
+
+# Загрузка страницы: повторы при сетевых ошибках и ответах 429/5xx, автоматический выключатель
+# по хосту. Любая неудача завершается FetchError. headers — дополнительные заголовки (например,
+# условного запроса); ответ 304 считается успешным
+async def fetch_page(url, headers=None):
+    breaker = get_host_breaker(url)
+    attempts = config.get("http_retries", 2) + 1
+    for attempt in range(attempts):
+        try:
+            breaker.before_request()
+        except CircuitOpenError:
+            ERRORS.inc(stage="circuit_open")
+            raise
+        retry_after = None
+        try:
+            response = await _fetch_hedged(url, headers)
+        except httpx.HTTPError as e:
+            error = f"{type(e).__name__}: {e}"
+        else:
+            if response.status_code < 400:
+                breaker.record_success()
+                return response
+            error = f"HTTP {response.status_code}"
+            if response.status_code not in RETRY_STATUSES:
+                # Сайт отвечает, просто не на этот запрос — выключатель не трогаем
+                ERRORS.inc(stage="fetch")
+                raise FetchError(error)
+            header = response.headers.get("Retry-After", "")
+            retry_after = float(header) if header.isdigit() else None
+        breaker.record_failure()
+        delay = backoff_delay(attempt)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        if attempt + 1 == attempts or breaker.state == "open" or delay > config.get("http_backoff_max", 8):
+            ERRORS.inc(stage="fetch")
+            raise FetchError(error)
+        RETRIES.inc()
+        logger.info(f"Повтор запроса через {delay:.1f} с ({error}): {url}")
+        await asyncio.sleep(delay)
+
+# Формирование URL для поиска
+def build_search_url(drug_name, city_name=None):
+    encoded_drug = quote(drug_name)
+    url = f"{TABLETKI_BASE_URL}/uk/search/?q={encoded_drug}"
+    if city_name:
+        encoded_city = quote(city_name)
+        url += f"&city={encoded_city}"
+    return url
+
+# Бэкенды разбора HTML. selectolax (lexbor) и lxml необязательны:
+# если библиотека не установлена, используется стандартный html.parser
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+try:
+    import lxml  # noqa: F401
+    HAS_LXML = True
+except ImportError:
+    HAS_LXML = False
+
+_BODY_RE = re.compile(r"<body[\s>]", re.IGNORECASE)
+
+# Разбор через BeautifulSoup (html.parser или lxml); строится только дерево <body>
+class SoupBackend:
+    def __init__(self, features):
+        self.name = features
+        self.features = features
+
+    def parse(self, html):
+        if _BODY_RE.search(html):
+            return BeautifulSoup(html, self.features, parse_only=SoupStrainer("body"))
+        return BeautifulSoup(html, self.features)
+
+    def select(self, node, selector):
+        return node.select(selector)
+
+    def select_one(self, node, selector):
+        return node.select_one(selector)
+
+    def text(self, node):
+        return node.text
+
+    def attr(self, node, name):
+        return node.get(name)
+
+    def find_by_class_words(self, root, words):
+        return root.find_all('div', class_=lambda c: c and any(word in c for word in words))
+
+    def find_with_attr(self, root, tags, attr):
+        return root.find_all(tags, attrs={attr: True})
+
+# Разбор через selectolax (lexbor): дерево строится на C, без объектов Python для каждого узла
+class SelectolaxBackend:
+    name = "selectolax"
+
+    def parse(self, html):
+        return LexborHTMLParser(html).body
+
+    # В lexbor поиск по узлу включает сам узел, а в BeautifulSoup — только потомков.
+    # Узлы сравниваем по mem_id: сравнение объектов Node сериализует их в HTML
+    def select(self, node, selector):
+        return [found for found in node.css(selector) if found.mem_id != node.mem_id]
+
+    def select_one(self, node, selector):
+        found = node.css_first(selector)
+        if found is not None and found.mem_id == node.mem_id:
+            found = next(iter(self.select(node, selector)), None)
+        return found
+
+    def text(self, node):
+        return node.text()
+
+    def attr(self, node, name):
+        return node.attributes.get(name)
+
+    def find_by_class_words(self, root, words):
+        return [
+            node for node in root.css('div')
+            if any(word in (node.attributes.get('class') or '') for word in words)
+        ]
+
+    def find_with_attr(self, root, tags, attr):
+        return root.css(", ".join(f"{tag}[{attr}]" for tag in tags))
+
+# Выбор бэкенда по настройке html_parser: auto, selectolax, lxml или html.parser
+def get_parser_backend():
+    global _parser_backend
+    if _parser_backend is None:
+        choice = config.get("html_parser", "auto")
+        if choice in ("auto", "selectolax") and LexborHTMLParser is not None:
+            _parser_backend = SelectolaxBackend()
+        elif choice in ("auto", "selectolax", "lxml") and HAS_LXML:
+            _parser_backend = SoupBackend("lxml")
+        else:
+            _parser_backend = SoupBackend("html.parser")
+        if choice not in ("auto", _parser_backend.name):
+            logger.warning(f"Парсер {choice} недоступен, используется {_parser_backend.name}")
+    return _parser_backend
+
+_parser_backend = None
+
+# Первый по приоритету сработавший селектор. Селекторы всегда пробуются по порядку: запоминать
+# сработавший в прошлый раз нельзя — на карточке, где совпадают несколько селекторов, он выбрал бы
+# не то поле, что более приоритетный
+def select_first(backend, node, selectors, many=False):
+    find = backend.select if many else backend.select_one
+    for selector in selectors:
+        found = find(node, selector)
+        if found:
+            return found
+    return [] if many else None
+
+# Текст поля по селекторам, а если они не сработали — значение из атрибутов
+def extract_field(backend, product, selectors, attrs, default):
+    elem = select_first(backend, product, selectors)
+    if elem is not None:
+        return backend.text(elem).strip()
+    for attr in attrs:
+        value = backend.attr(product, attr)
+        if value:
+            return value
+    return default
+
+NO_RESULTS_SELECTORS = ['.search-result-empty', '.no-results', '.empty-results']
+PRODUCT_SELECTORS = ['.search-result-item', '.product-item', '.med-item', '.result-item', '.item']
+NAME_SELECTORS = ['.item-title', '.product-name', '.title', 'h3', 'h2', '.name']
+PRICE_SELECTORS = ['.price', '.cost', '.product-price', '.money']
+PHARMACY_SELECTORS = ['.pharmacy-title', '.store-name', '.pharmacy-name', '.pharmacy', '.store']
+INFO_SELECTORS = ['.description', '.product-desc', '.details', '.info']
+NEXT_PAGE_SELECTORS = ['a[rel="next"]', 'link[rel="next"]', '.pagination .next a', '.pagination-next a', 'a.next']
+
+# Ссылка на следующую страницу результатов (как в разметке, может быть относительной) или None
+def find_next_page(backend, root):
+    for selector in NEXT_PAGE_SELECTORS:
+        node = backend.select_one(root, selector)
+        if node is not None and backend.attr(node, 'href'):
+            return backend.attr(node, 'href')
+    return None
+
+# Разбор страницы результатов поиска
+def parse_search_results(html, drug_name, city_name=None):
+    return parse_search_page(html, drug_name, city_name)[0]
+
+# Разбор страницы результатов поиска: (результаты, ссылка на следующую страницу или None)
+def parse_search_page(html, drug_name, city_name=None):
+    backend = get_parser_backend()
+    root = backend.parse(html)
+    
+    # Проверяем наличие результатов поиска
+    for selector in NO_RESULTS_SELECTORS:
+        if backend.select_one(root, selector) is not None:
+            logger.info(f"Ничего не найдено для {drug_name} {f'в {city_name}' if city_name else ''}")
+            return [], None
+
+    # Ищем результаты на странице
+    results = []
+    products = select_first(backend, root, PRODUCT_SELECTORS, many=True)
+
+    if not products:
+        # Если не нашли по селекторам, попробуем найти по атрибутам
+        products = backend.find_by_class_words(root, ('item', 'product', 'result'))
+        # Можно также попробовать найти по тегам
+        if not products:
+            products = backend.find_with_attr(root, ['div', 'li'], 'data-id')
+
+    for product in products:
+        try:
+            name = extract_field(backend, product, NAME_SELECTORS, ('data-name', 'title'), "Без назви")
+            price = extract_field(backend, product, PRICE_SELECTORS, ('data-price',), "Ціна невідома")
+            pharmacy = extract_field(
+                backend, product, PHARMACY_SELECTORS, ('data-pharmacy', 'data-store'), "Аптека невідома"
+            )
+            # Дополнительная информация: производитель, форма, вес и т.д.
+            info = extract_field(backend, product, INFO_SELECTORS, (), "")
+
+            # Ссылка на изображение
+            img_elem = backend.select_one(product, 'img')
+            img_url = backend.attr(img_elem, 'src') if img_elem is not None else ""
+
+            # Ссылка на продукт
+            link_elem = backend.select_one(product, 'a')
+            link = backend.attr(link_elem, 'href') if link_elem is not None else ""
+            if link and not link.startswith('http'):
+                link = f"{TABLETKI_BASE_URL}{link}"
+
+            results.append({
+                "name": name,
+                "price": price,
+                "pharmacy": pharmacy,
+                "info": info,
+                "img_url": img_url,
+                "link": link,
+                "city": city_name if city_name else ""
+            })
+        except Exception as e:
+            logger.error(f"Ошибка при парсинге элемента: {e}")
+
+    logger.info(f"Найдено {len(results)} результатов для {drug_name} {f'в {city_name}' if city_name else ''}")
+    return results, find_next_page(backend, root)
+
+# Кэш результатов поиска: TTL, ограничение размера с вытеснением LRU
+# и выдача устаревших данных, пока в фоне выполняется обновление
+class SearchCache:
+    def __init__(self, ttl_seconds, max_entries, max_stale_seconds):
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self.max_stale = max_stale_seconds
+        self._entries = OrderedDict()  # ключ -> (время сохранения, результаты)
+        self._pending = {}  # ключ -> задача загрузки
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Изменения с последнего сохранения на диск
+        self._changed = set()
+        self._removed = set()
+
+    # variant — неполные результаты (поиск до условия остановки): отдельная запись, на диск не сохраняется
+    @staticmethod
+    def make_key(drug_name, city_name=None, variant=None):
+        key = (normalize_query(drug_name), normalize_query(city_name or ""))
+        return key if variant is None else key + (variant,)
+
+    def put(self, key, results):
+        self._entries[key] = (time.monotonic(), results)
+        self._entries.move_to_end(key)
+        if len(key) == 2:
+            self._changed.add(key)
+            self._removed.discard(key)
+        self._trim()
+
+    def _trim(self):
+        while len(self._entries) > self.max_entries:
+            key, _ = self._entries.popitem(last=False)
+            if len(key) == 2:
+                self._changed.discard(key)
+                self._removed.add(key)
+            self.evictions += 1
+
+    # Изменения для сохранения на диск: записи (ключ, время сохранения по часам системы, результаты)
+    # и удалённые ключи. Время в кэше монотонное, для диска переводится в абсолютное
+    def take_changes(self):
+        offset = time.time() - time.monotonic()
+        rows = [(key, self._entries[key][0] + offset, self._entries[key][1]) for key in self._changed]
+        removed = list(self._removed)
+        self._changed.clear()
+        self._removed.clear()
+        return rows, removed
+
+    # Восстановление после перезапуска; записи, обновлённые за это время, не перезаписываются
+    def restore(self, rows):
+        offset = time.time() - time.monotonic()
+        restored = 0
+        # От новых к старым: каждая следующая запись ставится в начало очереди вытеснения
+        for key, stored, results in sorted(rows, key=lambda row: row[1], reverse=True):
+            if key in self._entries or time.time() - stored >= self.max_stale:
+                continue
+            self._entries[key] = (stored - offset, results)
+            self._entries.move_to_end(key, last=False)
+            restored += 1
+        self._trim()
+        return restored
+
+    # Загрузка с объединением одновременных запросов одного и того же ключа
+    def _load(self, key, drug_name, city_name, fetch):
+        task = self._pending.get(key)
+        if task is None:
+            async def load():
+                try:
+                    results = await fetch(drug_name, city_name)
+                    self.put(key, results)
+                    return results
+                finally:
+                    self._pending.pop(key, None)
+            task = self._pending[key] = asyncio.create_task(load())
+        return task
+
+    # Фоновое обновление устаревшей записи; ошибка обновления оставляет старые данные
+    def _refresh_in_background(self, key, drug_name, city_name, fetch):
+        def log_error(task):
+            if not task.cancelled() and task.exception():
+                logger.warning(f"Не удалось обновить кэш для {drug_name} {city_name or ''}: {task.exception()}")
+        self._load(key, drug_name, city_name, fetch).add_done_callback(log_error)
+
+    # Есть ли пригодная запись или уже идущая загрузка
+    def has(self, drug_name, city_name=None):
+        key = self.make_key(drug_name, city_name)
+        entry = self._entries.get(key)
+        return key in self._pending or (entry is not None and time.monotonic() - entry[0] < self.max_stale)
+
+    # variant — вызывающему хватит неполных результатов: полная запись (или её загрузка) используется,
+    # если есть, иначе запись варианта с теми же TTL, объединением запросов и фоновым обновлением
+    async def get_or_fetch(self, drug_name, city_name, fetch, variant=None):
+        key = self.make_key(drug_name, city_name)
+        if variant is not None and not self.has(drug_name, city_name):
+            key = self.make_key(drug_name, city_name, variant)
+        entry = self._entries.get(key)
+        if entry is not None:
+            stored_at, results = entry
+            age = time.monotonic() - stored_at
+            if age < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return results
+            if age < self.max_stale:
+                self._entries.move_to_end(key)
+                self.stale_hits += 1
+                self._refresh_in_background(key, drug_name, city_name, fetch)
+                return results
+        
+        self.misses += 1
+        # shield: отмена одного ожидающего не должна отменять общую загрузку
+        return await asyncio.shield(self._load(key, drug_name, city_name, fetch))
+
+    # Принудительное обновление записи (используется плановой проверкой)
+    async def refresh(self, drug_name, city_name, fetch):
+        key = self.make_key(drug_name, city_name)
+        return await asyncio.shield(self._load(key, drug_name, city_name, fetch))
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+search_cache = SearchCache(
+    ttl_seconds=config.get("cache_ttl_minutes", 30) * 60,
+    max_entries=config.get("cache_max_entries", 5000),
+    max_stale_seconds=config.get("cache_max_stale_hours", 24) * 3600
+)
+
+metrics.register(Counter("de_liky_cache_requests_total", "Обращения к кэшу результатов", ("result",), func=lambda: [
+    ({"result": "hit"}, search_cache.hits),
+    ({"result": "stale"}, search_cache.stale_hits),
+    ({"result": "miss"}, search_cache.misses)
+]))
+metrics.register(Gauge("de_liky_cache_entries", "Записей в кэше результатов", lambda: len(search_cache._entries)))
+
+# Разобранные страницы поиска по URL: валидаторы ответа (ETag, Last-Modified) для условных запросов
+# и хэш содержимого. Если сайт ответил 304 или прислал ту же страницу, что и в прошлый раз, разбор
+# пропускается и используются прошлые результаты. Ограничение размера с вытеснением LRU
+class PageCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # url -> (etag, last_modified, хэш, результаты, следующая страница)
+
+    @staticmethod
+    def digest(text):
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    # Заголовки условного запроса для страницы, загруженной раньше
+    def conditional_headers(self, url):
+        entry = self._entries.get(url)
+        if entry is None:
+            return None
+        headers = {}
+        if entry[0]:
+            headers["If-None-Match"] = entry[0]
+        if entry[1]:
+            headers["If-Modified-Since"] = entry[1]
+        return headers or None
+
+    # Прошлый результат разбора; digest — только если содержимое страницы не изменилось.
+    # Возвращаются копии: вызывающие могут менять записи результатов
+    def get(self, url, digest=None):
+        entry = self._entries.get(url)
+        if entry is None or (digest is not None and entry[2] != digest):
+            return None
+        self._entries.move_to_end(url)
+        return [dict(result) for result in entry[3]], entry[4]
+
+    def put(self, url, response, digest, results, next_page):
+        self._entries[url] = (
+            response.headers.get("ETag"), response.headers.get("Last-Modified"),
+            digest, [dict(result) for result in results], next_page
+        )
+        self._entries.move_to_end(url)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+page_cache = PageCache(config.get("page_cache_max_entries", 5000))
+
+# Счётчик запросов страниц поиска в текущей задаче (список из одного числа, None — не считать).
+# По нему плановая проверка списывает бюджет запросов к сайту за каждую загруженную страницу
+pages_fetched = contextvars.ContextVar("pages_fetched", default=None)
+
+def count_pages(amount=1):
+    counter = pages_fetched.get()
+    if counter is not None:
+        counter[0] += amount
+
+# Загрузка и разбор одной страницы поиска с учётом page_cache: (результаты, ссылка на следующую страницу)
+async def fetch_search_page(url, drug_name, city_name=None, in_thread=True, timings=None):
+    count_pages()
+    response = await fetch_page(url, page_cache.conditional_headers(url))
+    if response.status_code == 304:
+        cached = page_cache.get(url)
+        if cached is not None:
+            PAGE_REUSE.inc(outcome="not_modified")
+            return cached
+        # Запись успели вытеснить — нужна полная загрузка
+        count_pages()
+        response = await fetch_page(url)
+    html = response.text
+    digest = PageCache.digest(html)
+    cached = page_cache.get(url, digest)
+    if cached is not None:
+        PAGE_REUSE.inc(outcome="same_content")
+        return cached
+    started = time.perf_counter()
+    try:
+        with PARSE_SECONDS.time():
+            # Разбор HTML выполняем в отдельном потоке, чтобы не задерживать другие обработчики
+            if in_thread:
+                results, next_page = await asyncio.to_thread(parse_search_page, html, drug_name, city_name)
+            else:
+                results, next_page = parse_search_page(html, drug_name, city_name)
+    except Exception:
+        ERRORS.inc(stage="parse")
+        raise
+    if timings is not None:
+        timings["parse"] = timings.get("parse", 0.0) + time.perf_counter() - started
+    PAGE_REUSE.inc(outcome="parsed")
+    page_cache.put(url, response, digest, results, next_page)
+    return results, next_page
+
+# Ленивый обход страниц результатов поиска: следующая страница загружается и разбирается, только когда
+# вызывающий дочитал предыдущую, поэтому прерванный обход не тратит запросов на ненужные страницы.
+# Не больше search_max_pages страниц; timings (словарь) накапливает время разбора, если передан
+async def iter_search_pages(drug_name, city_name=None, in_thread=True, timings=None):
+    url = build_search_url(drug_name, city_name)
+    visited = set()
+    for _ in range(config.get("search_max_pages", 5)):
+        visited.add(url)
+        logger.info(f"Поиск: {drug_name} {f'в {city_name}' if city_name else ''}, URL: {url}")
+        results, next_page = await fetch_search_page(url, drug_name, city_name, in_thread, timings)
+        PAGES.inc()
+        yield results
+        if not results or not next_page:
+            return
+        url = urljoin(url, next_page)
+        if url in visited:
+            return
+
+# Результаты поиска по одному, страницы загружаются по мере чтения
+async def iter_search_results(drug_name, city_name=None):
+    async for page in iter_search_pages(drug_name, city_name):
+        for result in page:
+            yield result
+
+# Сбор результатов с остановкой, как только их достаточно: enough(results) -> True.
+# Возвращает (результаты, полные ли они), неполные результаты не кэшируются
+async def collect_search_results(drug_name, city_name=None, enough=None):
+    results = []
+    complete = True
+    pages = iter_search_pages(drug_name, city_name)
+    try:
+        async for page in pages:
+            results.extend(page)
+            if enough is not None and enough(results):
+                complete = False
+                break
+    finally:
+        await pages.aclose()
+    RESULTS.inc(outcome="found" if results else "not_found")
+    drug_catalog.add(results)
+    return results, complete
+
+# Условия остановки для collect_search_results; key различает неполные результаты в кэше
+def stop_condition(key, check):
+    check.key = key
+    return check
+
+def first_results(count):
+    return stop_condition(("first", count), lambda results: len(results) >= count)
+
+def distinct_names(count):
+    return stop_condition(("names", count), lambda results: len({result["name"] for result in results}) >= count)
+
+# Загрузка и разбор всех страниц поиска без кэша; ошибки загрузки пробрасываются вызывающему как FetchError
+async def fetch_search_results(drug_name, city_name=None):
+    results, _ = await collect_search_results(drug_name, city_name)
+    return results
+
+# Асинхронный поиск лекарств: не блокирует цикл событий бота
+# fresh=True обходит кэш и обновляет его свежими данными.
+# enough — вызывающему нужна только часть результатов (например, first_results(3)): при промахе кэша
+# страницы читаются, пока условие не выполнится
+# Если проверить не удалось, поднимается FetchError: пустой список означает только "не найдено"
+async def search_drugs_async(drug_name, city_name=None, fresh=False, enough=None):
+    try:
+        if fresh:
+            return await search_cache.refresh(drug_name, city_name, fetch_search_results)
+        if enough is not None:
+            # Если страницы кончились раньше условия, результаты полные — сохраняем и как полную запись
+            async def fetch_enough(drug_name, city_name):
+                results, complete = await collect_search_results(drug_name, city_name, enough)
+                if complete:
+                    search_cache.put(SearchCache.make_key(drug_name, city_name), results)
+                return results
+            return await search_cache.get_or_fetch(drug_name, city_name, fetch_enough, variant=enough.key)
+        return await search_cache.get_or_fetch(drug_name, city_name, fetch_search_results)
+    except FetchError as e:
+        logger.warning(f"Не удалось выполнить поиск {drug_name} {f'в {city_name}' if city_name else ''}: {e}")
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при поиске {drug_name} {f'в {city_name}' if city_name else ''}: {e}")
+        raise FetchError(str(e)) from e
+
+# Набор населённых пунктов Украины (собирается build_cities.py) и кеш построенного по нему индекса
+CITIES_DATASET_PATH = config.get(
+    "cities_dataset", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ua_settlements.tsv")
+)
+CITY_INDEX_CACHE_PATH = os.path.join(os.path.dirname(CONFIG_PATH), "cities.idx")
+CITY_INDEX_VERSION = 2
+
+# Транслитерация в упрощённый латинский "скелет": украинское, русское и латинское написание
+# одного названия (Харків, Харьков, Kharkiv, Kharkov; Парацетамол, Paracetamol) дают одинаковые или близкие ключи
+NAME_TRANSLIT = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'h', 'ґ': 'g', 'д': 'd', 'е': 'e', 'є': 'ie', 'ё': 'e', 'ж': 'zh',
+    'з': 'z', 'и': 'y', 'і': 'i', 'ї': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o',
+    'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh',
+    'щ': 'shch', 'ь': '', 'ъ': '', 'ы': 'y', 'э': 'e', 'ю': 'iu', 'я': 'ia', "'": '', '-': ' '
+})
+NAME_SKELETON_RULES = [
+    ("shch", "s"), ("sch", "s"), ("kh", "h"), ("zh", "z"), ("ts", "c"), ("tz", "c"), ("ch", "c"),
+    ("sh", "s"), ("g", "h"), ("j", "i"), ("y", "i"), ("w", "v"), ("x", "ks"), ("q", "k")
+]
+
+def name_skeleton(text):
+    text = normalize_query(text).translate(NAME_TRANSLIT)
+    for old, new in NAME_SKELETON_RULES:
+        text = text.replace(old, new)
+    text = re.sub(r"[^a-z0-9 ]", "", text)
+    # Удвоенные буквы (Kyiiv, Одесса) не различаем
+    text = re.sub(r"(.)\1+", r"\1", text)
+    return " ".join(text.split())
+
+# Расстояние Левенштейна с отсечением: больше limit не считаем
+def edit_distance(a, b, limit):
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+# Индекс населённых пунктов: отсортированные ключи для поиска по префиксу (bisect)
+# и триграммы для поиска с опечатками. Строится один раз при первом поиске и кешируется на диске
+class CityIndex:
+    def __init__(self, rows):
+        # rows: список (название, область, население, варианты написания)
+        self.entries = [(name, region, population) for name, region, population, _ in rows]
+        pairs = set()
+        for entry_id, (name, _, _, aliases) in enumerate(rows):
+            for alias in [name, *aliases]:
+                pairs.update(self._entry_keys(alias, entry_id))
+        pairs = sorted(pairs)
+        self.keys = [key for key, _, _ in pairs]
+        self.key_entries = [entry_id for _, entry_id, _ in pairs]
+        # Ключ с начала слова внутри названия (Подільський в Кам'янець-Подільський) ранжируется ниже
+        self.key_inner = [inner for _, _, inner in pairs]
+        self.trigrams = {}
+        for position, key in enumerate(self.keys):
+            for trigram in self._trigrams(key):
+                self.trigrams.setdefault(trigram, []).append(position)
+        # Для коротких префиксов заранее выбираем самые крупные пункты, чтобы не перебирать тысячи ключей
+        self.top_by_prefix = {}
+        for position, key in enumerate(self.keys):
+            for length in (1, 2):
+                if len(key) >= length:
+                    self.top_by_prefix.setdefault(key[:length], set()).add(self.key_entries[position])
+        for prefix, ids in self.top_by_prefix.items():
+            self.top_by_prefix[prefix] = heapq.nsmallest(20, ids, key=self._order)
+
+    @staticmethod
+    def _entry_keys(alias, entry_id):
+        key = name_skeleton(alias)
+        if not key:
+            return []
+        words = key.split(" ")
+        keys = [(key, entry_id, False)]
+        keys.extend((" ".join(words[i:]), entry_id, True) for i in range(1, len(words)))
+        return keys
+
+    @staticmethod
+    def _trigrams(key):
+        padded = f" {key} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def _order(self, entry_id):
+        name, _, population = self.entries[entry_id]
+        return (-population, name)
+
+    @classmethod
+    def from_tsv(cls, path):
+        rows = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("#") or not line.strip():
+                    continue
+                name, region, population, aliases = line.rstrip("\n").split("\t")
+                rows.append((name, region, int(population or 0), [alias for alias in aliases.split("|") if alias]))
+        return cls(rows)
+
+    def search(self, pattern, limit=10):
+        query = name_skeleton(pattern)
+        if not query:
+            return []
+        ranks = {}
+
+        def consider(entry_id, rank):
+            if rank < ranks.get(entry_id, 99):
+                ranks[entry_id] = rank
+
+        # Точное совпадение и префикс
+        if len(query) <= 2:
+            lo = bisect.bisect_left(self.keys, query)
+            if lo < len(self.keys) and self.keys[lo] == query:
+                consider(self.key_entries[lo], 0)
+            for entry_id in self.top_by_prefix.get(query, []):
+                consider(entry_id, 1)
+        else:
+            position = bisect.bisect_left(self.keys, query)
+            while position < len(self.keys) and self.keys[position].startswith(query):
+                exact = self.keys[position] == query
+                consider(self.key_entries[position], (0 if exact else 1) + (2 if self.key_inner[position] else 0))
+                position += 1
+
+        # Опечатки: кандидаты по общим триграммам, затем ограниченное расстояние Левенштейна
+        # (сравниваем и с ключом целиком, и с его началом той же длины — для недописанных названий)
+        # Если название введено точно, подсказки с опечатками не нужны
+        if len(ranks) < limit and len(query) >= 3 and 0 not in ranks.values():
+            allowed = 1 if len(query) <= 5 else 2 if len(query) <= 9 else 3
+            query_trigrams = self._trigrams(query)
+            shared = collections.Counter(itertools.chain.from_iterable(self.trigrams.get(trigram, ()) for trigram in query_trigrams))
+            # Каждая правка портит не больше трёх триграмм — остальных кандидатов можно не проверять
+            needed = len(query_trigrams) - 3 * allowed
+            for position, count in shared.most_common(20):
+                if count < needed:
+                    break
+                key = self.keys[position]
+                distance = min(
+                    edit_distance(query, key, allowed),
+                    edit_distance(query, key[:len(query)], allowed) + 1
+                )
+                if distance <= allowed:
+                    consider(self.key_entries[position], 4 + distance + (2 if self.key_inner[position] else 0))
+
+        # Сайт ищет аптеки по названию города без области, поэтому одноимённые пункты — один вариант
+        # выбора (с лучшим рангом, затем самый крупный), и область у него не показывается
+        best = {}
+        for entry_id in sorted(ranks, key=lambda entry_id: (ranks[entry_id], self._order(entry_id))):
+            name = self.entries[entry_id][0]
+            if name in best:
+                best[name]["region"] = ""
+            elif len(best) < limit:
+                best[name] = self.city(entry_id)
+        return list(best.values())
+
+    def city(self, entry_id):
+        if not 0 <= entry_id < len(self.entries):
+            return None
+        name, region, population = self.entries[entry_id]
+        return {"id": entry_id, "name": name, "region": region, "population": population}
+
+_city_index = None
+_city_index_lock = threading.Lock()
+
+# Загрузка индекса: из кеша на диске, если набор не менялся, иначе сборка из TSV.
+# Без набора данных — индекс по встроенному списку основных городов
+def load_city_index():
+    try:
+        stat = os.stat(CITIES_DATASET_PATH)
+    except OSError:
+        logger.warning(f"Набор населённых пунктов {CITIES_DATASET_PATH} не найден, используется встроенный список")
+        return CityIndex([
+            (city, "", len(UKRAINE_CITIES) - i, []) for i, city in enumerate(UKRAINE_CITIES)
+        ])
+    signature = (CITY_INDEX_VERSION, stat.st_size, stat.st_mtime_ns)
+    try:
+        with open(CITY_INDEX_CACHE_PATH, "rb") as f:
+            cached_signature, state = pickle.load(f)
+        if cached_signature == signature:
+            index = CityIndex.__new__(CityIndex)
+            index.__dict__.update(state)
+            return index
+    except Exception:
+        pass
+    started = time.perf_counter()
+    index = CityIndex.from_tsv(CITIES_DATASET_PATH)
+    logger.info(f"Индекс городов построен: {len(index.entries)} пунктов за {time.perf_counter() - started:.2f} с")
+    try:
+        tmp_path = CITY_INDEX_CACHE_PATH + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((signature, index.__dict__), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, CITY_INDEX_CACHE_PATH)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить индекс городов: {e}")
+    return index
+
+def get_city_index():
+    global _city_index
+    if _city_index is None:
+        with _city_index_lock:
+            if _city_index is None:
+                _city_index = load_city_index()
+    return _city_index
+
+# Функция для поиска городов по шаблону: не более 10 пунктов, сначала точные совпадения и крупные города
+def search_cities(city_pattern):
+    try:
+        return get_city_index().search(city_pattern, limit=10)
+    except Exception as e:
+        logger.error(f"Ошибка при поиске городов: {e}")
+        return []
+
+# Каталог названий препаратов, накопленный из всех результатов поиска: подсказки при вводе названия
+# и в inline-режиме без запроса к сайту. В отличие от индекса городов каталог пополняется на ходу,
+# поэтому отсортированный список ключей поддерживается через bisect.insort
+class DrugCatalog:
+    # Ранги: 0 — точное совпадение, 1 — префикс, 2-3 — то же с начала слова внутри названия, от FUZZY — опечатки
+    FUZZY = 4
+    # Сколько ключей префиксного диапазона просматривать для коротких запросов ("па")
+    MAX_PREFIX_SCAN = 3000
+    UNNAMED = "Без назви"
+
+    def __init__(self, storage, flush_seconds=60, flush_batch=500):
+        self.storage = storage
+        self.flush_seconds = flush_seconds
+        self.flush_batch = flush_batch
+        self.names = []
+        self.hits = []
+        self.skeletons = []
+        self._ids = {}
+        # Отсортированные (ключ, id, ключ начинается внутри названия)
+        self._keys = []
+        self._trigrams = {}
+        self._dirty = set()
+        self._flushed = time.monotonic()
+        self._loaded = False
+        self._lock = threading.Lock()
+        # Наборы названий из результатов, полученных до окончания загрузки
+        self._pending = []
+        self.lookups = {"hit": 0, "miss": 0, "loading": 0}
+
+    # Загрузка из базы; вызывается в отдельном потоке при запуске. Обращения из цикла событий её
+    # не ждут: до окончания загрузки поиск ничего не находит, а новые названия откладываются
+    def load(self, rows=None):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            started = time.perf_counter()
+            keys = []
+            for name, hits in (self.storage.catalog_names() if rows is None else rows):
+                keys.extend(self._register(name, hits))
+            keys.sort()
+            self._keys = keys
+            self._loaded = True
+            logger.info(f"Каталог препаратов загружен: {len(self.names)} названий за {time.perf_counter() - started:.2f} с")
+
+    def _register(self, name, hits):
+        drug_id = len(self.names)
+        key = name_skeleton(name)
+        self.names.append(name)
+        self.hits.append(hits)
+        self.skeletons.append(key)
+        self._ids[name] = drug_id
+        if not key:
+            return []
+        words = key.split(" ")
+        # Триграммы только первых двух слов: опечатки ищем в названии, а не в дозировке и фасовке
+        for trigram in CityIndex._trigrams(" ".join(words[:2])):
+            self._trigrams.setdefault(trigram, []).append(drug_id)
+        return [(" ".join(words[i:]), drug_id, i > 0) for i in range(len(words))]
+
+    # Пополнение каталога названиями из результатов поиска; запись в базу — пачками
+    def add(self, results):
+        self._pending.append({result.get("name") for result in results})
+        if not self._loaded:
+            return
+        batches, self._pending = self._pending, []
+        for names in batches:
+            for name in names:
+                if not name or name == self.UNNAMED:
+                    continue
+                drug_id = self._ids.get(name)
+                if drug_id is None:
+                    keys = self._register(name, 0)
+                    drug_id = len(self.names) - 1
+                    for key in keys:
+                        bisect.insort(self._keys, key)
+                self.hits[drug_id] += 1
+                self._dirty.add(drug_id)
+        if len(self._dirty) >= self.flush_batch or (self._dirty and time.monotonic() - self._flushed > self.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        if self._dirty:
+            self.storage.save_catalog([(self.names[drug_id], self.hits[drug_id]) for drug_id in self._dirty])
+            self._dirty.clear()
+        self._flushed = time.monotonic()
+
+    # Поиск названий: список (название, ранг), сначала лучшие совпадения и часто встречающиеся препараты
+    def search(self, pattern, limit=10):
+        # Пока каталог загружается, вызывающий поступает как с пустым каталогом — ищет на сайте
+        if not self._loaded:
+            self.lookups["loading"] += 1
+            return []
+        query = name_skeleton(pattern)
+        if len(query) < 2:
+            return []
+        ranks = {}
+
+        def consider(drug_id, rank):
+            if rank < ranks.get(drug_id, 99):
+                ranks[drug_id] = rank
+
+        position = bisect.bisect_left(self._keys, (query,))
+        end = min(len(self._keys), position + self.MAX_PREFIX_SCAN)
+        while position < end and self._keys[position][0].startswith(query):
+            key, drug_id, inner = self._keys[position]
+            consider(drug_id, (0 if key == query else 1) + (2 if inner else 0))
+            position += 1
+
+        # Опечатки — как в индексе городов: кандидаты по общим триграммам, затем расстояние Левенштейна
+        # с первыми словами названия и с его началом той же длины
+        if len(ranks) < limit and len(query) >= 3:
+            query_words = query.count(" ") + 1
+            allowed = 1 if len(query) <= 5 else 2 if len(query) <= 9 else 3
+            query_trigrams = CityIndex._trigrams(query)
+            shared = collections.Counter(itertools.chain.from_iterable(self._trigrams.get(trigram, ()) for trigram in query_trigrams))
+            needed = len(query_trigrams) - 3 * allowed
+            for drug_id, count in shared.most_common(50):
+                if count < needed:
+                    break
+                if drug_id in ranks:
+                    continue
+                key = self.skeletons[drug_id]
+                distance = min(
+                    edit_distance(query, " ".join(key.split(" ")[:query_words]), allowed),
+                    edit_distance(query, key[:len(query)], allowed)
+                )
+                if distance <= allowed:
+                    consider(drug_id, self.FUZZY + distance)
+
+        best = sorted(ranks, key=lambda drug_id: (ranks[drug_id], -self.hits[drug_id], self.names[drug_id]))[:limit]
+        self.lookups["hit" if best else "miss"] += 1
+        return [(self.names[drug_id], ranks[drug_id]) for drug_id in best]
+
+drug_catalog = None
+
+metrics.register(Gauge("de_liky_catalog_names", "Названий в каталоге препаратов", lambda: len(drug_catalog.names)))
+metrics.register(Counter("de_liky_catalog_lookups_total", "Поиски по каталогу препаратов", ("result",), func=lambda: [
+    ({"result": result}, count) for result, count in drug_catalog.lookups.items()
+]))
+
+# Асинхронная проверка наличия препарата в конкретном городе; FetchError — проверить не удалось
+async def check_drug_availability_async(drug_name, city_name, fresh=False, enough=None):
+    return await search_drugs_async(drug_name, city_name, fresh=fresh, enough=enough)
+
+# Текст с сайта или от пользователя для сообщения с parse_mode="Markdown": "_", "*", "`" и "["
+# в названиях иначе ломают разметку, и Telegram отклоняет сообщение целиком
+def md(text):
+    return escape_markdown(str(text), version=1)
+
+# Список до 3 аптек с ценами для сообщения
+def format_top_results(results):
+    text = ""
+    for i, result in enumerate(results[:3]):
+        text += f"{i+1}. {md(result['name'])}\n   💰 {md(result['price'])}\n   🏥 {md(result['pharmacy'])}\n\n"
+    return text
+
+# Цена в копейках из строки вида "1 234,50 грн"; None, если цену разобрать не удалось
+def parse_price_kopecks(price):
+    match = re.search(r"(\d[\d\s\u00a0]*)(?:[.,](\d{1,2}))?", price or "")
+    if not match:
+        return None
+    hryvnias = int(re.sub(r"\D", "", match.group(1)))
+    kopecks = int((match.group(2) or "0").ljust(2, "0"))
+    return hryvnias * 100 + kopecks
+
+# Компактный отпечаток результатов поиска: хэш набора (аптека, цена), минимальная цена и список аптек
+def availability_snapshot(results):
+    offers = sorted({(result["pharmacy"], result["price"]) for result in results})
+    digest = hashlib.blake2b(json.dumps(offers, ensure_ascii=False).encode("utf-8"), digest_size=8).hexdigest()
+    prices = [price for price in (parse_price_kopecks(result["price"]) for result in results) if price is not None]
+    return {
+        "fingerprint": digest,
+        "min_price": min(prices) if prices else None,
+        "pharmacies": sorted({pharmacy for pharmacy, _ in offers})
+    }
+
+# Сравнение отпечатков: появление, исчезновение, снижение цены, новые аптеки
+def detect_changes(old, new):
+    was_available = bool(old and old["pharmacies"])
+    is_available = bool(new["pharmacies"])
+    if not was_available:
+        return [("appeared",)] if is_available else []
+    if not is_available:
+        return [("disappeared",)]
+    
+    changes = []
+    if old["min_price"] is not None and new["min_price"] is not None and new["min_price"] < old["min_price"]:
+        changes.append(("price_drop", old["min_price"], new["min_price"]))
+    new_pharmacies = sorted(set(new["pharmacies"]) - set(old["pharmacies"]))
+    if new_pharmacies:
+        changes.append(("new_pharmacy", new_pharmacies))
+    return changes
+
+# Цена в копейках в виде строки "1234.50"
+def format_kopecks(kopecks):
+    return f"{kopecks // 100}.{kopecks % 100:02d}"
+
+# Текст уведомления об изменениях наличия препарата
+def format_change_message(drug_name, city_name, changes, results):
+    drug_name, city_name = md(drug_name), md(city_name)
+    kinds = {change[0] for change in changes}
+    if "disappeared" in kinds:
+        return f"❌ *{drug_name}* більше немає в наявності у місті *{city_name}*."
+    if "appeared" in kinds:
+        return f"💊 *{drug_name}* з'явився у місті *{city_name}*!\n\n" + format_top_results(results)
+    
+    message = ""
+    for change in changes:
+        if change[0] == "price_drop":
+            message += f"📉 Ціна на *{drug_name}* у місті *{city_name}* знизилась: {format_kopecks(change[1])} → {format_kopecks(change[2])} грн\n"
+        elif change[0] == "new_pharmacy":
+            message += f"🏥 *{drug_name}* з'явився в нових аптеках у місті *{city_name}*: {', '.join(md(pharmacy) for pharmacy in change[1][:5])}\n"
+    return message + "\n" + format_top_results(results)
+
+# История цен и наличия по парам (препарат, город). Наблюдения хранятся по столбцам в типизированных
+# массивах (array): цены — целые копейки, аптеки — числовые id, одно наблюдение — 20 байт до сжатия zlib.
+# Старые наблюдения прореживаются: все проверки за history_raw_days, затем одна запись за день,
+# после history_daily_days — за неделю; старше history_retention_days удаляются
+class PriceHistory:
+    COLUMNS = (
+        ("time", "I"), ("tier", "B"), ("min", "I"), ("median", "I"),
+        ("offers", "H"), ("pharmacy", "I"), ("available", "B")
+    )
+    HEADER = struct.Struct("<BII")  # версия, число наблюдений, время последнего прореживания
+    VERSION = 1
+    RAW, DAILY, WEEKLY = 0, 1, 2
+    DAY = 86400
+    SPANS = {DAILY: DAY, WEEKLY: 7 * DAY}
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.raw_days = config.get("history_raw_days", 7)
+        self.daily_days = config.get("history_daily_days", 90)
+        self.retention_days = config.get("history_retention_days", 365)
+        self._pharmacy_ids = {}
+
+    @classmethod
+    def empty(cls):
+        return {name: array.array(code) for name, code in cls.COLUMNS}
+
+    @classmethod
+    def encode(cls, columns, compacted):
+        header = cls.HEADER.pack(cls.VERSION, len(columns["time"]), compacted)
+        return zlib.compress(header + b"".join(columns[name].tobytes() for name, _ in cls.COLUMNS))
+
+    @classmethod
+    def decode(cls, data):
+        payload = zlib.decompress(data)
+        _, count, compacted = cls.HEADER.unpack_from(payload)
+        offset = cls.HEADER.size
+        columns = {}
+        for name, code in cls.COLUMNS:
+            column = array.array(code)
+            size = column.itemsize * count
+            column.frombytes(payload[offset:offset + size])
+            offset += size
+            columns[name] = column
+        return columns, compacted
+
+    def load(self, key):
+        data = self.storage.get_history(key)
+        return self.decode(data) if data else (self.empty(), 0)
+
+    def pharmacy_id(self, name):
+        pharmacy_id = self._pharmacy_ids.get(name)
+        if pharmacy_id is None:
+            pharmacy_id = self._pharmacy_ids[name] = self.storage.intern_pharmacy(name)
+        return pharmacy_id
+
+    # Новое наблюдение по результатам проверки; раз в сутки запись заодно прореживается
+    def observe(self, key, results, now=None):
+        now = int(now or time.time())
+        offers = {}
+        for result in results:
+            price = parse_price_kopecks(result["price"])
+            if price is not None and price < offers.get(result["pharmacy"], price + 1):
+                offers[result["pharmacy"]] = price
+        prices = sorted(offers.values())
+        cheapest = min(offers, key=offers.get) if offers else None
+        row = (
+            now, self.RAW, prices[0] if prices else 0, prices[len(prices) // 2] if prices else 0,
+            min(len(offers), 65535), self.pharmacy_id(cheapest) if cheapest else 0, 100 if results else 0
+        )
+        columns, compacted = self.load(key)
+        for (name, _), value in zip(self.COLUMNS, row):
+            columns[name].append(value)
+        if now - compacted >= self.DAY:
+            columns = self.downsample(columns, now)
+            compacted = now
+        self.storage.save_history(key, self.encode(columns, compacted))
+
+    # Объединение наблюдений за день или неделю: минимальная цена, медиана медиан, наибольшее число аптек,
+    # доля проверок с наличием
+    def _merge(self, rows, tier, start):
+        priced = [row for row in rows if row[2]]
+        cheapest = min(priced, key=lambda row: row[2]) if priced else None
+        medians = sorted(row[3] for row in priced)
+        return (
+            start, tier, cheapest[2] if cheapest else 0, medians[len(medians) // 2] if medians else 0,
+            max(row[4] for row in rows), cheapest[5] if cheapest else 0,
+            round(sum(row[6] for row in rows) / len(rows))
+        )
+
+    # Прореживание: день (неделя) объединяется целиком, когда весь он старше порога
+    def downsample(self, columns, now):
+        raw_cutoff = now - self.raw_days * self.DAY
+        daily_cutoff = now - self.daily_days * self.DAY
+        expired = now - self.retention_days * self.DAY
+        kept = []
+        buckets = {}
+        for row in zip(*(columns[name] for name, _ in self.COLUMNS)):
+            moment, tier = row[0], row[1]
+            if moment < expired:
+                continue
+            target = tier
+            week = moment - moment % self.SPANS[self.WEEKLY]
+            day = moment - moment % self.DAY
+            if tier < self.WEEKLY and week + self.SPANS[self.WEEKLY] <= daily_cutoff:
+                target, start = self.WEEKLY, week
+            elif tier < self.DAILY and day + self.DAY <= raw_cutoff:
+                target, start = self.DAILY, day
+            if target == tier:
+                kept.append(row)
+            else:
+                buckets.setdefault((start, target), []).append(row)
+        kept.extend(self._merge(rows, target, start) for (start, target), rows in buckets.items())
+        kept.sort(key=lambda row: row[0])
+        compacted = self.empty()
+        for row in kept:
+            for (name, _), value in zip(self.COLUMNS, row):
+                compacted[name].append(value)
+        return compacted
+
+    # Периодическое обслуживание: прореживание всех записей и удаление истории пар,
+    # которые не обновлялись дольше срока хранения
+    async def maintain(self):
+        now = int(time.time())
+        removed = self.storage.delete_stale_history(now - self.retention_days * self.DAY)
+        for i, key in enumerate(self.storage.history_keys()):
+            columns, compacted = self.load(key)
+            if now - compacted >= self.DAY:
+                self.storage.save_history(key, self.encode(self.downsample(columns, now), now))
+            if i % 100 == 0:
+                await asyncio.sleep(0)
+        size = self.storage.history_size()
+        logger.info(f"История цен: {size['items']} пар, {size['bytes'] / 1024:.0f} КБ на диске, удалено {removed}")
+
+    # Сводка для /history: последнее наблюдение и статистика за периоды, дневные минимумы за 30 дней
+    def summary(self, key, now=None):
+        now = int(now or time.time())
+        columns, _ = self.load(key)
+        if not columns["time"]:
+            return None
+        rows = list(zip(*(columns[name] for name, _ in self.COLUMNS)))
+        last = rows[-1]
+        periods = []
+        for days in (7, 30, 365):
+            recent = [row for row in rows if row[0] >= now - days * self.DAY]
+            priced = sorted(row[3] for row in recent if row[3])
+            periods.append({
+                "days": days,
+                "min": min((row[2] for row in recent if row[2]), default=None),
+                "median": priced[len(priced) // 2] if priced else None,
+                "available": round(sum(row[6] for row in recent) / len(recent)) if recent else None
+            })
+        daily = {}
+        for row in rows:
+            if row[2] and row[0] >= now - 30 * self.DAY:
+                day = (now - row[0]) // self.DAY
+                daily[day] = min(daily.get(day, row[2]), row[2])
+        trend = [daily.get(day) for day in range(29, -1, -1)]
+        return {
+            "time": last[0], "min": last[2] or None, "offers": last[4], "available": bool(last[6]),
+            "pharmacy": self.storage.pharmacy_name(last[5]) if last[5] else None,
+            "periods": periods, "trend": trend
+        }
+
+price_history = None
+
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+# Мини-график дневных минимальных цен; дни без данных — точка
+def format_sparkline(values):
+    known = [value for value in values if value is not None]
+    if not known:
+        return ""
+    low, high = min(known), max(known)
+    step = (high - low) / (len(SPARK_CHARS) - 1) or 1
+    return "".join("·" if value is None else SPARK_CHARS[round((value - low) / step)] for value in values)
+
+def format_history(drug_name, city_name, summary):
+    text = f"💊 *{md(drug_name)}* у місті *{md(city_name)}*\n"
+    if summary["available"] and summary["min"] is not None:
+        text += f"Зараз: від {format_kopecks(summary['min'])} грн, аптек: {summary['offers']}"
+        if summary["pharmacy"]:
+            text += f" (найдешевше: {md(summary['pharmacy'])})"
+        text += "\n"
+    else:
+        text += "Зараз: немає в наявності\n"
+    for period in summary["periods"]:
+        if period["available"] is None:
+            continue
+        line = f"{period['days']} дн.: "
+        if period["min"] is not None:
+            line += f"мін. {format_kopecks(period['min'])}, медіана {format_kopecks(period['median'])} грн, "
+        text += line + f"в наявності {period['available']}% перевірок\n"
+    sparkline = format_sparkline(summary["trend"])
+    if sparkline:
+        text += f"Мін. ціна за 30 днів: {sparkline}\n"
+    return text
+
+# Максимальная длина сообщения Telegram
+MAX_MESSAGE_LENGTH = 4096
+
+# Разбиение длинного текста на части по границам абзацев, чтобы не разрывать разметку
+def split_message(text, limit=MAX_MESSAGE_LENGTH):
+    parts = []
+    current = ""
+    for paragraph in text.split("\n\n"):
+        while len(paragraph) > limit:
+            cut = paragraph.rfind("\n", 0, limit)
+            cut = cut if cut > 0 else limit
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(paragraph[:cut])
+            paragraph = paragraph[cut:].lstrip("\n")
+        candidate = f"{current}\n\n{paragraph}" if current else paragraph
+        if len(candidate) > limit:
+            parts.append(current)
+            current = paragraph
+        else:
+            current = candidate
+    if current.strip():
+        parts.append(current)
+    return parts
+
+# Диспетчер исходящих уведомлений: объединяет сообщения одного чата в одно,
+# соблюдает общий и поштучный для чата лимиты Telegram и повторяет отправку после RetryAfter.
+# Сообщения одного чата всегда попадают в одну очередь, поэтому приходят по порядку
+class NotificationDispatcher:
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.queues = [asyncio.Queue() for _ in range(config.get("notification_workers", 4))]
+        self.batch_seconds = config.get("notification_batch_seconds", 30)
+        self._pending = {}  # chat_id -> (время первого сообщения, список сообщений)
+        self._global_limiter = RateLimiter(config.get("telegram_messages_per_second", 25), burst=5)
+        self._chat_limiters = {}
+        self._workers = []
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.send_latency_total = 0.0
+        self.send_latency_max = 0.0
+
+    # Добавление уведомления в накопитель чата
+    def add(self, chat_id, text):
+        entry = self._pending.get(chat_id)
+        if entry is None:
+            self._pending[chat_id] = (time.monotonic(), [text])
+        else:
+            entry[1].append(text)
+
+    # Постановка накопленных сообщений в очередь отправки (all=True — всех чатов сразу)
+    def flush(self, all=False):
+        now = time.monotonic()
+        for chat_id, (first_added, texts) in list(self._pending.items()):
+            if all or now - first_added >= self.batch_seconds:
+                del self._pending[chat_id]
+                queue = self.queues[hash(chat_id) % len(self.queues)]
+                for part in split_message("\n\n".join(texts)):
+                    queue.put_nowait((chat_id, part, time.monotonic()))
+
+    def _chat_limiter(self, chat_id):
+        limiter = self._chat_limiters.get(chat_id)
+        if limiter is None:
+            # Удаляем ограничители давно неактивных чатов, чтобы словарь не рос бесконечно
+            if len(self._chat_limiters) > 10000:
+                idle_before = time.monotonic() - 60
+                for key in [key for key, value in self._chat_limiters.items() if value._updated < idle_before]:
+                    del self._chat_limiters[key]
+            limiter = self._chat_limiters[chat_id] = RateLimiter(config.get("telegram_chat_messages_per_second", 1))
+        return limiter
+
+    async def _send(self, chat_id, text):
+        parse_mode = "Markdown"
+        for attempt in range(self.MAX_ATTEMPTS):
+            await self._chat_limiter(chat_id).acquire()
+            await self._global_limiter.acquire()
+            try:
+                with SEND_SECONDS.time():
+                    await self.bot.send_message(chat_id, text, parse_mode=parse_mode)
+                return True
+            except RetryAfter as e:
+                delay = e.retry_after
+                delay = delay.total_seconds() if hasattr(delay, "total_seconds") else delay
+                logger.warning(f"Telegram просит подождать {delay} с перед отправкой в чат {chat_id}")
+                self.retries += 1
+                await asyncio.sleep(delay)
+            except BadRequest as e:
+                # Разметка не разобралась (в сообщении объединены уведомления о нескольких препаратах,
+                # и из-за одного названия пропали бы все) — отправляем тот же текст без разметки
+                if parse_mode is not None and "parse entities" in str(e).lower():
+                    logger.warning(f"Разметка уведомления для чата {chat_id} не разобрана, отправка без неё: {e}")
+                    parse_mode = None
+                    continue
+                ERRORS.inc(stage="send")
+                logger.error(f"Не удалось отправить уведомление в чат {chat_id}: {e}")
+                return False
+            except Forbidden as e:
+                # Пользователь заблокировал бота: повтор не поможет
+                ERRORS.inc(stage="send")
+                logger.error(f"Не удалось отправить уведомление в чат {chat_id}: {e}")
+                return False
+            except NetworkError as e:
+                ERRORS.inc(stage="send")
+                logger.warning(f"Ошибка сети при отправке в чат {chat_id}: {e}")
+                self.retries += 1
+                await asyncio.sleep(min(60, 2 ** attempt) * random.uniform(0.5, 1.5))
+        return False
+
+    async def _worker(self, queue):
+        while True:
+            chat_id, text, enqueued_at = await queue.get()
+            try:
+                if await self._send(chat_id, text):
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                latency = time.monotonic() - enqueued_at
+                self.send_latency_total += latency
+                self.send_latency_max = max(self.send_latency_max, latency)
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Ошибка при отправке уведомления: {e}")
+            finally:
+                queue.task_done()
+
+    async def run(self):
+        self._workers = [asyncio.create_task(self._worker(queue)) for queue in self.queues]
+        try:
+            while True:
+                await asyncio.sleep(1)
+                self.flush()
+        finally:
+            for worker in self._workers:
+                worker.cancel()
+            await asyncio.gather(*self._workers, return_exceptions=True)
+
+    # Отправка всего накопленного перед остановкой бота
+    async def drain(self, timeout=10):
+        self.flush(all=True)
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"При остановке не отправлено {self.queue_depth()} уведомлений")
+
+    def queue_depth(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    def stats(self):
+        delivered = self.sent + self.failed
+        return {
+            "queue_depth": self.queue_depth(),
+            "pending_chats": len(self._pending),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "send_latency_avg": self.send_latency_total / delivered if delivered else 0.0,
+            "send_latency_max": self.send_latency_max
+        }
+
+notification_dispatcher = None
+
+metrics.register(Gauge(
+    "de_liky_scheduler_budget_per_hour", "Бюджет запросов к сайту в час",
+    lambda: check_scheduler.budget if check_scheduler else 0
+))
+metrics.register(Gauge(
+    "de_liky_scheduler_planned_per_hour", "Запланировано запросов к сайту в час",
+    lambda: check_scheduler.planned if check_scheduler else 0
+))
+
+metrics.register(Gauge(
+    "de_liky_notification_queue_depth", "Сообщений в очереди отправки",
+    lambda: notification_dispatcher.queue_depth() if notification_dispatcher else 0
+))
+
+# Функция для отправки уведомления о наличии препарата
+# Если результаты уже получены (например, при общей проверке), повторный запрос не выполняется
+async def notify_drug_available(chat_id, drug_name, city_name, bot, results=None, changes=None):
+    try:
+        if results is None:
+            results = await check_drug_availability_async(drug_name, city_name, enough=first_results(3))
+        if changes is None:
+            changes = [("appeared",)] if results else []
+        if changes:
+            message = format_change_message(drug_name, city_name, changes, results)
+            if notification_dispatcher is not None:
+                notification_dispatcher.add(chat_id, message)
+            else:
+                await bot.send_message(chat_id, message, parse_mode="Markdown")
+            return True
+        return False
+    except Exception as e:
+        logger.error(f"Ошибка при отправке уведомления: {e}")
+        return False
+
+# Команда /list
+async def list_items(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        # Получаем информацию о парах препарат-город для пользователя
+        chat_id = update.effective_chat.id
+        user_tracking = tracking_state.snapshot.entries(chat_id)
+        
+        if not user_tracking:
+            await update.message.reply_text("У вас ще немає препаратів для відстеження.")
+            return
+        
+        text = "*Відстежувані препарати:*\n\n"
+        
+        for i, item in enumerate(user_tracking):
+            text += f"{i+1}. 💊 *{md(item.drug)}* у місті 🏙️ *{md(item.city)}*\n"
+        
+        # Кнопки удаления ссылаются на id записи, а не на позицию в списке: список может измениться,
+        # пока сообщение открыто
+        keyboard = []
+        for item in user_tracking:
+            keyboard.append([InlineKeyboardButton(f"❌ {item.drug} ({item.city})", callback_data=f"untrack:{item.id}")])
+        
+        markup = InlineKeyboardMarkup(keyboard)
+        await update.message.reply_text(text, parse_mode="Markdown", reply_markup=markup)
+    except Exception as e:
+        ERRORS.inc(stage="handler")
+        logger.error(f"Ошибка в команде list: {e}")
+        await update.message.reply_text("Виникла помилка при отриманні списку.")
+
+# Команда /settings
+async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        keyboard = [
+            [InlineKeyboardButton("1 година", callback_data="interval:1")],
+            [InlineKeyboardButton("3 години", callback_data="interval:3")],
+            [InlineKeyboardButton("6 годин", callback_data="interval:6")],
+            [InlineKeyboardButton("12 годин", callback_data="interval:12")],
+            [InlineKeyboardButton("24 години", callback_data="interval:24")],
+            [InlineKeyboardButton("🤖 Автоматично", callback_data="interval:0")]
+        ]
+        markup = InlineKeyboardMarkup(keyboard)
+        chat_id = update.effective_chat.id
+        hours = tracking_state.snapshot.intervals.get(chat_id)
+        current = f"кожні {hours:g} годин" if hours else "автоматично"
+        await update.message.reply_text(
+            "⏰ Препарати, наявність яких часто змінюється, перевіряються частіше, стабільні — рідше. "
+            "Бажаний інтервал виконується, наскільки дозволяє обмеження кількості запитів до сайту.\n\n"
+            f"Ваш бажаний інтервал перевірки: {current}.{interval_delay_note(chat_id, hours)}\n\nОберіть новий інтервал:",
+            reply_markup=markup
+        )
+    except Exception as e:
+        ERRORS.inc(stage="handler")
+        logger.error(f"Ошибка в команде settings: {e}")
+        await update.message.reply_text("Виникла помилка при налаштуванні інтервалу.")
+
+# Пояснение, если из-за бюджета запросов препараты чата проверяются реже желаемого интервала
+def interval_delay_note(chat_id, hours):
+    if not hours or check_scheduler is None:
+        return ""
+    actual = check_scheduler.chat_interval_hours(chat_id)
+    if actual is None or actual <= hours * 1.05:
+        return ""
+    return (
+        f"\n\n⚠️ Зараз через обмеження навантаження на сайт ваші препарати перевіряються "
+        f"приблизно кожні {actual:.1f} год."
+    )
+
+# Команда /check
+async def check_now(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        chat_id = update.effective_chat.id
+        user_tracking = tracking_state.snapshot.entries(chat_id)
+        
+        if not user_tracking:
+            await update.message.reply_text("У вас ще немає препаратів для відстеження.")
+            return
+        
+        progress = await update.message.reply_text("🔎 Виконується перевірка наявності препаратів...")
+        
+        # Препараты пользователя проверяются параллельно, но не более check_now_concurrency одновременно
+        semaphore = asyncio.Semaphore(config.get("check_now_concurrency", 5))
+        
+        # None — проверить не удалось (сайт недоступен), это не то же самое, что "не знайдено"
+        async def check_item(index, item):
+            async with semaphore:
+                try:
+                    return index, await check_drug_availability_async(
+                        item.drug, item.city, enough=first_results(3)
+                    )
+                except FetchError:
+                    return index, None
+        
+        statuses = ["⏳"] * len(user_tracking)
+        found = {}
+        failed = 0
+        last_edit = 0
+        done = 0
+        for next_result in asyncio.as_completed([check_item(i, item) for i, item in enumerate(user_tracking)]):
+            index, results = await next_result
+            done += 1
+            if results is None:
+                statuses[index] = "⚠️"
+                failed += 1
+            else:
+                statuses[index] = "✅" if results else "❌"
+            if results:
+                found[index] = results
+            
+            # Прогресс обновляется в том же сообщении, но не чаще раза в секунду (лимит Telegram на правки)
+            if done < len(user_tracking) and time.monotonic() - last_edit >= config.get("progress_edit_interval", 1.0):
+                last_edit = time.monotonic()
+                await edit_progress(progress, format_check_progress(user_tracking, statuses, done))
+        
+        await edit_progress(progress, format_check_progress(user_tracking, statuses, done))
+        
+        if failed:
+            await update.message.reply_text(
+                f"⚠️ Не вдалося перевірити {failed} з {len(user_tracking)}: сайт tabletki.ua зараз не відповідає. "
+                "Спробуйте пізніше."
+            )
+        if not found:
+            if failed < len(user_tracking):
+                await update.message.reply_text("❌ Жодних відстежуваних препаратів не знайдено в обраних містах.")
+            return
+        
+        # Все найденные препараты — одним сообщением (или несколькими, если не помещается)
+        messages = []
+        for index in sorted(found):
+            drug = user_tracking[index].drug
+            city = user_tracking[index].city
+            messages.append(f"💊 *{md(drug)}* доступний у місті *{md(city)}*!\n\n" + format_top_results(found[index]))
+        for part in split_message("\n\n".join(messages)):
+            await update.message.reply_text(part, parse_mode="Markdown")
+    except Exception as e:
+        ERRORS.inc(stage="handler")
+        logger.error(f"Ошибка в команде check: {e}")
+        await update.message.reply_text("Виникла помилка при перевірці наявності ліків.")
+
+# Текст сообщения о ходе проверки: статус каждого препарата
+def format_check_progress(user_tracking, statuses, done):
+    title = "🔎 Перевірка завершена" if done == len(user_tracking) else "🔎 Перевірка наявності"
+    lines = [f"{title}: {done}/{len(user_tracking)}", ""]
+    for item, status in zip(user_tracking, statuses):
+        lines.append(f"{status} {item.drug} ({item.city})")
+    return split_message("\n".join(lines))[0]
+
+# Правка сообщения о ходе проверки; ошибки правки не должны прерывать проверку
+async def edit_progress(message, text):
+    try:
+        await message.edit_text(text)
+    except BadRequest as e:
+        # "Message is not modified" и подобные ошибки не критичны
+        logger.debug(f"Не удалось обновить сообщение о проверке: {e}")
+
+# Состояние диалога пользователя: чего бот ждёт, выбранный препарат и короткие id названий для кнопок
+# (callback_data — не больше 64 байт, полное название препарата туда часто не помещается)
+class Session:
+    __slots__ = ("waiting_for", "selected_drug", "choices", "touched")
+
+    def __init__(self):
+        self.waiting_for = None
+        self.selected_drug = None
+        self.choices = {}  # короткий id -> название
+        self.touched = time.monotonic()
+
+# Хранилище сессий: TTL и вытеснение LRU, как в кэше результатов. Сессии лежат в порядке последнего
+# обращения, поэтому истёкшие всегда в начале и удаляются за O(1) на обращение. Число сессий
+# и число запомненных названий в сессии ограничены, поэтому память не растёт со временем
+class SessionStore:
+    def __init__(self, ttl_seconds, max_sessions, max_choices):
+        self.ttl = ttl_seconds
+        self.max_sessions = max_sessions
+        self.max_choices = max_choices
+        self._sessions = OrderedDict()  # chat_id -> Session
+        self.expired = 0
+        self.evicted = 0
+
+    def _evict(self, now):
+        while self._sessions:
+            chat_id, session = next(iter(self._sessions.items()))
+            if now - session.touched >= self.ttl:
+                self.expired += 1
+            elif len(self._sessions) > self.max_sessions:
+                self.evicted += 1
+            else:
+                break
+            del self._sessions[chat_id]
+
+    # Сессия чата (новая, если её нет или она истекла)
+    def get(self, chat_id):
+        now = time.monotonic()
+        session = self._sessions.get(chat_id)
+        if session is None or now - session.touched >= self.ttl:
+            session = self._sessions[chat_id] = Session()
+        session.touched = now
+        self._sessions.move_to_end(chat_id)
+        self._evict(now)
+        return session
+
+    def drop(self, chat_id):
+        self._sessions.pop(chat_id, None)
+
+    # Короткий id названия для callback_data; старые id вытесняются. id случайный, а не порядковый:
+    # кнопка из списка прошлой (удалённой или истёкшей) сессии не должна совпасть с id в новой сессии
+    # и выбрать другой препарат — такая кнопка просто не найдётся
+    def remember(self, session, name):
+        choice_id = secrets.token_hex(4)
+        while choice_id in session.choices:
+            choice_id = secrets.token_hex(4)
+        session.choices[choice_id] = name
+        while len(session.choices) > self.max_choices:
+            del session.choices[next(iter(session.choices))]
+        return choice_id
+
+    @staticmethod
+    def lookup(session, choice_id):
+        return session.choices.get(choice_id)
+
+    def __len__(self):
+        return len(self._sessions)
+
+sessions = SessionStore(
+    ttl_seconds=config.get("session_ttl_minutes", 60) * 60,
+    max_sessions=config.get("session_max", 10000),
+    max_choices=config.get("session_max_choices", 40)
+)
+
+metrics.register(Gauge("de_liky_sessions", "Активные сессии пользователей", lambda: len(sessions)))
+metrics.register(Counter("de_liky_sessions_removed_total", "Удалённые сессии пользователей", ("reason",), func=lambda: [
+    ({"reason": "expired"}, sessions.expired),
+    ({"reason": "evicted"}, sessions.evicted)
+]))
+
+# Поиск препаратов по тексту и показ вариантов выбора
+async def search_and_show_drugs(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+    try:
+        # Сначала локальный каталог названий; сайт запрашиваем, только если каталог не знает
+        # ни одного подходящего названия (подсказки с опечатками не в счёт)
+        unique_drugs = {
+            name: {"name": name} for name, rank in drug_catalog.search(query, limit=10) if rank < DrugCatalog.FUZZY
+        }
+
+        if not unique_drugs:
+            await update.message.reply_text(f"🔎 Пошук препаратів \"{query}\"...")
+
+            # Ищем препараты без указания города
+            try:
+                results = await search_drugs_async(query, enough=distinct_names(10))
+            except FetchError:
+                await update.message.reply_text("⚠️ Сайт tabletki.ua зараз не відповідає. Спробуйте пізніше.")
+                return False
+
+            if not results:
+                await update.message.reply_text("Нічого не знайдено. Спробуйте інший запит.")
+                return False
+
+            # Группируем препараты по названию (убираем дубликаты)
+            for result in results:
+                name = result['name']
+                if name not in unique_drugs:
+                    unique_drugs[name] = result
+        
+        # Создаем кнопки с названиями препаратов; в callback_data — короткий id названия из сессии
+        session = sessions.get(update.effective_chat.id)
+        keyboard = []
+        for name in list(unique_drugs.keys())[:10]:  # Ограничиваем 10 препаратами
+            keyboard.append([InlineKeyboardButton(name, callback_data=f"drug:{sessions.remember(session, name)}")])
+        
+        markup = InlineKeyboardMarkup(keyboard)
+        await update.message.reply_text(
+            "Оберіть препарат для відстеження з варіантів нижче:", 
+            reply_markup=markup
+        )
+        return True
+    except Exception as e:
+        ERRORS.inc(stage="handler")
+        logger.error(f"Ошибка при поиске препаратов: {e}")
+        await update.message.reply_text("Виникла помилка при пошуку. Спробуйте пізніше.")
+        return False
+
+# Inline-режим (@bot парацет): подсказки названий из каталога за миллисекунды.
+# Сайт запрашивается, только если в каталоге ничего не нашлось
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        query = update.inline_query.query.strip()
+        if len(query) < 2:
+            await update.inline_query.answer([], cache_time=300)
+            return
+        names = [name for name, _ in drug_catalog.search(query, limit=20)]
+        if not names:
+            try:
+                results = await search_drugs_async(query, enough=distinct_names(20))
+            except FetchError:
+                # Пустой ответ без кэширования: следующий ввод попробует снова
+                await update.inline_query.answer([], cache_time=0)
+                return
+            names = list(dict.fromkeys(result["name"] for result in results))[:20]
+        articles = [
+            InlineQueryResultArticle(
+                id=hashlib.blake2b(name.encode("utf-8"), digest_size=8).hexdigest(),
+                title=name,
+                input_message_content=InputTextMessageContent(name)
+            )
+            for name in names
+        ]
+        await update.inline_query.answer(articles, cache_time=300)
+    except Exception as e:
+        ERRORS.inc(stage="handler")
+        logger.error(f"Ошибка в inline-запросе: {e}")
+
+# Показ списка городов для выбора
+async def show_cities_for_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, city_pattern=None):
+    try:
+        if city_pattern:
+            cities = search_cities(city_pattern)
+        else:
+            # Если шаблон не передан, показываем основные города
+            cities = UKRAINE_CITIES[:10]
+        
+        if not cities:
+            if update.callback_query:
+                await update.callback_query.edit_message_text("Не знайдено підходящих міст. Введіть назву міста ще раз:")
+            else:
+                await update.message.reply_text("Не знайдено підходящих міст. Введіть назву міста ще раз:")
+            return False
+        
+        # Создаем кнопки с городами. Найденные пункты передаются коротким id (callback_data — до 64 байт),
+        # область подписывается только у пунктов без тёзок; основные города — коротким id названия из сессии
+        keyboard = []
+        session = sessions.get(update.effective_chat.id)
+        for city in cities:
+            if isinstance(city, dict):
+                label = city["name"]
+                if city["region"] and city["region"] != f"м. {city['name']}":
+                    label = f"{city['name']} ({city['region']})"
+                keyboard.append([InlineKeyboardButton(label, callback_data=f"select_city:{city['id']}")])
+            else:
+                keyboard.append([InlineKeyboardButton(city, callback_data=f"city:{sessions.remember(session, city)}")])
+        
+        markup = InlineKeyboardMarkup(keyboard)
+        
+        # В зависимости от типа сообщения, редактируем или отправляем новое
+        if update.callback_query:
+            await update.callback_query.edit_message_text(
+                "Оберіть місто для відстеження препарату:",
+                reply_markup=markup
+            )
+        else:
+            await update.message.reply_text(
+                "Оберіть місто для відстеження препарату:",
+                reply_markup=markup
+            )
+        
+        return True
+    except Exception as e:
+        ERRORS.inc(stage="handler")
+        logger.error(f"Ошибка при отображении списка городов: {e}")
+        if update.callback_query:
+            await update.callback_query.edit_message_text("Виникла помилка при виборі міста. Спробуйте пізніше.")
+        else:
+            await update.message.reply_text("Виникла помилка при виборі міста. Спробуйте пізніше.")
+        return False
+
+# Неизменяемый снимок состояния отслеживания: записи по чатам (кортежи TrackingEntry) и желаемые
+# интервалы чатов. Опубликованный снимок больше не меняется, поэтому планировщик, проверка и обработчики
+# читают его без блокировок и без запросов к базе; изменения видны только в следующем снимке
+class TrackingSnapshot:
+    __slots__ = ("version", "tracking", "intervals")
+
+    def __init__(self, version, tracking, intervals):
+        self.version = version
+        self.tracking = types.MappingProxyType(tracking)
+        self.intervals = types.MappingProxyType(intervals)
+
+    def entries(self, chat_id):
+        return self.tracking.get(chat_id, ())
+
+    def entry(self, chat_id, entry_id):
+        return next((entry for entry in self.entries(chat_id) if entry.id == entry_id), None)
+
+    # Количество записей, чатов с отслеживанием и уникальных пар препарат-город
+    def stats(self):
+        return {
+            "entries": sum(len(entries) for entries in self.tracking.values()),
+            "chats": len(self.tracking),
+            "queries": len({(entry.drug_key, entry.city_key) for entries in self.tracking.values() for entry in entries})
+        }
+
+# Единственный владелец состояния отслеживания: добавление, удаление и интервалы чатов приходят
+# командами в очередь и применяются одной задачей по порядку. Накопившиеся команды применяются одной
+# транзакцией, затем публикуется новый снимок (копируются только изменённые чаты) и планировщик
+# узнаёт об изменении. Обработчик ждёт только применения своей команды, а не хода проверки;
+# проверка работает со своим снимком и запись не задерживает
+class TrackingState:
+    def __init__(self, storage):
+        self.storage = storage
+        self._snapshot = None
+        self._version = 0
+        self._commands = None
+        self._owner = None
+
+    @property
+    def snapshot(self):
+        if self._snapshot is None:
+            self.reload()
+        return self._snapshot
+
+    # Полное перечитывание из базы: при первом обращении и после записи в обход очереди команд
+    def reload(self):
+        tracking = {}
+        for entry in self.storage.all_tracking():
+            tracking.setdefault(entry.chat_id, []).append(entry)
+        self._publish({chat_id: tuple(entries) for chat_id, entries in tracking.items()}, self.storage.chat_intervals())
+
+    def _publish(self, tracking, intervals):
+        self._version += 1
+        self._snapshot = TrackingSnapshot(self._version, tracking, intervals)
+        if check_scheduler:
+            check_scheduler.notify_changed()
+
+    # Отправка команды владельцу и ожидание результата. Задача-владелец запускается при первой команде
+    async def submit(self, command, *args):
+        if self._owner is None or self._owner.done():
+            self._commands = asyncio.Queue()
+            self._owner = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._commands.put_nowait((getattr(self, f"_{command}"), args, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = [await self._commands.get()]
+            while not self._commands.empty():
+                batch.append(self._commands.get_nowait())
+            self._apply(batch)
+
+    def _apply(self, batch):
+        snapshot = self.snapshot
+        tracking = dict(snapshot.tracking)
+        intervals = dict(snapshot.intervals)
+        results = []
+        self.storage.conn.execute("BEGIN")
+        try:
+            for command, args, _ in batch:
+                results.append(command(tracking, intervals, *args))
+            self.storage.conn.execute("COMMIT")
+        except Exception as e:
+            self.storage.conn.execute("ROLLBACK")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self._publish(tracking, intervals)
+        for (_, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def _add(self, tracking, intervals, chat_id, drug_name, city_name):
+        entry = self.storage.add_tracking(chat_id, drug_name, city_name)
+        if entry is not None:
+            tracking[chat_id] = tracking.get(chat_id, ()) + (entry,)
+        return entry
+
+    def _remove(self, tracking, intervals, chat_id, entry_id):
+        if not self.storage.remove_tracking(chat_id, entry_id):
+            return None
+        entries = tracking.get(chat_id, ())
+        removed = next((entry for entry in entries if entry.id == entry_id), None)
+        remaining = tuple(entry for entry in entries if entry.id != entry_id)
+        if remaining:
+            tracking[chat_id] = remaining
+        else:
+            tracking.pop(chat_id, None)
+        return removed
+
+    def _mark_checked(self, tracking, intervals, entries):
+        self.storage.mark_checked([entry.id for entry in entries])
+        ids = {entry.id for entry in entries}
+        for chat_id in {entry.chat_id for entry in entries}:
+            if chat_id in tracking:
+                tracking[chat_id] = tuple(
+                    entry._replace(checked=1) if entry.id in ids else entry for entry in tracking[chat_id]
+                )
+
+    def _set_interval(self, tracking, intervals, chat_id, hours):
+        self.storage.set_chat_interval(chat_id, hours)
+        if hours:
+            intervals[chat_id] = hours
+        else:
+            intervals.pop(chat_id, None)
+
+    async def close(self):
+        if self._owner is not None:
+            self._owner.cancel()
+            await asyncio.gather(self._owner, return_exceptions=True)
+            self._owner = None
+
+tracking_state = None
+
+# Добавление препарата и города в отслеживание
+async def add_to_tracking(chat_id, drug_name, city_name):
+    try:
+        # None — уже отслеживается
+        return await tracking_state.submit("add", chat_id, drug_name, city_name) is not None
+    except Exception as e:
+        logger.error(f"Ошибка при добавлении в отслеживание: {e}")
+        return False
+
+# Удаление записи отслеживания по её id; возвращает удалённую запись или None
+async def remove_from_tracking(chat_id, entry_id):
+    try:
+        return await tracking_state.submit("remove", chat_id, entry_id)
+    except Exception as e:
+        logger.error(f"Ошибка при удалении из отслеживания: {e}")
+        return None
+
+# Планирование проверки: одинаковые пары препарат-город всех пользователей объединяются в одну задачу
+def plan_sweep(tracking):
+    jobs = {}
+    entries = 0
+    for chat_id, user_tracking in tracking.items():
+        for item in user_tracking:
+            drug = item.drug
+            city = item.city
+            if not drug or not city:
+                continue
+            
+            entries += 1
+            key = (normalize_query(drug), normalize_query(city))
+            job = jobs.get(key)
+            if job is None:
+                job = jobs[key] = {"key": key, "drug": drug, "city": city, "subscribers": []}
+            # Для каждого подписчика сохраняем запись: названия в том виде, в каком он их добавил
+            job["subscribers"].append(item)
+    return jobs, entries
+
+# Режим рабочих процессов (config "workers", 0 — всё выполняется в процессе бота): загрузка и разбор
+# страниц плановой проверки идут в N отдельных процессах, задачи распределяются по хэшу ключа
+# препарат-город. Процесс бота получает только разобранные результаты и остаётся отзывчивым
+
+# Рабочий процесс: свой цикл событий, свой HTTP-клиент и своя доля лимита запросов к сайту.
+# Сигналы остановки обрабатывает процесс бота, он же завершает рабочие процессы
+def checker_worker(jobs, results, base_url, rate):
+    global TABLETKI_BASE_URL
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    TABLETKI_BASE_URL = base_url
+    config["http_requests_per_second"] = rate
+    asyncio.run(_checker_worker(jobs, results))
+
+async def _checker_worker(jobs, results):
+    loop = asyncio.get_running_loop()
+    parent = os.getppid()
+    tasks = set()
+    while True:
+        try:
+            item = await loop.run_in_executor(None, jobs.get, True, 1)
+        except queue.Empty:
+            # Процесс бота завершился аварийно — выходим сами
+            if os.getppid() != parent:
+                break
+            continue
+        if item is None:
+            break
+        task = asyncio.create_task(_worker_check(results, *item))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await close_http_client()
+
+# Одна задача в рабочем процессе. Разбор выполняется прямо в цикле событий: процесс занят только проверкой
+async def _worker_check(results, lease_id, drug_name, city_name):
+    counter = [0]
+    pages_fetched.set(counter)
+    try:
+        started = time.perf_counter()
+        timings = {}
+        items = []
+        async for page in iter_search_pages(drug_name, city_name, in_thread=False, timings=timings):
+            items.extend(page)
+        parse_seconds = timings.get("parse", 0.0)
+        results.put((lease_id, True, items, time.perf_counter() - started - parse_seconds, parse_seconds, counter[0]))
+    except Exception as e:
+        results.put((lease_id, False, f"{type(e).__name__}: {e}", 0.0, 0.0, counter[0]))
+
+# Координатор рабочих процессов в процессе бота. Каждая отправленная задача получает аренду
+# с уникальным id и сроком: результат применяется, только если аренда ещё действует, поэтому
+# задача, переданная заново после сбоя процесса, не выполнится дважды. Упавший или зависший
+# процесс перезапускается, его задачи передаются новому процессу того же шарда
+class WorkerPool:
+    def __init__(self, size):
+        self.size = size
+        self.lease_seconds = config.get("worker_lease_seconds", 120)
+        self.max_attempts = config.get("worker_max_attempts", 2)
+        # Сколько задач одновременно отдаём одному процессу: срок аренды идёт с момента отправки,
+        # поэтому остальные ждут в очереди координатора, а не в процессе
+        self.max_in_flight = config.get("worker_max_in_flight", config.get("http_max_concurrency", 5) * 2)
+        self._context = multiprocessing.get_context("spawn")
+        self._results = self._context.Queue()
+        self._workers = [None] * size  # шард -> (процесс, очередь задач)
+        self._backlog = [collections.deque() for _ in range(size)]
+        self._in_flight = [0] * size
+        self._leases = {}  # id аренды -> задача
+        self._by_key = {}  # ключ -> задача (ожидающая или выданная)
+        self._lease_ids = itertools.count(1)
+        self._loop = None
+        self._reader = None
+        self._watcher = None
+        self.restarts = 0
+        self.completed = 0
+
+    def _spawn(self, shard):
+        jobs = self._context.Queue()
+        rate = config.get("http_requests_per_second", 2) / self.size
+        process = self._context.Process(
+            target=checker_worker, args=(jobs, self._results, TABLETKI_BASE_URL, rate),
+            name=f"de-liky-worker-{shard}", daemon=True
+        )
+        process.start()
+        self._workers[shard] = (process, jobs)
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        for shard in range(self.size):
+            self._spawn(shard)
+        self._reader = threading.Thread(target=self._read_results, name="de-liky-worker-results", daemon=True)
+        self._reader.start()
+        self._watcher = asyncio.create_task(self._watch())
+        logger.info(f"Запущено рабочих процессов: {self.size}")
+
+    def shard(self, key):
+        return zlib.crc32("\t".join(key).encode("utf-8")) % self.size
+
+    # Загрузка и разбор страницы в рабочем процессе; та же сигнатура, что у fetch_search_results
+    async def fetch(self, drug_name, city_name=None):
+        key = SearchCache.make_key(drug_name, city_name)
+        job = self._by_key.get(key)
+        if job is None:
+            job = self._by_key[key] = {
+                "key": key, "drug": drug_name, "city": city_name, "shard": self.shard(key),
+                "attempts": 0, "future": self._loop.create_future()
+            }
+            self._backlog[job["shard"]].append(job)
+            self._pump(job["shard"])
+        # shield: отмена ожидающего не отменяет уже выданную задачу
+        try:
+            return await asyncio.shield(job["future"])
+        finally:
+            # Страницы загружал рабочий процесс — учитываем их в счётчике вызывающей задачи
+            count_pages(job.get("pages", 0))
+
+    def _pump(self, shard):
+        backlog = self._backlog[shard]
+        while backlog and self._in_flight[shard] < self.max_in_flight:
+            job = backlog.popleft()
+            job["lease"] = next(self._lease_ids)
+            job["deadline"] = time.monotonic() + self.lease_seconds
+            job["attempts"] += 1
+            self._leases[job["lease"]] = job
+            self._in_flight[shard] += 1
+            self._workers[shard][1].put((job["lease"], job["drug"], job["city"]))
+
+    def _read_results(self):
+        while True:
+            item = self._results.get()
+            if item is None:
+                return
+            self._loop.call_soon_threadsafe(self._complete, *item)
+
+    def _finish(self, job, result=None, error=None):
+        self._by_key.pop(job["key"], None)
+        if job["future"].done():
+            return
+        if error is not None:
+            job["future"].set_exception(FetchError(error))
+        else:
+            job["future"].set_result(result)
+
+    def _complete(self, lease_id, ok, payload, fetch_seconds, parse_seconds, pages):
+        job = self._leases.pop(lease_id, None)
+        if job is None:
+            # Аренда истекла, задача уже передана заново — поздний результат не применяем
+            return
+        job["pages"] = job.get("pages", 0) + pages
+        self._in_flight[job["shard"]] -= 1
+        self.completed += 1
+        # Рабочие процессы повторяют запросы сами; здесь результат учитывает выключатель процесса бота,
+        # по которому планировщик приостанавливает проверку
+        breaker = get_host_breaker(TABLETKI_BASE_URL)
+        if ok:
+            breaker.record_success()
+            FETCH_SECONDS.observe(fetch_seconds)
+            PARSE_SECONDS.observe(parse_seconds)
+            RESULTS.inc(outcome="found" if payload else "not_found")
+            drug_catalog.add(payload)
+            self._finish(job, result=payload)
+        else:
+            breaker.record_failure()
+            ERRORS.inc(stage="fetch")
+            self._finish(job, error=payload)
+        self._pump(job["shard"])
+
+    # Перезапуск шарда: выданные ему задачи возвращаются в начало очереди с новой арендой
+    def _restart(self, shard):
+        self.restarts += 1
+        _, old_jobs = self._workers[shard]
+        old_jobs.cancel_join_thread()
+        old_jobs.close()
+        self._spawn(shard)
+        leased = [job for job in self._leases.values() if job["shard"] == shard]
+        self._in_flight[shard] = 0
+        for job in sorted(leased, key=lambda job: job["lease"], reverse=True):
+            del self._leases[job["lease"]]
+            if job["attempts"] >= self.max_attempts:
+                self._finish(job, error=f"рабочий процесс не выполнил задачу за {job['attempts']} попыток")
+            else:
+                self._backlog[shard].appendleft(job)
+        self._pump(shard)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            expired = {job["shard"] for job in self._leases.values() if job["deadline"] < now}
+            for shard, (process, _) in enumerate(self._workers):
+                if process.is_alive() and shard not in expired:
+                    continue
+                if process.is_alive():
+                    logger.warning(f"Рабочий процесс {shard} не вернул результат за {self.lease_seconds} с, перезапуск")
+                    process.kill()
+                else:
+                    logger.warning(f"Рабочий процесс {shard} завершился с кодом {process.exitcode}, перезапуск")
+                await asyncio.to_thread(process.join, 5)
+                self._restart(shard)
+
+    def leases(self):
+        return len(self._leases)
+
+    async def close(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+        for _, jobs in self._workers:
+            jobs.put(None)
+        for process, _ in self._workers:
+            await asyncio.to_thread(process.join, 10)
+            if process.is_alive():
+                process.terminate()
+        self._results.put(None)
+        for job in list(self._by_key.values()):
+            self._finish(job, error="рабочие процессы остановлены")
+        logger.info(f"Рабочие процессы остановлены, выполнено задач: {self.completed}, перезапусков: {self.restarts}")
+
+worker_pool = None
+
+metrics.register(Gauge("de_liky_worker_leases", "Задач, выданных рабочим процессам", lambda: worker_pool.leases() if worker_pool else 0))
+metrics.register(Counter("de_liky_worker_restarts_total", "Перезапуски рабочих процессов", func=lambda: [
+    ({}, worker_pool.restarts if worker_pool else 0)
+]))
+
+# Выполнение одной задачи: один запрос к сайту и уведомления всем подписчикам,
+# но только если наличие изменилось с прошлой проверки. Если проверить не удалось, поднимается FetchError
+async def run_sweep_job(job, bot):
+    SWEEP_JOBS.inc()
+    try:
+        with SWEEP_JOB_SECONDS.time():
+            return await _run_sweep_job(job, bot)
+    finally:
+        if profiler.active:
+            profiler.job_done()
+
+async def _run_sweep_job(job, bot):
+    try:
+        # Плановая проверка всегда обновляет кэш, интерактивные запросы затем берут данные из него
+        fetch = worker_pool.fetch if worker_pool is not None else fetch_search_results
+        results = await search_cache.refresh(job["drug"], job["city"], fetch)
+    except Exception as e:
+        # Ошибка загрузки не означает отсутствие препарата: сохранённый отпечаток не трогаем
+        logger.error(f"Ошибка при проверке {job['drug']} в {job['city']}: {e}")
+        if isinstance(e, FetchError):
+            raise
+        raise FetchError(str(e)) from e
+    
+    snapshot = availability_snapshot(results)
+    previous = storage.get_snapshot(job["key"])
+    changed = previous is not None and previous["fingerprint"] != snapshot["fingerprint"]
+    storage.record_check(job["key"], changed, CHANGE_HALF_LIFE_HOURS)
+    price_history.observe(job["key"], results)
+    changes = []
+    if previous is None or previous["fingerprint"] != snapshot["fingerprint"]:
+        storage.save_snapshot(job["key"], snapshot)
+        changes = detect_changes(previous, snapshot)
+    
+    # Отпечаток общий для пары препарат-город, а подписчик, добавленный после прошлой проверки,
+    # ещё не знает текущего наличия: для него сравнение идёт с пустым отпечатком
+    fresh = [entry for entry in job["subscribers"] if not entry.checked]
+    initial = detect_changes(None, snapshot) if fresh else []
+    notified = 0
+    for entry in job["subscribers"]:
+        entry_changes = changes if entry.checked else initial
+        if entry_changes and await notify_drug_available(
+            entry.chat_id, entry.drug, entry.city, bot, results=results, changes=entry_changes
+        ):
+            notified += 1
+    if fresh:
+        await tracking_state.submit("mark_checked", fresh)
+    return notified
+
+# Общая проверка всех отслеживаемых препаратов
+async def run_sweep(bot):
+    tracking = tracking_state.snapshot.tracking
+    jobs, entries = plan_sweep(tracking)
+    SWEEPS.inc()
+    logger.info(f"Проверка препаратов для {len(tracking)} пользователей: {entries} записей, {len(jobs)} уникальных запросов")
+    
+    started = time.monotonic()
+    outcomes = await asyncio.gather(*(run_sweep_job(job, bot) for job in jobs.values()), return_exceptions=True)
+    for outcome in outcomes:
+        if isinstance(outcome, BaseException) and not isinstance(outcome, FetchError):
+            raise outcome
+    notified = [outcome for outcome in outcomes if not isinstance(outcome, FetchError)]
+    if notification_dispatcher is not None:
+        notification_dispatcher.flush(all=True)
+    stats = {
+        "users": len(tracking),
+        "entries": entries,
+        "jobs": len(jobs),
+        "failed": len(outcomes) - len(notified),
+        "fetches_saved": entries - len(jobs),
+        "notified": sum(notified),
+        "duration": time.monotonic() - started,
+        "cache": search_cache.stats()
+    }
+    logger.info(
+        f"Проверка завершена за {stats['duration']:.1f} с: {stats['jobs']} запросов к сайту, "
+        f"не удалось {stats['failed']}, сэкономлено {stats['fetches_saved']}, отправлено {stats['notified']} уведомлений"
+    )
+    return stats
+
+# Период полураспада статистики изменений: старые наблюдения постепенно теряют вес
+CHANGE_HALF_LIFE_HOURS = 7 * 24
+
+# Оценка частоты изменений результата (раз в час); без наблюдений — априорно раз в сутки
+def change_rate(stats):
+    changes, hours = stats or (0.0, 0.0)
+    return (changes + 1) / (hours + 24)
+
+# Планировщик проверок: у каждой задачи препарат-город своя частота проверки. Она растёт с частотой
+# изменений результата и числом подписчиков (пропорционально корню из их произведения), не опускается
+# ниже желаемой подписчиками и в сумме укладывается в бюджет запросов к сайту в час
+class CheckScheduler:
+    # Разброс времени следующего запуска относительно интервала
+    JITTER = 0.1
+    # Как часто перечитывать список отслеживания и пересчитывать частоты, даже если изменений не было
+    RESYNC_SECONDS = 300
+    # Через сколько повторить проверку, которая не удалась (но не позже обычного интервала)
+    RETRY_SECONDS = 300
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._jobs = {}  # ключ -> задача из plan_sweep
+        self._due = {}  # ключ -> время следующего запуска
+        self._last_run = {}  # ключ -> время последнего запуска
+        self._scores = {}  # ключ -> корень из (подписчики * частота изменений)
+        self._floors = {}  # ключ -> минимальная частота по желаемым интервалам подписчиков
+        self._heap = []
+        self._running = set()
+        self._tasks = set()
+        self._wakeup = asyncio.Event()
+        self._dirty = True
+        self._synced_at = 0
+        self._restored = False
+        self._semaphore = asyncio.Semaphore(config.get("scheduler_max_concurrency", 5))
+        self._limiter = None
+        self._scale = 1.0
+        self._floor_scale = 1.0
+        self.min_rate = 1 / config.get("max_interval_hours", 48)
+        self.max_rate = 60 / config.get("min_interval_minutes", 30)
+        self.budget = 0.0
+        self.planned = 0.0
+        self.runs = 0
+        self.fetches_saved = 0
+
+    # Бюджет запросов в час; по умолчанию — столько же, сколько давал бы общий интервал interval_hours
+    def budget_per_hour(self):
+        return config.get("requests_per_hour") or max(1.0, len(self._jobs) / get_interval_hours())
+
+    def _score(self, key, stats):
+        return math.sqrt(len(self._jobs[key]["subscribers"]) * change_rate(stats))
+
+    def _rate(self, key):
+        floor = self._floors.get(key, self.min_rate) * self._floor_scale
+        return min(self.max_rate, max(floor, self._scale * self._scores.get(key, 0.0)))
+
+    def interval(self, key):
+        return 3600 / self._rate(key)
+
+    # Фактический интервал проверки препаратов чата в часах (самый длинный из них) или None, если
+    # они ещё не запланированы. Может быть длиннее желаемого: желаемые интервалы всех пользователей
+    # вместе могут не помещаться в бюджет запросов, тогда они пропорционально растягиваются
+    def chat_interval_hours(self, chat_id):
+        intervals = [
+            self.interval(key) / 3600 for key in (
+                (normalize_query(entry.drug), normalize_query(entry.city))
+                for entry in tracking_state.snapshot.entries(chat_id)
+            ) if key in self._jobs
+        ]
+        return max(intervals) if intervals else None
+
+    # Распределение бюджета: множитель подбирается бисекцией так, чтобы сумма частот была равна бюджету
+    def allocate(self):
+        stats = storage.all_job_stats()
+        preferences = tracking_state.snapshot.intervals
+        self._scores = {}
+        self._floors = {}
+        for key, job in self._jobs.items():
+            self._scores[key] = self._score(key, stats.get(key))
+            wanted = [preferences[entry.chat_id] for entry in job["subscribers"] if entry.chat_id in preferences]
+            self._floors[key] = min(self.max_rate, max(self.min_rate, 1 / min(wanted))) if wanted else self.min_rate
+
+        self.budget = self.budget_per_hour()
+        floors = [self._floors[key] for key in self._jobs]
+        scores = [self._scores[key] for key in self._jobs]
+        # Минимальные частоты не помещаются в бюджет — уменьшаем их пропорционально
+        floor_total = sum(floors)
+        self._floor_scale = min(1.0, self.budget / floor_total) if floor_total else 1.0
+        floors = [floor * self._floor_scale for floor in floors]
+
+        def total(scale):
+            return sum(min(self.max_rate, max(floor, scale * score)) for floor, score in zip(floors, scores))
+
+        low, high = 1e-6, 1e6
+        for _ in range(30):
+            middle = math.sqrt(low * high)
+            if total(middle) > self.budget:
+                high = middle
+            else:
+                low = middle
+        self._scale = low
+        self.planned = total(low)
+        rate = self.budget / 3600
+        if self._limiter is None or self._limiter.rate != rate:
+            self._limiter = RateLimiter(rate, burst=max(1, int(self.budget / 60)))
+
+    def _push(self, key, due):
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, key))
+
+    def _next_due(self, key, now):
+        interval = self.interval(key)
+        last_run = self._last_run.get(key)
+        if last_run is None:
+            # Новая задача: случайный момент в пределах интервала
+            return now + random.uniform(0, interval)
+        return max(now, last_run + interval * random.uniform(1 - self.JITTER, 1 + self.JITTER))
+
+    # Синхронизация задач со списком отслеживания и пересчёт частот
+    def sync_jobs(self):
+        jobs, entries = plan_sweep(tracking_state.snapshot.tracking)
+        now = time.time()
+        for key in self._jobs.keys() - jobs.keys():
+            self._due.pop(key, None)
+            self._last_run.pop(key, None)
+        new_keys = jobs.keys() - self._jobs.keys()
+        self._jobs = jobs
+        self.allocate()
+        saved = {}
+        if not self._restored:
+            # Первая синхронизация после запуска: продолжаем расписание прошлого запуска
+            saved = storage.load_schedule()
+            self._restored = True
+        overdue = []
+        for key in jobs:
+            if key in self._running:
+                continue
+            if key in new_keys:
+                due, last_run = saved.get(key, (None, None))
+                if last_run is not None:
+                    self._last_run[key] = last_run
+                # Без сохранённого срока или если частота с тех пор выросла — срок считается заново
+                if due is None or (last_run is not None and due > last_run + self.interval(key) * (1 + self.JITTER)):
+                    due = self._next_due(key, now)
+                if due <= now:
+                    overdue.append((due, key))
+                else:
+                    self._push(key, due)
+                continue
+            # Частота выросла (например, пользователь выбрал интервал короче) — переносим запуск ближе
+            last_run = self._last_run.get(key)
+            if last_run is not None and self._due.get(key, 0) > last_run + self.interval(key) * (1 + self.JITTER):
+                self._push(key, self._next_due(key, now))
+        # Просроченные за время простоя задачи запускаются не все сразу, а с шагом, соответствующим
+        # бюджету запросов, начиная с самых просроченных
+        spacing = 3600 / self.budget
+        for position, (_, key) in enumerate(sorted(overdue)):
+            self._push(key, now + position * spacing)
+        if overdue:
+            logger.info(f"Планировщик: {len(overdue)} просроченных проверок, догоняем за {len(overdue) * spacing / 60:.0f} мин")
+        self.fetches_saved = entries - len(jobs)
+        self._dirty = False
+        self._synced_at = time.monotonic()
+        logger.info(
+            f"Планировщик: {entries} записей, {len(jobs)} уникальных запросов, сэкономлено {self.fetches_saved}, "
+            f"запланировано {self.planned:.0f} из {self.budget:.0f} запросов в час"
+        )
+
+    # Расписание для сохранения: (ключ, срок следующей проверки, время последней). До первой
+    # синхронизации расписание прошлого запуска ещё не загружено — сохранять нечего
+    def export_state(self):
+        if not self._restored:
+            return None
+        return [(key, self._due.get(key), self._last_run.get(key)) for key in self._jobs]
+
+    # Список отслеживания или желаемые интервалы изменились
+    def notify_changed(self):
+        self._dirty = True
+        self._wakeup.set()
+
+    async def _run_job(self, key):
+        failed = False
+        # Токен бюджета берётся за первую страницу, за остальные загруженные страницы он списывается
+        # после проверки — иначе многостраничные результаты превышали бы requests_per_hour в разы
+        counter = [0]
+        pages_fetched.set(counter)
+        try:
+            await self._limiter.acquire()
+            async with self._semaphore:
+                job = self._jobs.get(key)
+                if job is not None:
+                    await run_sweep_job(job, self.bot)
+                    self.runs += 1
+        except FetchError:
+            failed = True
+        except Exception as e:
+            ERRORS.inc(stage="sweep")
+            logger.error(f"Scheduled check error: {e}")
+        finally:
+            if counter[0] > 1:
+                self._limiter.charge(counter[0] - 1)
+            self._running.discard(key)
+            if failed:
+                # Проверка не состоялась: время последней проверки не меняем, повторяем после паузы
+                if key in self._jobs:
+                    delay = max(self.RETRY_SECONDS, get_host_breaker(TABLETKI_BASE_URL).retry_in())
+                    delay = min(self.interval(key), delay) * random.uniform(1, 1 + self.JITTER)
+                    self._push(key, time.time() + delay)
+            else:
+                self._last_run[key] = time.time()
+                if key in self._jobs:
+                    # Частота изменений обновилась после проверки — интервал пересчитывается сразу
+                    self._scores[key] = self._score(key, storage.get_job_stats(key))
+                    self._push(key, self._next_due(key, time.time()))
+            self._wakeup.set()
+
+    async def run(self):
+        while True:
+            if self._dirty or time.monotonic() - self._synced_at > self.RESYNC_SECONDS:
+                self.sync_jobs()
+            
+            # Пока сайт недоступен, проверка приостановлена: задачи ждут в очереди, а не тратят попытки.
+            # Когда срок паузы истекает, запускается одна задача — она и будет пробным запросом
+            breaker = get_host_breaker(TABLETKI_BASE_URL)
+            pause = breaker.retry_in()
+            closed = breaker.state == "closed"
+            probe = not closed and pause == 0 and not self._running
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now and (closed or probe):
+                due, key = heapq.heappop(self._heap)
+                # Пропускаем устаревшие записи кучи (задача удалена или перепланирована)
+                if self._due.get(key) != due or key in self._running:
+                    continue
+                del self._due[key]
+                probe = False
+                self._running.add(key)
+                task = asyncio.create_task(self._run_job(key))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            
+            timeout = self.RESYNC_SECONDS
+            if not closed:
+                # Ждём конца паузы или завершения пробной задачи
+                timeout = min(timeout, max(1, pause))
+            elif self._heap:
+                timeout = min(timeout, max(0, self._heap[0][0] - now))
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+check_scheduler = None
+
+# Фоновая проверка по расписанию (работает в цикле событий бота)
+async def schedule_checks(application):
+    global check_scheduler
+    check_scheduler = CheckScheduler(application.bot)
+    logger.info(f"Background checker started, base interval: {get_interval_hours()} hours")
+    await check_scheduler.run()
+
+# Тёплый перезапуск: кэш результатов и расписание проверок сохраняются в базу каждые
+# state_save_seconds и при остановке, а при запуске загружаются обратно
+def save_state():
+    rows, removed = search_cache.take_changes()
+    storage.save_cache(
+        [(key, stored, zlib.compress(json.dumps(results, ensure_ascii=False).encode("utf-8"))) for key, stored, results in rows],
+        removed
+    )
+    schedule = check_scheduler.export_state() if check_scheduler is not None else None
+    if schedule is not None:
+        storage.save_schedule(schedule)
+
+def decode_cache_rows(rows):
+    return [(key, stored, json.loads(zlib.decompress(data))) for key, stored, data in rows]
+
+async def restore_cache():
+    started = time.perf_counter()
+    rows = storage.load_cache(time.time() - search_cache.max_stale)
+    # Распаковка и разбор JSON — в отдельном потоке, чтобы не задерживать обработчики
+    restored = search_cache.restore(await asyncio.to_thread(decode_cache_rows, rows))
+    logger.info(f"Кэш восстановлен: {restored} записей за {time.perf_counter() - started:.2f} с")
+
+async def persist_state():
+    while True:
+        await asyncio.sleep(config.get("state_save_seconds", 60))
+        try:
+            save_state()
+        except Exception as e:
+            ERRORS.inc(stage="persist")
+            logger.error(f"Ошибка при сохранении состояния: {e}")
+
+# Команда /history: цены и наличие отслеживаемых препаратов за прошедшие периоды
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        chat_id = update.effective_chat.id
+        user_tracking = tracking_state.snapshot.entries(chat_id)
+        
+        if not user_tracking:
+            await update.message.reply_text("У вас ще немає препаратів для відстеження.")
+            return
+        
+        parts = []
+        for item in user_tracking:
+            drug = item.drug
+            city = item.city
+            summary = price_history.summary((normalize_query(drug), normalize_query(city)))
+            if summary is None:
+                parts.append(f"💊 *{md(drug)}* у місті *{md(city)}*\nІсторії ще немає — вона з'явиться після перших перевірок.\n")
+            else:
+                parts.append(format_history(drug, city, summary))
+        
+        for part in split_message("\n".join(parts)):
+            await update.message.reply_text(part, parse_mode="Markdown")
+    except Exception as e:
+        ERRORS.inc(stage="handler")
+        logger.error(f"Ошибка в команде history: {e}")
+        await update.message.reply_text("Виникла помилка при отриманні історії цін.")
+
+# Прореживание истории цен раз в сутки (первый раз — вскоре после запуска)
+async def maintain_history():
+    await asyncio.sleep(600)
+    while True:
+        try:
+            await price_history.maintain()
+        except Exception as e:
+            ERRORS.inc(stage="history")
+            logger.error(f"Ошибка при обслуживании истории цен: {e}")
+        await asyncio.sleep(PriceHistory.DAY)
+
+# Команда /stats (только для администраторов из admin_chat_ids): сводка метрик
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if update.effective_chat.id not in config.get("admin_chat_ids", []):
+            return
+        
+        for part in split_message(metrics.render_summary()):
+            await update.message.reply_text(part)
+    except Exception as e:
+        logger.error(f"Ошибка в команде stats: {e}")
+
+# Профилирование по запросу (команда /profile или сигнал SIGUSR1) на заданное число секунд или плановых
+# проверок. Режимы: sample — выборка стеков всех потоков (включая разбор страниц в потоках), результат
+# в формате collapsed stacks для flamegraph.pl / speedscope; cprofile — точный профиль потока цикла
+# событий (планировщик, загрузка, обработчики) в формате pstats. Пока профилирование выключено,
+# не работает ни поток выборки, ни cProfile — остаётся только проверка флага в run_sweep_job
+class Profiler:
+    MODES = ("sample", "cprofile")
+
+    def __init__(self, directory, sample_interval):
+        self.directory = directory
+        self.sample_interval = sample_interval
+        self.active = False
+        self.mode = None
+        self.jobs_left = None
+        self._profile = None
+        self._sampler = None
+        self._stop_sampling = None
+        self._stacks = None
+        self._timer = None
+        self._on_done = None
+        self._started = 0.0
+
+    def start(self, mode, seconds=None, jobs=None, on_done=None):
+        if self.active:
+            raise RuntimeError(f"профилирование уже идёт ({self.mode})")
+        if mode not in self.MODES:
+            raise ValueError(f"неизвестный режим {mode}")
+        self.active = True
+        self.mode = mode
+        self.jobs_left = jobs
+        self._on_done = on_done
+        self._started = time.monotonic()
+        if mode == "cprofile":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._stacks = collections.Counter()
+            self._stop_sampling = threading.Event()
+            self._sampler = threading.Thread(target=self._sample, name="de-liky-profiler", daemon=True)
+            self._sampler.start()
+        if seconds:
+            self._timer = asyncio.get_running_loop().call_later(seconds, self.stop)
+        logger.info(f"Профилирование {mode} запущено: {f'{jobs} проверок' if jobs else f'{seconds} с'}")
+
+    # Плановая проверка завершена: считаем их, если профилируем заданное число проверок
+    def job_done(self):
+        if self.jobs_left is not None:
+            self.jobs_left -= 1
+            if self.jobs_left <= 0:
+                self.stop()
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop_sampling.wait(self.sample_interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                # Простаивающие вспомогательные потоки (ожидание очереди или события) не интересны
+                if stack[0].split(" ", 1)[1].startswith(("(threading.py", "(queue.py")):
+                    continue
+                stack.append(names.get(thread_id, str(thread_id)))
+                self._stacks[";".join(reversed(stack))] += 1
+
+    # Остановка и запись результата; возвращает путь к файлу
+    def stop(self):
+        if not self.active:
+            return None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        os.makedirs(self.directory, exist_ok=True)
+        name = time.strftime("profile-%Y%m%d-%H%M%S")
+        duration = time.monotonic() - self._started
+        if self.mode == "cprofile":
+            self._profile.disable()
+            path = os.path.join(self.directory, f"{name}.pstats")
+            self._profile.dump_stats(path)
+            summary = self._top_functions(self._profile)
+            self._profile = None
+        else:
+            self._stop_sampling.set()
+            self._sampler.join()
+            path = os.path.join(self.directory, f"{name}.folded")
+            with open(path, "w", encoding="utf-8") as f:
+                for stack, count in self._stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            summary = f"{sum(self._stacks.values())} выборок, {len(self._stacks)} разных стеков"
+            self._stacks = None
+        self.active = False
+        self.jobs_left = None
+        logger.info(f"Профилирование {self.mode} завершено за {duration:.0f} с: {path}")
+        if self._on_done is not None:
+            self._on_done(f"Профиль ({self.mode}, {duration:.0f} с) сохранён: {path}\n\n{summary}")
+            self._on_done = None
+        return path
+
+    @staticmethod
+    def _top_functions(profile, limit=10):
+        stats = pstats.Stats(profile)
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+        lines = ["Больше всего времени (cumulative):"]
+        for (filename, line, function), (_, calls, _, cumulative, _) in rows:
+            lines.append(f"{cumulative:.2f} с  {calls} выз.  {function} ({os.path.basename(filename)}:{line})")
+        return "\n".join(lines)
+
+profiler = Profiler(
+    config.get("profile_dir", os.path.join(os.path.dirname(CONFIG_PATH), "profiles")),
+    sample_interval=config.get("profile_sample_ms", 5) / 1000
+)
+
+# Команда /profile (только для администраторов): /profile [sample|cprofile] [секунды | jobs N],
+# /profile stop — остановить досрочно. По умолчанию sample на 60 секунд
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        chat_id = update.effective_chat.id
+        if chat_id not in config.get("admin_chat_ids", []):
+            return
+        
+        args = list(context.args or [])
+        if args[:1] == ["stop"]:
+            if profiler.stop() is None:
+                await update.message.reply_text("Профилирование не запущено.")
+            return
+        mode = "sample"
+        if args and args[0] in Profiler.MODES:
+            mode = args.pop(0)
+        seconds, jobs = 60, None
+        if args[:1] == ["jobs"] and len(args) > 1:
+            # Ограничение по времени остаётся на случай, если проверок долго не будет
+            seconds, jobs = config.get("profile_max_seconds", 600), int(args[1])
+        elif args:
+            seconds = int(args[0])
+        bot = context.bot
+        
+        def on_done(text):
+            for part in split_message(text):
+                asyncio.create_task(bot.send_message(chat_id, part))
+        
+        profiler.start(mode, seconds=seconds, jobs=jobs, on_done=on_done)
+        await update.message.reply_text(
+            f"Профилирование {mode} запущено на {f'{jobs} проверок' if jobs else f'{seconds} с'}. "
+            "Результат пришлю, когда закончится."
+        )
+    except (RuntimeError, ValueError) as e:
+        await update.message.reply_text(f"Не удалось запустить профилирование: {e}")
+    except Exception as e:
+        logger.error(f"Ошибка в команде profile: {e}")
+
+# SIGUSR1: профилирование sample на profile_signal_seconds; повторный сигнал останавливает его досрочно
+def toggle_profiling():
+    if profiler.active:
+        profiler.stop()
+    else:
+        profiler.start("sample", seconds=config.get("profile_signal_seconds", 60))
+
+# Фоновые задачи бота
+_background_tasks = []
+
+# Запуск фоновых задач после инициализации приложения
+async def on_startup(application):
+    global notification_dispatcher, worker_pool
+    if config.get("workers", 0) > 0:
+        worker_pool = WorkerPool(config["workers"])
+        worker_pool.start()
+    notification_dispatcher = NotificationDispatcher(application.bot)
+    _background_tasks.append(asyncio.create_task(notification_dispatcher.run()))
+    _background_tasks.append(asyncio.create_task(schedule_checks(application)))
+    _background_tasks.append(asyncio.create_task(maintain_history()))
+    _background_tasks.append(asyncio.create_task(restore_cache()))
+    _background_tasks.append(asyncio.create_task(persist_state()))
+    if hasattr(signal, "SIGUSR1"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, toggle_profiling)
+    if config.get("metrics_port"):
+        _background_tasks.append(asyncio.create_task(serve_metrics(config["metrics_port"])))
+    # Индекс городов загружается в фоне, чтобы не задерживать запуск и первый поиск
+    _background_tasks.append(asyncio.create_task(asyncio.to_thread(get_city_index)))
+    _background_tasks.append(asyncio.create_task(asyncio.to_thread(drug_catalog.load, storage.catalog_names())))
+
+# Остановка фоновых задач, сохранение состояния и закрытие HTTP-клиента
+async def on_shutdown(application):
+    if notification_dispatcher is not None:
+        await notification_dispatcher.drain()
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    try:
+        save_state()
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении состояния: {e}")
+    if worker_pool is not None:
+        await worker_pool.close()
+    await tracking_state.close()
+    drug_catalog.flush()
+    await close_http_client()
+
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        query = update.callback_query
+        await query.answer()
+        
+        session = sessions.get(update.effective_chat.id)
+        
+        # select_drug_for_tracking и select_city_for_tracking (название прямо в callback_data) —
+        # кнопки из сообщений, отправленных до перехода на короткие id
+        if query.data.startswith(("drug:", "select_drug_for_tracking:")):
+            # Пользователь выбрал препарат, предлагаем выбрать город
+            prefix, value = query.data.split(":", 1)
+            drug_name = sessions.lookup(session, value) if prefix == "drug" else value
+            if drug_name is None:
+                await query.edit_message_text("Цей список застарів. Введіть назву препарату ще раз:")
+                session.waiting_for = "drug_search"
+                return
+            
+            # Сохраняем выбранный препарат
+            session.selected_drug = drug_name
+            
+            # Показываем список городов для выбора
+            session.waiting_for = "city_for_tracking"
+            await show_cities_for_selection(update, context)
+        
+        elif query.data.startswith(("city:", "select_city:", "select_city_for_tracking:")):
+            # Пользователь выбрал город: из основного списка — по id названия в сессии, из результатов поиска — по id в индексе
+            prefix, value = query.data.split(":", 1)
+            if prefix == "select_city":
+                city = get_city_index().city(int(value))
+                city_name = city["name"] if city is not None else None
+            elif prefix == "city":
+                city_name = sessions.lookup(session, value)
+            else:
+                city_name = value
+            if city_name is None:
+                await query.edit_message_text("Місто не знайдено. Введіть назву міста ще раз:")
+                return
+            drug_name = session.selected_drug
+            
+            if not drug_name:
+                await query.edit_message_text("Помилка: не вибрано препарат. Почніть спочатку.")
+                return
+            
+            # Добавляем в отслеживание
+            chat_id = update.effective_chat.id
+            if await add_to_tracking(chat_id, drug_name, city_name):
+                await query.edit_message_text(
+                    f"✅ Препарат *{md(drug_name)}* буде відстежуватися у місті *{md(city_name)}*.\n\n"
+                    f"Ви отримаєте повідомлення, коли препарат з'явиться в наявності.",
+                    parse_mode="Markdown"
+                )
+            else:
+                await query.edit_message_text(
+                    f"ℹ️ Препарат *{md(drug_name)}* у місті *{md(city_name)}* вже відстежується.",
+                    parse_mode="Markdown"
+                )
+            
+            # Диалог завершён — сессия больше не нужна
+            sessions.drop(update.effective_chat.id)
+        
+        elif query.data.startswith(("untrack:", "remove_tracking:")):
+            # Пользователь хочет удалить препарат из отслеживания. remove_tracking:<позиция в списке> —
+            # кнопки из сообщений, отправленных до перехода на id записей
+            prefix, value = query.data.split(":", 1)
+            chat_id = update.effective_chat.id
+            
+            if prefix == "untrack":
+                entry_id = int(value)
+            else:
+                user_tracking = tracking_state.snapshot.entries(chat_id)
+                index = int(value)
+                entry_id = user_tracking[index].id if index < len(user_tracking) else None
+            
+            removed = await remove_from_tracking(chat_id, entry_id) if entry_id is not None else None
+            if removed is not None:
+                await query.edit_message_text(
+                    f"🗑️ Препарат *{md(removed.drug)}* у місті *{md(removed.city)}* видалено з відстеження.",
+                    parse_mode="Markdown"
+                )
+            else:
+                await query.edit_message_text("❌ Препарат не знайдено.")
+        
+        elif query.data.startswith("interval:"):
+            # Желаемый интервал пользователя: его препараты проверяются не реже (0 — автоматически)
+            hours = int(query.data.split(":", 1)[1])
+            chat_id = update.effective_chat.id
+            await tracking_state.submit("set_interval", chat_id, hours or None)
+            if hours:
+                # Пересчёт частот сразу, чтобы ответ учитывал новый интервал (иначе это сделает цикл планировщика)
+                if check_scheduler:
+                    check_scheduler.sync_jobs()
+                await query.edit_message_text(
+                    f"⏰ Ваші препарати перевірятимуться кожні *{hours} годин*, наскільки дозволяє обмеження "
+                    f"кількості запитів до сайту.{interval_delay_note(chat_id, hours)}",
+                    parse_mode="Markdown"
+                )
+            else:
+                await query.edit_message_text("⏰ Інтервал перевірки визначатиметься автоматично.")
+    
+    except Exception as e:
+        ERRORS.inc(stage="handler")
+        logger.error(f"Ошибка в button_handler: {e}")
+        await query.edit_message_text("Виникла помилка при обробці запиту.")
+
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        text = update.message.text.strip()
+        
+        if text == "🔎 Додати препарат для відстеження":
+            await update.message.reply_text("Введіть назву препарату для пошуку:")
+            sessions.get(update.effective_chat.id).waiting_for = "drug_search"
+            return
+        
+        if text == "📋 Список відстежуваних":
+            await list_items(update, context)
+            return
+        
+        if text == "🔎 Перевірити зараз":
+            await check_now(update, context)
+            return
+        
+        if text == "⚙️ Налаштування":
+            await settings(update, context)
+            return
+        
+        # Проверяем, ожидаем ли ввод от пользователя
+        waiting_for = sessions.get(update.effective_chat.id).waiting_for
+        
+        if waiting_for == "drug_search":
+            # Пользователь ввел название препарата
+            await search_and_show_drugs(update, context, text)
+            return
+        
+        elif waiting_for == "city_for_tracking":
+            # Пользователь ввел название города
+            await show_cities_for_selection(update, context, text)
+            return
+        
+        else:
+            # Если ничего не ожидаем, считаем ввод поиском препарата
+            await search_and_show_drugs(update, context, text)
+    
+    except Exception as e:
+        ERRORS.inc(stage="handler")
+        logger.error(f"Ошибка в handle_text: {e}")
+        await update.message.reply_text("Виникла помилка при обробці тексту.")
+
+# Очередь входящих обновлений с ограничением: обновление занимает место от получения до конца обработки.
+# Когда все места заняты, приём (getUpdates или ответ на запрос вебхука) ждёт, и Telegram придерживает
+# следующие обновления у себя, вместо того чтобы копить их в памяти бота
+class BoundedUpdateQueue(asyncio.Queue):
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+        self._slots = asyncio.Semaphore(limit)
+
+    async def put(self, item):
+        await self._slots.acquire()
+        await super().put(item)
+
+    def task_done(self):
+        super().task_done()
+        self._slots.release()
+
+    def in_flight(self):
+        return self.limit - self._slots._value
+
+_update_queue = None
+
+metrics.register(Gauge(
+    "de_liky_pending_updates", "Обновлений Telegram в очереди и в обработке",
+    lambda: _update_queue.in_flight() if _update_queue else 0
+))
+
+# Сборка приложения с обработчиками; base_url позволяет направить запросы к Bot API на заглушку (бенчмарк)
+# Подключение к базе (с переносом данных из старого конфига) и каталог, история цен и состояние
+# отслеживания поверх неё. Вызывается процессом бота один раз, до обработки обновлений
+def init_storage():
+    global storage, drug_catalog, price_history, tracking_state
+    if storage is not None:
+        return
+    storage = Storage(DB_PATH)
+    storage.migrate_from_config(config)
+    drug_catalog = DrugCatalog(
+        storage,
+        flush_seconds=config.get("catalog_flush_seconds", 60),
+        flush_batch=config.get("catalog_flush_batch", 500)
+    )
+    price_history = PriceHistory(storage)
+    tracking_state = TrackingState(storage)
+
+def build_application(base_url=None):
+    global _update_queue
+    init_storage()
+    _update_queue = BoundedUpdateQueue(config.get("max_pending_updates", 256))
+    # Обработчики выполняются параллельно, чтобы медленный запрос одного пользователя не задерживал остальных
+    builder = (
+        ApplicationBuilder()
+        .token(config["token"])
+        .concurrent_updates(config.get("concurrent_updates", 32))
+        .update_queue(_update_queue)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    app = builder.build()
+
+    # Добавляем обработчики команд
+    app.add_handler(CommandHandler("start", instrument_handler("start", start)))
+    app.add_handler(CommandHandler("list", instrument_handler("list", list_items)))
+    app.add_handler(CommandHandler("check", instrument_handler("check", check_now)))
+    app.add_handler(CommandHandler("settings", instrument_handler("settings", settings)))
+    app.add_handler(CommandHandler("history", instrument_handler("history", history_command)))
+    app.add_handler(CommandHandler("stats", stats_command))
+    app.add_handler(CommandHandler("profile", profile_command))
+
+    # Добавляем обработчик для callback-запросов от кнопок
+    app.add_handler(CallbackQueryHandler(instrument_handler("button", button_handler)))
+
+    # Подсказки названий препаратов в inline-режиме
+    app.add_handler(InlineQueryHandler(instrument_handler("inline", inline_query)))
+
+    # Добавляем обработчик для текстовых сообщений
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrument_handler("text", handle_text)))
+    return app
+
+# Параметры вебхука из конфига. Секрет проверяется у каждого входящего запроса (заголовок
+# X-Telegram-Bot-Api-Secret-Token); если он не задан, генерируется при каждом запуске
+def webhook_options():
+    webhook_url = config.get("webhook_url")
+    if not webhook_url:
+        raise ValueError("для mode=webhook нужен webhook_url")
+    return {
+        "listen": config.get("webhook_listen", "127.0.0.1"),
+        "port": config.get("webhook_port", 8443),
+        "url_path": config.get("webhook_path", urlsplit(webhook_url).path.strip("/")),
+        "webhook_url": webhook_url,
+        "secret_token": config.get("webhook_secret") or secrets.token_urlsafe(32),
+        "cert": config.get("webhook_cert"),
+        "key": config.get("webhook_key"),
+        "max_connections": config.get("webhook_max_connections", 40)
+    }
+
+def main():
+    try:
+        if not config["token"]:
+            logger.error("Токен бота не найден в конфигурации")
+            print("Ошибка: токен бота не найден в конфигурации!")
+            return
+
+        app = build_application()
+
+        # Запускаем бота: опрос getUpdates (по умолчанию) или вебхук со встроенным HTTP-сервером.
+        # В обоих режимах SIGINT/SIGTERM останавливают приём, дожидаются обработчиков и вызывают on_shutdown
+        mode = config.get("mode", "polling")
+        logger.info(f"Bot started! ({mode})")
+        print("Bot started!")
+        if mode == "webhook":
+            app.run_webhook(**webhook_options())
+        else:
+            app.run_polling()
+    except Exception as e:
+        logger.critical(f"Критическая ошибка при запуске бота: {e}")
+        print(f"Критическая ошибка при запуске бота: {e}")
+
+if __name__ == "__main__":
+    main()
@@ -39,10 +39,14 @@ install_dependencies() {
 
     # Устанавливаем библиотеки в venv
     "$INSTALL_DIR/venv/bin/pip" install --upgrade pip
-    "$INSTALL_DIR/venv/bin/pip" install python-telegram-bot requests beautifulsoup4
+    "$INSTALL_DIR/venv/bin/pip" install "python-telegram-bot[webhooks]" "httpx[brotli]" beautifulsoup4 lxml selectolax
 
     # Копируем meds_bot.py из /root/ в папку бота
     cp /root/meds_bot.py "$INSTALL_DIR/"
+    # Список населённых пунктов для поиска городов (без него используется встроенный список основных городов)
+    if [ -f /root/ua_settlements.tsv ]; then
+        cp /root/ua_settlements.tsv "$INSTALL_DIR/"
+    fi
     
     echo "✅  Зависимости установлены"
 }
@@ -57,9 +61,7 @@ configure_token() {
 {
     "token": "$TOKEN",
     "cities": [],
-    "drugs": [],
-    "interval_hours": 12,
-    "chat_ids": []
+    "drugs": []
 }
 EOF
 